@@ -10,7 +10,9 @@ import xml.etree.ElementTree
 import sys
 import os.path
 
+from nntp import NNTP
 from nzb import NZBBuilder
+from run import RefreshGroups
 from store import Article, Group
 
 
@@ -138,9 +140,18 @@ class Indexer:
       return
 
   def _build_group_list(self, all=False):
-    with self.nntp_connection as nntp:
-      resp, groups = nntp.list()
-    Group.add_from_nntplib(groups)
+    # Streamed into the store while it is read; after the first full list
+    # only groups created since are asked for, unless all is set.
+    server = NNTP(self.config.get('indexer', 'host'),
+                  self.config.getint('indexer', 'port'),
+                  self.config.get('indexer', 'username'),
+                  self.config.get('indexer', 'password'), True)
+    self.nntp_semaphore.acquire()
+    try:
+      RefreshGroups(server, all)
+    finally:
+      server.close()
+      self.nntp_semaphore.release()
 
   def _fetch_group_articles(self, group, start, end):
     LOG.debug((group, start, end))
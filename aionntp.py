@@ -0,0 +1,567 @@
+#!/usr/bin/python
+"""An event loop driven NNTP client and the sync engine built on it.
+
+Selected with `engine: asyncio` in config.yaml. Every connection of every
+server is one coroutine on a single loop, fetched articles go through
+bounded queues to a parse and a store stage, and Ctrl-C cancels the fetchers
+at their next read instead of waiting on blocked sockets.
+
+Written against trollius, the asyncio backport for Python 2: coroutines use
+`yield From(...)` and `raise Return(...)` in place of await and return.
+"""
+
+import collections
+import concurrent.futures
+import functools
+import logging
+import nntplib
+import signal
+import ssl
+import time
+
+import trollius as asyncio
+from trollius import From, Return
+
+import headers
+from matcher import SubjectParser
+import metrics
+import nntp
+from pipeline import DEFAULT_STORE_BACKLOG
+# run.py imports this module only once asked for the asyncio engine.
+from run import (DEFAULT_BATCH_SIZE, DEFAULT_REPORT_INTERVAL,
+                 DEFAULT_UNIT_SPANS, DEFAULT_WATERMARK_AGE)
+from scheduler import DEFAULT_MAX_ATTEMPTS, Span, WorkUnit, split_range
+import store
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+CRLF = '\r\n'
+DOT_END = '\r\n.\r\n'  # a multi-line body's terminator, with the CRLF before it
+
+# Errors that lose the connection; anything still in flight is gone with it.
+CONNECTION_ERRORS = (EnvironmentError, EOFError, nntplib.NNTPError)
+
+
+class AsyncNNTP(object):
+  """A single NNTP connection, read and written through an event loop."""
+
+  @classmethod
+  def FromConfig(cls, config, loop=None):
+    return cls(
+      config['host'], config.get('port', nntp.DEFAULT_NNTP_PORT),
+      config.get('username'), config.get('password'),
+      config.get('ssl', False),
+      config.get('xover_span', nntp.DEFAULT_XOVER_SPAN),
+      config.get('xover_pipeline', nntp.DEFAULT_XOVER_PIPELINE),
+      config.get('backbone'), loop)
+
+  def __init__(self, host, port, user=None, password=None, is_ssl=False,
+               xover_span=None, xover_pipeline=None, backbone=None,
+               loop=None):
+    self.host = host
+    self.port = port
+    self.backbone = backbone or host
+    self.user = user
+    self.password = password
+    self.is_ssl = is_ssl
+    self.xover_span_width = int(xover_span or nntp.DEFAULT_XOVER_SPAN)
+    self.xover_pipeline = max(
+      1, int(xover_pipeline or nntp.DEFAULT_XOVER_PIPELINE))
+    self.loop = loop
+    self.reader = self.writer = None
+    self.welcome = None
+    self.group_name = None
+    self._buffer = ''
+    self.received = 0  # bytes read off the connection
+
+  def __str__(self):
+    return '<AsyncNNTP %s %i>' % (self.host, self.port)
+
+  @property
+  def connected(self):
+    return self.writer is not None
+
+  @asyncio.coroutine
+  def connect(self):
+    LOG.info('connecting to %s:%i', self.host, self.port)
+    context = None
+    if self.is_ssl:
+      # Like ssl.wrap_socket in nntp.NNTP: encrypted, but unverified.
+      context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    self.reader, self.writer = yield From(asyncio.open_connection(
+      self.host, self.port, ssl=context, loop=self.loop))
+    self._buffer = ''
+    self.group_name = None
+    try:
+      self.welcome = yield From(self.getresp())
+      yield From(self._authenticate())
+    except:
+      self.close()
+      raise
+
+  @asyncio.coroutine
+  def _authenticate(self):
+    readermode_afterauth = False
+    try:
+      self.welcome = yield From(self.shortcmd('MODE READER'))
+    except nntplib.NNTPPermanentError:
+      pass  # error 500, probably 'not implemented'
+    except nntplib.NNTPTemporaryError as err:
+      if not (self.user and err.response[:3] == '480'):
+        raise
+      readermode_afterauth = True
+    if not self.user:
+      return
+    resp = yield From(self.shortcmd('AUTHINFO USER ' + self.user))
+    if resp[:3] == '381':
+      if not self.password:
+        raise nntplib.NNTPReplyError(resp)
+      resp = yield From(self.shortcmd('AUTHINFO PASS ' + self.password))
+      if resp[:3] != '281':
+        raise nntplib.NNTPPermanentError(resp)
+    if readermode_afterauth:
+      try:
+        self.welcome = yield From(self.shortcmd('MODE READER'))
+      except nntplib.NNTPPermanentError:
+        pass
+
+  def close(self):
+    """Drops the connection without a QUIT; safe mid-response."""
+    if self.writer is not None:
+      self.writer.close()
+    self.reader = self.writer = None
+
+  @asyncio.coroutine
+  def quit(self):
+    try:
+      yield From(self.shortcmd('QUIT'))
+    except CONNECTION_ERRORS:
+      pass
+    finally:
+      self.close()
+
+  @asyncio.coroutine
+  def _read(self):
+    data = yield From(self.reader.read(nntp.CHUNK_SIZE))
+    if not data:
+      raise EOFError('%s closed the connection' % self)
+    self.received += len(data)
+    raise Return(data)
+
+  @asyncio.coroutine
+  def _readline(self):
+    while CRLF not in self._buffer:
+      self._buffer += yield From(self._read())
+    line, self._buffer = self._buffer.split(CRLF, 1)
+    raise Return(line)
+
+  @asyncio.coroutine
+  def _read_body(self):
+    """Returns the dot-unstuffed lines of a multi-line response body.
+
+    Data is read in chunks and only joined once the terminator shows up,
+    rather than awaiting every line on its own.
+    """
+    chunks = [CRLF]
+    tail = CRLF
+    data, self._buffer = self._buffer, ''
+    while DOT_END not in tail + data:
+      chunks.append(data)
+      tail = (tail + data)[-len(DOT_END):]
+      data = yield From(self._read())
+    chunks.append(data)
+    text = ''.join(chunks)
+    end = text.find(DOT_END)
+    self._buffer = text[end + len(DOT_END):]
+    body = text[len(CRLF):end]
+    if not body:
+      raise Return([])
+    lines = body.split(CRLF)
+    if body[0] == '.' or '\n.' in body:
+      lines = [line[1:] if line[:1] == '.' else line for line in lines]
+    raise Return(lines)
+
+  @asyncio.coroutine
+  def getresp(self):
+    resp = yield From(self._readline())
+    code = resp[:1]
+    if code == '4':
+      raise nntplib.NNTPTemporaryError(resp)
+    if code == '5':
+      raise nntplib.NNTPPermanentError(resp)
+    if not code or code not in '123':
+      raise nntplib.NNTPProtocolError(resp)
+    raise Return(resp)
+
+  @asyncio.coroutine
+  def shortcmd(self, line):
+    self.writer.write(line + CRLF)
+    resp = yield From(self.getresp())
+    raise Return(resp)
+
+  @asyncio.coroutine
+  def longcmd(self, line):
+    resp = yield From(self.shortcmd(line))
+    if resp[:3] not in nntp.LONGRESP:
+      raise nntplib.NNTPReplyError(resp)
+    lines = yield From(self._read_body())
+    raise Return((resp, lines))
+
+  @asyncio.coroutine
+  def group(self, name):
+    """Returns (resp, count, first, last, name), as nntplib does."""
+    resp = yield From(self.shortcmd('GROUP ' + name))
+    if resp[:3] != '211':
+      raise nntplib.NNTPReplyError(resp)
+    words = resp.split()
+    self.group_name = name
+    raise Return((resp, words[1], words[2], words[3],
+                  words[4] if len(words) > 4 else name))
+
+  @asyncio.coroutine
+  def list(self):
+    """Returns (resp, [(name, last, first, flag), ...]), as nntplib does."""
+    resp, lines = yield From(self.longcmd('LIST'))
+    raise Return((resp, [tuple(line.split()) for line in lines]))
+
+  @asyncio.coroutine
+  def list_active(self, wildmat=None):
+    """Returns the nntp.Active records of the groups matching wildmat."""
+    command = 'LIST ACTIVE %s' % wildmat if wildmat else 'LIST ACTIVE'
+    resp, lines = yield From(self.longcmd(command))
+    raise Return(list(nntp.parse_active(lines)))
+
+  @asyncio.coroutine
+  def active(self, names):
+    """Returns {name: nntp.Active} for the group names that exist.
+
+    As nntp.NNTP.active: LIST ACTIVE wildmats where possible, GROUP for
+    the rest.
+    """
+    wanted = set(names)
+    found = {}
+    wildmats, rest = nntp.group_wildmats(sorted(wanted))
+    for wildmat in wildmats:
+      try:
+        records = yield From(self.list_active(wildmat))
+      except nntplib.NNTPPermanentError as err:
+        LOG.info('%s refused LIST ACTIVE with a wildmat: %s', self, err.response)
+        rest = sorted(wanted.difference(found))
+        break
+      found.update((record.name, record) for record in records
+                   if record.name in wanted)
+    for name in rest:
+      try:
+        resp, count, first, last, group_name = yield From(self.group(name))
+      except nntplib.NNTPTemporaryError as err:
+        LOG.debug('No group %s on %s: %s', name, self, err.response)
+        continue
+      found[name] = nntp.Active(name, int(last), int(first), 'y')
+    raise Return(found)
+
+  @asyncio.coroutine
+  def xover(self, low, high):
+    """Returns the Overview records of [low, high] in the selected group."""
+    records = []
+
+    @asyncio.coroutine
+    def collect(span_low, span_high, span_records):
+      records.extend(span_records)
+
+    yield From(self.xover_spans(self.group_name, low, high, collect))
+    raise Return(records)
+
+  @asyncio.coroutine
+  def xover_spans(self, group_name, start, end, on_span):
+    """Fetches [start, end] of group_name in xover_span sized spans.
+
+    Up to xover_pipeline XOVER commands are in flight at once. For every
+    span, in order, the coroutine on_span(low, high, records) is awaited
+    before the next response is read, so a slow consumer holds the socket
+    back instead of letting records pile up.
+    """
+    if self.group_name != group_name:
+      yield From(self.group(group_name))
+    spans = iter(split_range(start, end, self.xover_span_width))
+    pending = collections.deque()
+    while True:
+      while len(pending) < self.xover_pipeline:
+        span = next(spans, None)
+        if span is None:
+          break
+        self.writer.write('XOVER %i-%i%s' % (span + (CRLF,)))
+        pending.append(span)
+      yield From(self.writer.drain())
+      if not pending:
+        break
+      low, high = pending.popleft()
+      started, received = time.time(), self.received
+      try:
+        resp = yield From(self.getresp())
+      except nntplib.NNTPTemporaryError as err:
+        if err.response[:3] not in nntp.NO_ARTICLES:
+          raise
+        LOG.debug('No articles in [%i-%i]: %s', low, high, err.response)
+        records = []
+      else:
+        if resp[:3] != '224':
+          raise nntplib.NNTPReplyError(resp)
+        lines = yield From(self._read_body())
+        records = list(nntp.parse_overview(lines))
+      metrics.XOVER_SECONDS.observe(time.time() - started, (self.host,))
+      metrics.OVERVIEW_BYTES.inc(self.received - received, (self.host,))
+      yield From(on_span(low, high, records))
+
+
+def _store(batch, spans):
+  # Runs on the writer thread; spans follow their articles, as in run.py.
+  with store.peewee_db.atomic():
+    rows = store.Article.addBatchFromNNTP(batch)
+    for span in spans:
+      store.Coverage.add(*span)
+  return rows
+
+
+class _BoundedQueue(asyncio.Queue):
+  """A queue of at most maxsize items, bounded by a semaphore.
+
+  trollius' own maxsize asserts when a getter takes twice before a putter it
+  woke has run, which draining a batch with several fetchers waiting does.
+  """
+
+  def __init__(self, maxsize, loop=None):
+    super(_BoundedQueue, self).__init__(loop=loop)
+    self._room = asyncio.Semaphore(maxsize, loop=loop)
+
+  @asyncio.coroutine
+  def put(self, item):
+    yield From(self._room.acquire())
+    self.put_nowait(item)
+
+  def _get(self):
+    self._room.release()
+    return super(_BoundedQueue, self)._get()
+
+
+@asyncio.coroutine
+def _queue_span(fetched, unit, low, high, records):
+  for record in records:
+    yield From(fetched.put((unit.backbone, unit.group, record._replace(
+      subject=headers.decode_subject(record.subject),
+      poster=headers.decode_poster(record.poster)))))
+  yield From(fetched.put(Span(unit.backbone, unit.group, low, high)))
+
+
+@asyncio.coroutine
+def PlanSync(loop, writer, clients, group_names, unit_spans,
+             max_age=DEFAULT_WATERMARK_AGE):
+  """Returns a deque of missing work units per backbone.
+
+  Each backbone is planned through its first connection, from watermarks
+  stored within max_age seconds or else fetched with LIST ACTIVE; stored
+  watermarks and coverage are read on the writer thread, which owns the
+  database.
+  """
+  units = collections.OrderedDict()
+  for backbone, backbone_clients in clients.iteritems():
+    client = backbone_clients[0]
+    width = client.xover_span_width * unit_spans
+    units[backbone] = collections.deque()
+    watermarks = yield From(loop.run_in_executor(
+      writer, store.Watermark.fresh, backbone, group_names, max_age))
+    stale = [name for name in group_names if name not in watermarks]
+    if stale:
+      if not client.connected:
+        yield From(client.connect())
+      found = yield From(client.active(stale))
+      yield From(loop.run_in_executor(
+        writer, store.Watermark.addBatchFromActive, backbone, found.values()))
+      watermarks.update((record.name, (record.low, record.high))
+                        for record in found.itervalues())
+    for group_name in group_names:
+      if group_name not in watermarks:
+        LOG.warn('Skipping %s on %s: no such group', group_name, backbone)
+        continue
+      first, last = watermarks[group_name]
+      missing = yield From(loop.run_in_executor(
+        writer, store.Coverage.missing, backbone, group_name, first, last))
+      LOG.info('%s on %s [%d-%d]: %d missing ranges, %d articles',
+               group_name, backbone, first, last, len(missing),
+               sum(high - low + 1 for low, high in missing))
+      for low, high in missing:
+        for piece in split_range(low, high, width):
+          units[backbone].append(
+            WorkUnit(backbone, group_name, piece[0], piece[1], 0, ()))
+  raise Return(units)
+
+
+def _take(units, host):
+  # As Scheduler does, prefer a unit this host has not failed yet; failing
+  # that, retry on it anyway rather than leave the unit behind.
+  for idx, unit in enumerate(units):
+    if host not in unit.failed_on:
+      del units[idx]
+      return unit
+  return units.popleft()
+
+
+@asyncio.coroutine
+def FetchWorker(client, units, fetched, max_attempts):
+  """Fetches units of one backbone over one connection until none are left."""
+  while units:
+    unit = _take(units, client.host)
+    try:
+      if not client.connected:
+        yield From(client.connect())
+      yield From(client.xover_spans(
+        unit.group, unit.low, unit.high,
+        functools.partial(_queue_span, fetched, unit)))
+    except CONNECTION_ERRORS as err:
+      LOG.warn('Fetching %s [%i-%i] from %s failed: %s',
+               unit.group, unit.low, unit.high, client, err)
+      # Pipelined responses may still be on their way; start over.
+      client.close()
+      if unit.attempts + 1 >= max_attempts:
+        LOG.error('Giving up on %s [%i-%i] after %d attempts',
+                  unit.group, unit.low, unit.high, unit.attempts + 1)
+      else:
+        units.appendleft(unit._replace(
+          attempts=unit.attempts + 1,
+          failed_on=unit.failed_on + (client.host,)))
+  if client.connected:
+    yield From(client.quit())
+
+
+@asyncio.coroutine
+def ParseWorker(loop, fetched, parsed, parser, batch_size):
+  """Gathers fetched articles into batches and matches their subjects.
+
+  Matching runs off the loop, in the parser's process pool; a None from the
+  fetch queue flushes the last batch and is passed on to the store stage.
+  """
+  finished = False
+  while not finished:
+    items = [(yield From(fetched.get()))]
+    while len(items) < batch_size and not fetched.empty():
+      items.append(fetched.get_nowait())
+    if items[-1] is None:
+      finished = True
+      items.pop()
+    if not items:
+      continue
+    batch = [item for item in items if not isinstance(item, Span)]
+    spans = [item for item in items if isinstance(item, Span)]
+    segment_data = yield From(loop.run_in_executor(
+      None, parser.match, [nntp_article.subject for _, _, nntp_article in batch]))
+    yield From(parsed.put((batch, spans, segment_data)))
+  yield From(parsed.put(None))
+
+
+@asyncio.coroutine
+def StoreWorker(loop, writer, parsed, fetched):
+  """Writes matched batches, one transaction each, on the writer thread."""
+  while True:
+    item = yield From(parsed.get())
+    if item is None:
+      break
+    batch, spans, segment_data = item
+    started = time.time()
+    rows = yield From(loop.run_in_executor(writer, _store, [
+      (server, group_name, nntp_article, data)
+      for (server, group_name, nntp_article), data in zip(batch, segment_data)
+    ], spans))
+    elapsed = time.time() - started
+    LOG.info('Stored %d articles (%d rows) in %.2fs, %d rows/s, %d queued',
+             len(batch), rows, elapsed, rows / max(elapsed, 0.001),
+             fetched.qsize())
+
+
+@asyncio.coroutine
+def _watch(loop, exit_event, fetchers, stages, interval):
+  # run.py reports Ctrl-C and other shutdown requests through exit_event. A
+  # stage that died would leave the fetchers blocked on a full queue.
+  reported = time.time()
+  while not all(task.done() for task in fetchers):
+    if metrics.ENABLED and time.time() - reported >= interval:
+      LOG.info('metrics: %s', metrics.summary())
+      reported = time.time()
+    if exit_event.is_set() or any(task.done() for task in stages):
+      for task in fetchers:
+        task.cancel()
+      break
+    yield From(asyncio.sleep(0.5, loop=loop))
+
+
+@asyncio.coroutine
+def _sync(loop, exit_event, config, parser, writer):
+  batch_size = config.get('batch_size', DEFAULT_BATCH_SIZE)
+  clients = collections.OrderedDict()
+  for server in config.get('servers'):
+    for _ in xrange(server.get('connections', nntp.DEFAULT_CONNECTIONS)):
+      client = AsyncNNTP.FromConfig(server, loop)
+      clients.setdefault(client.backbone, []).append(client)
+
+  units = yield From(PlanSync(
+    loop, writer, clients, config.get('groups'),
+    config.get('unit_spans', DEFAULT_UNIT_SPANS),
+    config.get('watermark_age', DEFAULT_WATERMARK_AGE)))
+  # Bounded, so fetchers stall rather than outrun matching and writing.
+  fetched = _BoundedQueue(batch_size * 2, loop=loop)
+  parsed = asyncio.Queue(
+    config.get('store_backlog', DEFAULT_STORE_BACKLOG), loop=loop)
+  metrics.QUEUE_DEPTH.track(fetched.qsize, ('fetched',))
+  metrics.QUEUE_DEPTH.track(parsed.qsize, ('parsed',))
+  stages = [
+    asyncio.ensure_future(
+      ParseWorker(loop, fetched, parsed, parser, batch_size), loop=loop),
+    asyncio.ensure_future(
+      StoreWorker(loop, writer, parsed, fetched), loop=loop),
+  ]
+  max_attempts = config.get('max_attempts', DEFAULT_MAX_ATTEMPTS)
+  fetchers = [
+    asyncio.ensure_future(
+      FetchWorker(client, units[backbone], fetched, max_attempts), loop=loop)
+    for backbone, backbone_clients in clients.iteritems()
+    for client in backbone_clients]
+  LOG.info('Fetching %d work units over %d connections',
+           sum(len(queue) for queue in units.itervalues()), len(fetchers))
+
+  try:
+    loop.add_signal_handler(signal.SIGINT, exit_event.set)
+  except (RuntimeError, ValueError):
+    pass  # not the main thread; rely on the caller setting exit_event
+  yield From(_watch(loop, exit_event, fetchers, stages,
+                    config.get('report_interval', DEFAULT_REPORT_INTERVAL)))
+  yield From(asyncio.wait(fetchers, loop=loop))
+  for task in fetchers:
+    if not task.cancelled() and task.exception() is not None:
+      LOG.error('Fetch worker failed: %r', task.exception())
+  for client in (client for backbone_clients in clients.itervalues()
+                 for client in backbone_clients):
+    client.close()
+  failed = [task for task in stages if task.done()]
+  if failed:
+    for task in stages:
+      task.cancel()
+    failed[0].result()
+  # Whatever was fetched before a cancel is still matched and stored.
+  yield From(fetched.put(None))
+  yield From(asyncio.gather(*stages, loop=loop))
+  for queue in ('fetched', 'parsed'):
+    metrics.QUEUE_DEPTH.forget((queue,))
+  if metrics.ENABLED:
+    LOG.info('metrics: %s', metrics.summary())
+
+
+def sync(exit_event, config):
+  loop = asyncio.new_event_loop()
+  parser = SubjectParser(config['regexp_file'],
+                         config.get('parse_processes'))
+  writer = concurrent.futures.ThreadPoolExecutor(1)
+  try:
+    loop.run_until_complete(_sync(loop, exit_event, config, parser, writer))
+  finally:
+    writer.shutdown()
+    parser.close()
+    loop.close()
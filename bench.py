@@ -0,0 +1,693 @@
+#!/usr/bin/python2
+"""Micro benchmarks for the indexer's hot paths.
+
+  python bench.py overview [articles]
+  python bench.py match [subjects]
+  python bench.py dates [headers]
+  python bench.py http [requests] [concurrency] [readers]
+  python bench.py schema [articles] [batch size]
+  python bench.py stages [articles] [latency ms]
+  python bench.py sync [articles] [connections] [latency ms] [KB/s] [processes]
+  python bench.py compare old.json new.json
+
+Results are printed as JSON; --json path also writes them there, with
+when and on what they were taken, for `compare` to diff a later run
+against. stages and sync fetch from fakenntp, in a process of its own.
+"""
+
+import calendar
+import cStringIO
+import datetime
+import httplib
+import json
+import nntplib
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib
+from wsgiref import simple_server
+
+from dateutil import parser
+
+import fakenntp
+import headers
+import matcher
+import metrics
+import nntp
+import nzb
+import run
+import store
+
+
+def _max_rss():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _timed(func, *args):
+  rss = _max_rss()
+  started = time.time()
+  count = func(*args)
+  elapsed = time.time() - started
+  return {
+    'seconds': round(elapsed, 4),
+    'per_second': int(count / elapsed) if elapsed else None,
+    'max_rss_growth_kb': _max_rss() - rss,
+  }
+
+
+def _decode(field):
+  if not isinstance(field, str):
+    return field
+  try:
+    return unicode(field, 'ascii')
+  except UnicodeDecodeError:
+    return unicode(field, 'latin-1')
+
+
+def synthetic_overview(count, first=1):
+  """Returns a 224 XOVER response for count binary-group style articles."""
+  lines = ['224 Overview information follows']
+  for number in xrange(first, first + count):
+    lines.append('\t'.join([
+      str(number),
+      'Some.Release.Name.S01E%02d.720p - [%02d/45] - "some.release.'
+      'name.part%02d.rar" yEnc (%d/137)' % (
+        number % 24, number % 45, number % 45, number % 137 + 1),
+      'poster%d <poster%d@example.com>' % (number % 7, number % 7),
+      'Sat, 12 Oct 2013 17:%02d:%02d +0000' % (number / 60 % 60, number % 60),
+      '<part%dof137.%d@example.com>' % (number % 137 + 1, number),
+      '',
+      str(396000 + number % 1000),
+      '3042',
+      'Xref: news.example.com alt.binaries.example:%d' % number,
+    ]))
+  lines.append('.')
+  return '\r\n'.join(lines) + '\r\n'
+
+
+class _FakeSocket(object):
+  def __init__(self, data, chunk_size=nntp.CHUNK_SIZE):
+    self._file = cStringIO.StringIO(data)
+    self._chunk_size = chunk_size
+
+  def recv(self, size):
+    return self._file.read(min(size, self._chunk_size))
+
+  def readline(self, limit=-1):
+    return self._file.readline(limit)
+
+  def sendall(self, data):
+    pass
+
+
+class _NNTPLibClient(nntplib.NNTP):
+  def __init__(self, sock):
+    self.sock = self.file = sock
+    self.debugging = 0
+
+
+def _nntplib_overview(data):
+  # The pre-streaming path: nntplib builds the full list of 8-tuples, then
+  # run.py decoded every field.
+  client = _NNTPLibClient(_FakeSocket(data))
+  count = 0
+  for article in client.xover('1', '2')[1]:
+    [_decode(field) for field in article]
+    count += 1
+  return count
+
+
+def _streaming_overview(data):
+  reader = nntp.SocketReader(_FakeSocket(data))
+  reader.readline()
+  count = 0
+  for record in nntp.parse_overview(reader.dot_lines()):
+    record._replace(subject=_decode(record.subject),
+                    poster=_decode(record.poster))
+    count += 1
+  return count
+
+
+def bench_overview(articles=100000):
+  data = synthetic_overview(articles)
+  return {
+    'articles': articles,
+    'response_bytes': len(data),
+    'streaming': _timed(_streaming_overview, data),
+    'nntplib': _timed(_nntplib_overview, data),
+  }
+
+
+def _sequential_match(subjects):
+  # The pre-engine path: every template in file order until one matches.
+  for subject in subjects:
+    for candidate in matcher.Matchers:
+      if candidate.pattern.match(subject):
+        break
+  return len(subjects)
+
+
+def _engine_match(subjects):
+  for subject in subjects:
+    matcher.MatchSubject(subject)
+  return len(subjects)
+
+
+def bench_match(subjects=100000, regexp_file='regexp.txt'):
+  if not matcher.Matchers:
+    matcher.LoadMatchers(open(regexp_file, 'rb'))
+  reader = nntp.SocketReader(_FakeSocket(synthetic_overview(subjects)))
+  reader.readline()
+  subjects = [record.subject
+              for record in nntp.parse_overview(reader.dot_lines())]
+  return {
+    'subjects': len(subjects),
+    'sequential': _timed(_sequential_match, subjects),
+    'engine': _timed(_engine_match, subjects),
+    'shape_hits': matcher.ENGINE.shape_hits,
+  }
+
+
+# Date header styles as posting clients write them into overviews.
+DATE_STYLES = (
+  '%a, %d %b %Y %H:%M:%S +0000',
+  '%d %b %Y %H:%M:%S GMT',
+  '%a, %d %b %Y %H:%M:%S +0000 (UTC)',
+  '%a, %d %b %y %H:%M:%S GMT',
+  '%a, %d %b %Y %H:%M:%S Z',
+)
+DATE_POSTS_PER_SECOND = 20  # parts a binary poster sends in one second
+
+
+def _synthetic_dates(count):
+  dates = []
+  for idx in xrange(count):
+    style = DATE_STYLES[idx / 1000 % len(DATE_STYLES)]
+    dates.append(time.strftime(style, time.gmtime(
+      1381597262 + idx / DATE_POSTS_PER_SECOND)))
+  return dates
+
+
+def _dateutil_dates(dates):
+  for date in dates:
+    calendar.timegm(parser.parse(date).utctimetuple())
+  return len(dates)
+
+
+def _header_dates(dates):
+  for date in dates:
+    headers.parse_date(date)
+  return len(dates)
+
+
+def _header_dates_unmemoized(dates):
+  for date in dates:
+    headers._fast_date(date)
+  return len(dates)
+
+
+def bench_dates(count=100000):
+  dates = _synthetic_dates(count)
+  return {
+    'headers': count,
+    'distinct': len(set(dates)),
+    'dateutil': _timed(_dateutil_dates, dates),
+    'fast_path': _timed(_header_dates_unmemoized, dates),
+    'memoized': _timed(_header_dates, dates),
+  }
+
+
+def _http_paths(count):
+  # A mix of the UI's polls, table pages and searches; offsets vary so
+  # most pages miss the response cache and reach the database.
+  paths = []
+  for idx in xrange(count):
+    tq = 'limit 50 offset %d' % (idx * 7 % 500)
+    paths.append([
+      '/state',
+      '/groups?' + urllib.urlencode({'tq': tq}),
+      '/articles?' + urllib.urlencode({'tq': tq}),
+      '/releases?' + urllib.urlencode({'tq': 'order by completion desc ' + tq}),
+      '/articles?' + urllib.urlencode({'tq': tq, 'query': 'part%02d' % (idx % 50)}),
+    ][idx % 5])
+  return paths
+
+
+def _load(httpd, requests, concurrency):
+  port = httpd.server_address[1]
+  serving = threading.Thread(target=httpd.serve_forever)
+  serving.daemon = True
+  serving.start()
+  paths = _http_paths(requests)
+  latencies = []
+  errors = [0]
+  lock = threading.Lock()
+
+  def client(offset):
+    for path in paths[offset::concurrency]:
+      started = time.time()
+      try:
+        conn = httplib.HTTPConnection('127.0.0.1', port, timeout=60)
+        conn.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        failed = response.status != 200
+      except (EnvironmentError, httplib.HTTPException):
+        failed = True
+      with lock:
+        latencies.append(time.time() - started)
+        errors[0] += failed
+
+  clients = [threading.Thread(target=client, args=(idx,))
+             for idx in xrange(concurrency)]
+  started = time.time()
+  for thread in clients:
+    thread.start()
+  for thread in clients:
+    thread.join()
+  elapsed = time.time() - started
+  httpd.shutdown()
+  httpd.server_close()
+  latencies.sort()
+  return {
+    'requests': len(latencies),
+    'errors': errors[0],
+    'per_second': int(len(latencies) / elapsed),
+    'p50_ms': int(latencies[len(latencies) / 2] * 1000),
+    'p99_ms': int(latencies[len(latencies) * 99 / 100] * 1000),
+  }
+
+
+def bench_http(requests=2000, concurrency=50, readers=None):
+  """Load tests the API against nntp.db: pooled server vs a serial one."""
+  import server
+  server.store.open_db()
+  server.RESPONSES.max_entries = 0  # measure the handlers, not the cache
+  app = server.gzipped(server.writes_apart(server.itty.handle_request))
+  class SerialServer(simple_server.WSGIServer):
+    # What itty.run_itty serves with: one request at a time.
+    request_queue_size = server.REQUEST_BACKLOG
+  serial = simple_server.make_server(
+    '127.0.0.1', 0, app, server_class=SerialServer,
+    handler_class=server.RequestHandler)
+  return {
+    'concurrency': concurrency,
+    'serial': _load(serial, requests, concurrency),
+    'pooled': _load(server.make_server(
+      '127.0.0.1', 0, readers or server.DEFAULT_READERS), requests, concurrency),
+  }
+
+
+# The store's tables as they were before integer article keys and interned
+# names (layout 0).
+LEGACY_SCHEMA = (
+  'CREATE TABLE article (identifier TEXT NOT NULL PRIMARY KEY,'
+  ' poster TEXT NOT NULL, posted DATETIME NOT NULL, subject TEXT NOT NULL,'
+  ' size BIGINT NOT NULL)',
+  'CREATE INDEX article_posted_identifier ON article (posted, identifier)',
+  'CREATE TABLE groupindex (server TEXT NOT NULL, name TEXT NOT NULL,'
+  ' number BIGINT NOT NULL, article_id TEXT NOT NULL,'
+  ' PRIMARY KEY (server, name, number))',
+  'CREATE INDEX groupindex_article_id ON groupindex (article_id)',
+  'CREATE INDEX groupindex_name_number ON groupindex (name, number)',
+  'CREATE TABLE segment (article_id TEXT NOT NULL PRIMARY KEY,'
+  ' release_name TEXT, file_name TEXT NOT NULL, file_total INTEGER NOT NULL,'
+  ' file_number INTEGER NOT NULL, part_total INTEGER NOT NULL,'
+  ' part_number INTEGER NOT NULL)',
+  'CREATE INDEX segment_release_name_file_name_part_number'
+  ' ON segment (release_name, file_name, part_number)',
+)
+LEGACY_PRAGMAS = {'journal_mode': 'delete', 'synchronous': 'full'}
+
+
+def _synthetic_rows(first, count):
+  # (article, group index, segment, posted epoch) rows as
+  # Article.addBatchFromNNTP writes them to layout 0, minus the article
+  # reference.
+  for number in xrange(first, first + count):
+    message_id = '<part%dof137.%d@example.com>' % (number % 137 + 1, number)
+    release = 'Some.Release.Name.%d' % (number / 5000)
+    minute, second = number / 60 % 60, number % 60
+    yield ((message_id, 'poster%d <poster%d@example.com>' % (
+              number % 7, number % 7),
+            '2013-10-12 17:%02d:%02d+00:00' % (minute, second),
+            '%s - [%02d/45] - "%s.part%02d.rar" yEnc (%d/137)' % (
+              release, number % 45, release, number % 45, number % 137 + 1),
+            396000 + number % 1000),
+           ('news.example.com', 'alt.binaries.example', number),
+           (release, '%s.part%02d.rar' % (release, number % 45), 45,
+            number % 45, 137, number % 137 + 1),
+           calendar.timegm((2013, 10, 12, 17, minute, second)))
+
+
+def _store_keyed(conn, rows):
+  # Articles with interned posters and epoch dates; returns their ids.
+  posters = store.POSTERS.ids(row[0][1] for row in rows)
+  servers = store.SERVERS.ids(row[1][0] for row in rows)
+  groups = store.GROUPS.ids(row[1][1] for row in rows)
+  conn.executemany(
+    'INSERT OR IGNORE INTO article (identifier, identifier_hash, poster_id,'
+    ' posted, subject, size) VALUES (?, ?, ?, ?, ?, ?)',
+    [(row[0][0], store.message_key(row[0][0]), posters[row[0][1]], row[3],
+      row[0][3], row[0][4]) for row in rows])
+  ids = {}
+  for chunk in store.chunked(rows):
+    keys = [store.message_key(row[0][0]) for row in chunk]
+    ids.update(conn.execute(
+      'SELECT identifier, id FROM article WHERE identifier_hash IN (%s)'
+      % ', '.join('?' * len(keys)), keys).fetchall())
+  references = [ids[row[0][0]] for row in rows]
+  conn.executemany('INSERT OR IGNORE INTO groupindex VALUES (?, ?, ?, ?)',
+                   [(servers[row[1][0]], groups[row[1][1]], row[1][2], ref)
+                    for row, ref in zip(rows, references)])
+  return references
+
+
+class _legacy_transaction(object):
+  def __init__(self, conn):
+    self.conn = conn
+
+  def __enter__(self):
+    self.conn.execute('BEGIN')
+
+  def __exit__(self, *exc_info):
+    self.conn.execute('COMMIT' if exc_info[0] is None else 'ROLLBACK')
+
+
+def _load_articles(conn, articles, batch_size, layout):
+  for first in xrange(0, articles, batch_size):
+    rows = list(_synthetic_rows(first, min(batch_size, articles - first)))
+    if layout == 'store':
+      _store_rows(rows)
+      continue
+    # The current layout is written through the store's own connection,
+    # which its interners share.
+    keyed = layout == 'current'
+    with store.peewee_db.atomic() if keyed else _legacy_transaction(conn):
+      if keyed:
+        references = _store_keyed(conn, rows)
+      else:
+        conn.executemany('INSERT OR IGNORE INTO article VALUES (?, ?, ?, ?, ?)',
+                         [row[0] for row in rows])
+        references = [row[0][0] for row in rows]
+        conn.executemany('INSERT OR IGNORE INTO groupindex VALUES (?, ?, ?, ?)',
+                         [row[1] + (ref,) for row, ref in zip(rows, references)])
+      conn.executemany(
+        'INSERT OR IGNORE INTO segment VALUES (?, ?, ?, ?, ?, ?, ?)',
+        [(ref,) + row[2] for row, ref in zip(rows, references)])
+  return articles
+
+
+def _store_rows(rows):
+  # The same rows through Article.addBatchFromNNTP, as a sync stores them.
+  batch = []
+  for ((message_id, poster, posted, subject, size), (server, name, number),
+       segment, _) in rows:
+    batch.append((server, name, nntp.Overview(
+      number, subject, poster, posted, message_id, size), dict(zip(
+        ('release_name', 'file_name', 'file_total', 'file_number',
+         'part_total', 'part_number'), segment))))
+  store.Article.addBatchFromNNTP(batch)
+
+
+def _lookup_articles(conn, articles, keyed, lookups=10000):
+  chooser = random.Random(articles)
+  for _ in xrange(lookups):
+    number = chooser.randrange(articles)
+    message_id = '<part%dof137.%d@example.com>' % (number % 137 + 1, number)
+    if keyed:
+      conn.execute('SELECT * FROM article'
+                   ' WHERE identifier_hash = ? AND identifier = ?',
+                   (store.message_key(message_id), message_id)).fetchall()
+    else:
+      conn.execute('SELECT * FROM article WHERE identifier = ?',
+                   (message_id,)).fetchall()
+  return lookups
+
+
+def _schema_run(directory, name, articles, batch_size, layout, pragmas):
+  path = os.path.join(directory, name + '.db')
+  if layout == 'legacy':
+    conn = sqlite3.connect(path, isolation_level=None)
+    for pragma, value in sorted(pragmas.iteritems()):
+      conn.execute('PRAGMA %s = %s' % (pragma, value))
+    for statement in LEGACY_SCHEMA:
+      conn.execute(statement)
+  else:
+    store.open_db({'path': path, 'pragmas': pragmas})
+    conn = store.peewee_db.get_conn()
+    if layout == 'current':
+      for (trigger,) in conn.execute(
+          "SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall():
+        conn.execute('DROP TRIGGER "%s"' % trigger)
+  result = {'load': _timed(_load_articles, conn, articles, batch_size, layout)}
+  conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+  result['lookup'] = _timed(_lookup_articles, conn, articles,
+                            layout != 'legacy')
+  if layout == 'legacy':
+    conn.close()
+  else:
+    store.peewee_db.close()
+  result['file_mb'] = round(sum(
+    os.path.getsize(os.path.join(directory, entry))
+    for entry in os.listdir(directory) if entry.startswith(name + '.db'))
+    / 1048576.0, 1)
+  return result
+
+
+def bench_schema(articles=10000000, batch_size=2000):
+  """Ingests synthetic articles into the old and current table layouts.
+
+  legacy, legacy_tuned and current_raw insert article, group index and
+  segment rows with bare executemany calls, without triggers, search
+  indexes or release summaries: they are ceilings of what each layout
+  allows, not what the store gets out of it. store writes the same rows
+  through Article.addBatchFromNNTP, with every trigger in place, as a
+  sync does.
+  """
+  directory = tempfile.mkdtemp(prefix='bench-schema-')
+  profile = store.DEFAULT_PROFILE['pragmas']
+  try:
+    return {
+      'articles': articles,
+      'legacy': _schema_run(directory, 'legacy', articles, batch_size,
+                            'legacy', LEGACY_PRAGMAS),
+      'legacy_tuned': _schema_run(directory, 'legacy_tuned', articles,
+                                  batch_size, 'legacy', profile),
+      'current_raw': _schema_run(directory, 'current_raw', articles,
+                                 batch_size, 'current', profile),
+      'store': _schema_run(directory, 'store', articles, batch_size,
+                           'store', profile),
+    }
+  finally:
+    shutil.rmtree(directory)
+
+
+FAKE_GROUP = fakenntp.DEFAULT_GROUPS[0]
+FAKE_SERVER = 'fakenntp'  # backbone the fetched articles are stored under
+
+
+class _NullFile(object):
+  def write(self, data):
+    self.bytes = getattr(self, 'bytes', 0) + len(data)
+
+  def close(self):
+    pass
+
+
+def _fetch(client, articles, records):
+  with client as conn:
+    records.extend(conn.xover_span(FAKE_GROUP, 1, articles))
+  client.close()
+  return len(records)
+
+
+def _decode_records(records, decoded):
+  decoded.extend(record._replace(
+    subject=headers.decode_subject(record.subject),
+    poster=headers.decode_poster(record.poster)) for record in records)
+  return len(decoded)
+
+
+def _match_subjects(records, segment_data):
+  segment_data.extend(matcher.MatchSubjects(
+    [record.subject for record in records]))
+  return len(segment_data)
+
+
+def _insert(records, segment_data, batch_size):
+  for first in xrange(0, len(records), batch_size):
+    store.Article.addBatchFromNNTP(
+      (FAKE_SERVER, FAKE_GROUP, record, data) for record, data in zip(
+        records[first:first + batch_size],
+        segment_data[first:first + batch_size]))
+  return len(records)
+
+
+def _export(names):
+  return nzb.write_releases(names, lambda name: _NullFile())
+
+
+def bench_stages(articles=100000, latency_ms=0, regexp_file='regexp.txt'):
+  """Times each stage of a sync on its own, over fakenntp's overviews.
+
+  fetch reads them over one connection, plain and gzip compressed;
+  decode, match and insert then take the fetched records through what
+  the pipeline does with them, and nzb exports every stored release.
+  """
+  if not matcher.Matchers:
+    matcher.LoadMatchers(open(regexp_file, 'rb'))
+  port, server = fakenntp.serve_in_process(
+    articles=articles, latency=latency_ms / 1000.0, gzip=True, prime=True,
+    regexp_file=regexp_file)
+  directory = tempfile.mkdtemp(prefix='bench-stages-')
+  records, compressed, decoded, segment_data = [], [], [], []
+  try:
+    result = {
+      'articles': articles,
+      'fetch': _timed(_fetch, nntp.NNTP(
+        '127.0.0.1', port, usenetrc=False, compression='none'),
+        articles, records),
+      'fetch_gzip': _timed(_fetch, nntp.NNTP(
+        '127.0.0.1', port, usenetrc=False, compression='gzip'),
+        articles, compressed),
+      'decode': _timed(_decode_records, records, decoded),
+      'match': _timed(_match_subjects, decoded, segment_data),
+    }
+    store.open_db({'path': os.path.join(directory, 'nntp.db')})
+    result['insert'] = _timed(_insert, decoded, segment_data,
+                              run.DEFAULT_BATCH_SIZE)
+    names = [name for (name,) in
+             store.Release.select(store.Release.name).tuples()]
+    result['nzb'] = _timed(_export, names)
+    result['matched'] = len(segment_data) - segment_data.count(None)
+    result['releases'] = len(names)
+    store.peewee_db.close()
+    return result
+  finally:
+    server.terminate()
+    shutil.rmtree(directory)
+
+
+def bench_sync(articles=200000, connections=4, latency_ms=20,
+               kbytes_per_second=0, processes=2, regexp_file='regexp.txt'):
+  """Runs run.sync against fakenntp end to end, then exports the NZBs.
+
+  latency_ms is the fake link's round trip and kbytes_per_second each
+  connection's bandwidth, 0 for unlimited; processes is parse_processes.
+  """
+  if not matcher.Matchers:
+    matcher.LoadMatchers(open(regexp_file, 'rb'))
+  port, server = fakenntp.serve_in_process(
+    articles=articles, latency=latency_ms / 1000.0,
+    bandwidth=kbytes_per_second * 1024, prime=True, regexp_file=regexp_file)
+  directory = tempfile.mkdtemp(prefix='bench-sync-')
+  config = {
+    'servers': [{'host': '127.0.0.1', 'port': port, 'backbone': FAKE_SERVER,
+                 'connections': connections, 'compression': 'none'}],
+    'groups': [FAKE_GROUP],
+    'regexp_file': regexp_file,
+    'parse_processes': processes,
+    'report_interval': 3600,
+  }
+  try:
+    store.open_db({'path': os.path.join(directory, 'nntp.db')})
+    def sync():
+      run.sync(threading.Event(), config)
+      return store.Article.select().count()
+    result = {
+      'articles': articles,
+      'connections': connections,
+      'latency_ms': latency_ms,
+      'kbytes_per_second': kbytes_per_second,
+      'sync': _timed(sync),
+    }
+    cache = nzb.NZBCache(os.path.join(directory, 'nzb'))
+    def export():
+      # Chatter takes the place of some parts, so few releases are
+      # complete; every one is exported.
+      names = [name for (name,) in
+               store.Release.select(store.Release.name).tuples()]
+      return len(cache.export(names))
+    result['nzb'] = _timed(export)
+    result['stored'] = store.Article.select().count()
+    result['releases'] = store.Release.select().count()
+    store.peewee_db.close()
+    return result
+  finally:
+    server.terminate()
+    shutil.rmtree(directory)
+
+
+def _flatten(results, path=()):
+  for key, value in sorted(results.iteritems()):
+    if isinstance(value, dict):
+      for item in _flatten(value, path + (key,)):
+        yield item
+    elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+      yield '.'.join(path + (key,)), value
+
+
+def compare(old_path, new_path):
+  """Changes between two --json runs, in percent of the old figures.
+
+  Only timings and rates are compared; for per_second higher is better,
+  for seconds lower.
+  """
+  old = dict(_flatten(json.load(open(old_path))['results']))
+  new = dict(_flatten(json.load(open(new_path))['results']))
+  changes = {}
+  for key in sorted(set(old) & set(new)):
+    if key.rsplit('.', 1)[-1] in ('per_second', 'seconds') and old[key]:
+      changes[key] = {
+        'old': old[key],
+        'new': new[key],
+        'change_percent': round((new[key] - old[key]) * 100.0 / old[key], 1),
+      }
+  return changes
+
+
+BENCHMARKS = {
+  'overview': bench_overview,
+  'match': bench_match,
+  'dates': bench_dates,
+  'http': bench_http,
+  'schema': bench_schema,
+  'stages': bench_stages,
+  'sync': bench_sync,
+}
+
+
+if __name__ == '__main__':
+  metrics.configure_logging()
+  argv = sys.argv[1:]
+  output = None
+  if '--json' in argv:
+    idx = argv.index('--json')
+    output = argv[idx + 1]
+    del argv[idx:idx + 2]
+  name = argv[0] if argv else 'overview'
+  if name == 'compare':
+    print json.dumps(compare(*argv[1:3]), indent=2, sort_keys=True)
+    sys.exit()
+  args = [int(arg) for arg in argv[1:]]
+  results = {name: BENCHMARKS[name](*args)}
+  print json.dumps(results, indent=2, sort_keys=True)
+  if output:
+    with open(output, 'w') as out:
+      json.dump({
+        'benchmark': name,
+        'args': args,
+        'taken': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+      }, out, indent=2, sort_keys=True)
@@ -0,0 +1,267 @@
+#!/usr/bin/python
+
+import logging
+import re
+
+from matcher import MatcherMacros
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+DEFAULT_MAX_CLUSTERS = 20000  # distinct subject shapes tracked at a time
+DEFAULT_SAMPLES = 5  # subjects kept per cluster, to show and to check against
+TOKENS = re.compile(r'"[^"]*"|\d+|[^\W\d_]+|\s+|.', re.U)
+REGEX_SPECIALS = frozenset('\\.^$*+?()[]|')
+OPENERS = {'(': ')', '[': ']'}
+SEPARATORS = ('-', '|')
+# Regular expressions for tokens that differ between a cluster's subjects.
+VARYING = {'0': r'\d+', '""': r'"[^"]*"', ' ': r'\s+'}
+
+
+def tokenize(subject):
+  return TOKENS.findall(subject)
+
+
+def _shape(token):
+  if token[0].isdigit():
+    return '0'
+  if token[0] == '"' and len(token) > 1:
+    return '""'
+  if token.isspace():
+    return ' '
+  return token
+
+
+def _escape(text):
+  # Braces are doubled as well, templates go through str.format.
+  out = []
+  for char in text:
+    if char in REGEX_SPECIALS:
+      out.append('\\' + char)
+    elif char in '{}':
+      out.append('\\' + char * 2)
+    else:
+      out.append(char)
+  return ''.join(out)
+
+
+def compile_template(template):
+  """Compiles a regexp.txt template the way matcher.MatcherEngine does."""
+  return re.compile('^' + template.format(**MatcherMacros) + '$', re.I)
+
+
+class Cluster(object):
+  """Subjects sharing one shape: the same tokens, apart from digit runs,
+  quoted strings and spacing.
+
+  tokens holds the first subject's tokens, with None wherever a later
+  subject differed; such positions are what varies between the posts of a
+  release (part and file counters, file names).
+  """
+
+  def __init__(self, shape, tokens):
+    self.shape = shape
+    self.tokens = list(tokens)
+    self.count = 0
+    self.samples = []
+    self._suggested = (None, None)  # (count, template) when last suggested
+
+  def add(self, subject, tokens, samples=DEFAULT_SAMPLES):
+    self.count += 1
+    if len(self.samples) < samples:
+      self.samples.append(subject)
+    known = self.tokens
+    for idx, token in enumerate(tokens):
+      if known[idx] is not None and known[idx] != token:
+        known[idx] = None
+
+  def pattern(self):
+    """The cluster as a readable pattern, varying tokens shown as '*'."""
+    return ''.join('*' if token is None else token for token in self.tokens)
+
+  def _counters(self):
+    # (start, end) of every bracketed "n/m" or "n of m" counter.
+    shape = self.shape
+    found = []
+    for idx, token in enumerate(shape):
+      if token not in OPENERS:
+        continue
+      for middle in (['/'], [' ', 'of', ' ']):
+        end = idx + 3 + len(middle)
+        if (shape[idx + 1:end] == ('0',) + tuple(middle) + ('0',) and
+            end < len(shape) and shape[end] == OPENERS[token]):
+          found.append((idx, end + 1))
+          break
+    return found
+
+  def _file_name(self, before):
+    # A quoted string, or else the last bare word that looks like a file.
+    shape = self.shape
+    for idx, token in enumerate(shape[:before]):
+      if token == '""':
+        return idx, idx + 1, '"{file_name}"'
+    end = before
+    while end > 0:
+      while end > 0 and shape[end - 1] == ' ':
+        end -= 1
+      start = end
+      while start > 0 and shape[start - 1] != ' ':
+        start -= 1
+      word = shape[start:end]
+      if (len(word) >= 3 and word[-2] == '.' and word[-1].isalpha() and
+          word[0] not in OPENERS):
+        return start, end, '{file_name}'
+      end = start
+    return None
+
+  def suggest(self):
+    """Returns a regexp.txt template matching every sample, or None.
+
+    The last counter becomes {parts} and an earlier one {files}; a quoted
+    string or file-like word becomes {file_name}, and whatever literal text
+    leads up to the first of them {release}. Standalone dashes and pipes
+    become {seperator}; all else is kept literally, or as a digit run,
+    quoted string or spacing where the samples differ.
+    """
+    if self._suggested[0] != self.count:
+      self._suggested = (self.count, self._suggest())
+    return self._suggested[1]
+
+  def _suggest(self):
+    counters = self._counters()
+    if not counters:
+      return None
+    macros = {}
+    parts = counters[-1]
+    macros[parts[0]] = (parts[1], '%s{parts}%s' % (
+      _escape(self.shape[parts[0]]), _escape(self.shape[parts[1] - 1])))
+    if len(counters) > 1:
+      files = counters[0]
+      macros[files[0]] = (files[1], '%s{files}%s' % (
+        _escape(self.shape[files[0]]), _escape(self.shape[files[1] - 1])))
+    file_name = self._file_name(parts[0])
+    if file_name is None or any(
+        start <= file_name[0] < macros[start][0] for start in macros):
+      return None
+    macros[file_name[0]] = file_name[1:]
+
+    first = min(macros)
+    if any(token is None for token in self.tokens[:first]):
+      first = self.tokens.index(None)
+    release_end = first
+    while release_end > 0 and self.shape[release_end - 1] in (' ',) + SEPARATORS:
+      release_end -= 1
+    if any(token.isalnum() for token in self.tokens[:release_end]):
+      macros[0] = (release_end, '{release}')
+
+    out = []
+    idx = 0
+    shape = self.shape
+    while idx < len(shape):
+      if idx in macros:
+        idx, text = macros[idx]
+        out.append(text)
+        continue
+      token = self.tokens[idx]
+      if (shape[idx] in SEPARATORS and idx > 0 and shape[idx - 1] == ' ' and
+          ' ' in shape[idx + 1:idx + 3]):
+        # "-", "|" and "||" between spaces
+        out.append('{seperator}')
+        idx += 2 if shape[idx + 1:idx + 2] == ('|',) else 1
+        continue
+      out.append(VARYING.get(shape[idx], _escape(shape[idx]))
+                 if token is None else _escape(token))
+      idx += 1
+    template = ''.join(out)
+
+    try:
+      compiled = compile_template(template)
+    except re.error:
+      return None
+    for subject in self.samples:
+      match = compiled.match(subject)
+      if match is None or not match.groupdict().get('file_name'):
+        return None
+    return template
+
+  def release_name(self, template):
+    match = compile_template(template).match(self.samples[0])
+    return match.groupdict().get('release_name') if match else None
+
+  def as_dict(self):
+    template = self.suggest()
+    return {
+      'pattern': self.pattern(),
+      'count': self.count,
+      'samples': self.samples,
+      'template': template,
+      'release_name': self.release_name(template) if template else None,
+    }
+
+
+class SubjectClusters(object):
+  """Groups subjects into clusters of likely posts of the same release.
+
+  Each subject is tokenized once and filed under its shape, so a page or a
+  whole group is clustered in time linear in its subjects; only the
+  clusters, not the subjects, are kept. Once max_clusters shapes are known,
+  subjects of new shapes are only counted as unclustered.
+  """
+
+  def __init__(self, max_clusters=DEFAULT_MAX_CLUSTERS, samples=DEFAULT_SAMPLES):
+    self.max_clusters = max_clusters
+    self.samples = samples
+    self.clusters = {}
+    self.subjects = 0
+    self.unclustered = 0
+
+  def add(self, subject):
+    self.subjects += 1
+    tokens = tokenize(subject)
+    shape = tuple(_shape(token) for token in tokens)
+    cluster = self.clusters.get(shape)
+    if cluster is None:
+      if len(self.clusters) >= self.max_clusters:
+        self.unclustered += 1
+        return
+      cluster = self.clusters[shape] = Cluster(shape, tokens)
+    cluster.add(subject, tokens, self.samples)
+
+  def add_all(self, subjects):
+    for subject in subjects:
+      self.add(subject)
+    return self
+
+  def largest(self, limit=None, minimum=1):
+    clusters = sorted((cluster for cluster in self.clusters.itervalues()
+                       if cluster.count >= minimum),
+                      key=lambda cluster: -cluster.count)
+    return clusters[:limit] if limit else clusters
+
+  def releases(self, limit=None, minimum=1):
+    """Candidate releases: clusters with a template, by their release name."""
+    found = {}
+    for cluster in self.largest(minimum=minimum):
+      template = cluster.suggest()
+      name = cluster.release_name(template) if template else None
+      if name:
+        release = found.setdefault(name, {
+          'release_name': name, 'count': 0, 'patterns': []})
+        release['count'] += cluster.count
+        release['patterns'].append(cluster.pattern())
+    releases = sorted(found.itervalues(), key=lambda release: -release['count'])
+    return releases[:limit] if limit else releases
+
+  def suggestions(self, limit=None, minimum=1):
+    """Suggested regexp.txt templates, by the number of subjects they cover."""
+    found = {}
+    for cluster in self.largest(minimum=minimum):
+      template = cluster.suggest()
+      if template:
+        suggestion = found.setdefault(template, {
+          'template': template, 'clusters': 0, 'count': 0,
+          'example': cluster.samples[0]})
+        suggestion['clusters'] += 1
+        suggestion['count'] += cluster.count
+    suggestions = sorted(found.itervalues(), key=lambda row: -row['count'])
+    return suggestions[:limit] if limit else suggestions
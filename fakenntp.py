@@ -0,0 +1,435 @@
+#!/usr/bin/python2
+"""A local NNTP server with synthetic binary groups, for benchmarks.
+
+  python fakenntp.py [port] [articles per group] [latency ms] [bytes/s]
+
+Overview data is computed from article numbers, so any range of a group
+of any size is served the same way every time without storing it.
+Subjects follow the styles of regexp.txt, with a share of chatter no
+template matches; posters include encoded-words and Latin-1. Responses
+wait out a round trip of latency after their command arrived, so
+pipelined commands overlap as they would on a real link, and each
+connection's writes are held to bandwidth bytes per second. Overview can
+also be served compressed, as XZVER or after XFEATURE COMPRESS GZIP.
+"""
+
+import email.utils
+import fnmatch
+import logging
+import multiprocessing
+import Queue
+import re
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import zlib
+
+import clusters
+import metrics
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+DEFAULT_ARTICLES = 100000  # articles per synthetic group
+DEFAULT_GROUPS = ('alt.binaries.fake',)
+DEFAULT_FILES = 12  # files per release
+DEFAULT_PARTS = 40  # parts per file
+DEFAULT_NOISE = 0.05  # share of subjects no template matches
+DEFAULT_POSTERS = 200  # distinct posters per group
+DEFAULT_LATENCY = 0.0  # seconds of round trip before every response
+DEFAULT_BANDWIDTH = 0  # bytes per second per connection; 0 is unlimited
+DEFAULT_REGEXP_FILE = 'regexp.txt'
+BLOCK = 1000  # overview lines rendered and cached together
+MAX_BLOCKS = 1000  # blocks cached per group before the cache is dropped
+WRITE_CHUNK = 16 * 1024  # bytes written at a time under a bandwidth limit
+YENC_LINE = 128  # encoded bytes per line of an XZVER body
+EPOCH = 1381597200  # posting time of article 1, Sat, 12 Oct 2013 17:00 UTC
+POST_INTERVAL = 3  # seconds between consecutive articles
+
+SHOWS = ('Some.Show', 'Another.Series', 'The.Documentary', 'Late.Night.Talk',
+         'Old.Sitcom', 'Space.Drama', 'Cooking.Contest', 'Nature.Hour')
+QUALITIES = ('720p.HDTV.x264', '1080p.WEB-DL.DD5.1.H.264', 'HDTV.XviD',
+             '2160p.UHD.BluRay.x265', 'DVDRip.x264')
+TEAMS = ('FAKE', 'NOGRP', 'LOL', 'DIMENSION', 'KILLERS')
+CHATTER = ('Re: anyone have %s?', 'REQ: %s please', '%s - repost soon',
+           'FILL for %s', 'Looking for %s in good quality')
+POSTER_STYLES = (
+  'poster%d <poster%d@example.com>',
+  'Uploader %d <up%d@example.net>',
+  '=?UTF-8?B?SsO2cmc=?= %d <j%d@example.org>',
+  'J\xf6rg M\xfcller %d <jm%d@example.de>',
+  '=?ISO-8859-1?Q?Fran=E7ois?= %d <f%d@example.fr>',
+)
+# What each regexp.txt macro turns into when rendering a subject style.
+STYLE_FIELDS = {
+  'release': '%(release)s',
+  'comment': '%(comment)s',
+  'seperator': '-',
+  'files': '%(file)d/%(files)d',
+  'files_b': '[%(file)d/%(files)d]',
+  'parts': '%(part)d/%(parts)d',
+  'parts_p': '(%(part)d/%(parts)d)',
+  'parts_b': '[%(part)d/%(parts)d]',
+  'file_name': '%(file_name)s',
+  'file_name_parts': '%(file_name)s',
+  'size': '%(size)d bytes',
+}
+EXAMPLE = {
+  'release': 'Some.Show.S01E01.720p.HDTV.x264-FAKE', 'comment': 'repost',
+  'file': 3, 'files': 12, 'part': 7, 'parts': 40,
+  'file_name': 'some.show.s01e01.720p.hdtv.x264-fake.part03.rar',
+  'size': 396000,
+}
+
+
+def _style(template):
+  # Renders the macros, then undoes what regexp.txt escapes or repeats.
+  style = template.replace('%', '%%').format(**STYLE_FIELDS)
+  style = style.replace(r'\d+', '128').replace(' +', ' ')
+  return re.sub(r'\\(.)', r'\1', style)
+
+
+def subject_styles(regexp_file=DEFAULT_REGEXP_FILE):
+  """Subject formats, one per template of regexp_file.
+
+  A template is only used if the subject rendered from it is one its own
+  pattern matches; the rest need more regular expression than a format
+  can undo.
+  """
+  styles = []
+  for line in open(regexp_file, 'rb'):
+    template = line.strip()
+    if not template or template.startswith('#'):
+      continue
+    style = _style(template)
+    try:
+      compiled = clusters.compile_template(template)
+    except (KeyError, re.error):
+      continue
+    if compiled.match(style % EXAMPLE):
+      styles.append(style)
+    else:
+      LOG.debug('No subject style for %s', template)
+  return styles
+
+
+class SyntheticGroup(object):
+  """A binary group whose overview is a function of the article number.
+
+  Articles are posted release by release, each release being files files
+  of parts parts, in a style of styles picked per release. Roughly a
+  noise share of articles are chatter instead.
+  """
+
+  def __init__(self, name, articles=DEFAULT_ARTICLES, styles=None, first=1,
+               files=DEFAULT_FILES, parts=DEFAULT_PARTS, noise=DEFAULT_NOISE,
+               posters=DEFAULT_POSTERS):
+    self.name = name
+    self.first = first
+    self.last = first + articles - 1
+    self.styles = styles or subject_styles()
+    self.files = files
+    self.parts = parts
+    self.noise = int(noise * 1000)
+    self.posters = posters
+    self._releases = {}
+    self._blocks = {}
+    self._lock = threading.Lock()
+
+  def release(self, index):
+    """(name, subject style) of the index-th release of the group."""
+    found = self._releases.get(index)
+    if found is None:
+      name = '%s.S%02dE%02d.%s-%s' % (
+        SHOWS[index % len(SHOWS)], index / 100 % 30 + 1, index % 100 + 1,
+        QUALITIES[index / 7 % len(QUALITIES)], TEAMS[index / 3 % len(TEAMS)])
+      found = self._releases[index] = (
+        name, self.styles[index * 7 % len(self.styles)])
+    return found
+
+  def subject(self, number):
+    offset = number - self.first
+    index, position = divmod(offset, self.files * self.parts)
+    release, style = self.release(index)
+    if number * 2654435761 % 1000 < self.noise:
+      return CHATTER[number % len(CHATTER)] % release
+    file_number, part = divmod(position, self.parts)
+    return style % {
+      'release': release,
+      'comment': 'www.example.com',
+      'file': file_number + 1,
+      'files': self.files,
+      'part': part + 1,
+      'parts': self.parts,
+      'file_name': '%s.part%02d.rar' % (release.lower(), file_number + 1),
+      'size': 396000 * self.parts,
+    }
+
+  def poster(self, number):
+    index = number * 40503 % self.posters
+    return POSTER_STYLES[index % len(POSTER_STYLES)] % (index, index)
+
+  def line(self, number):
+    size = 396000 + number * 7919 % 4000
+    return '\t'.join([
+      str(number),
+      self.subject(number),
+      self.poster(number),
+      email.utils.formatdate(EPOCH + number * POST_INTERVAL),
+      '<part%d.%d.%s@fakenntp>' % (number % self.parts + 1, number, self.name),
+      '',
+      str(size),
+      str(size / 130),
+      'Xref: fakenntp %s:%d' % (self.name, number),
+    ])
+
+  def _block(self, index):
+    with self._lock:
+      block = self._blocks.get(index)
+    if block is None:
+      low = max(self.first, index * BLOCK)
+      high = min(self.last, index * BLOCK + BLOCK - 1)
+      block = [self.line(number) for number in xrange(low, high + 1)]
+      with self._lock:
+        if len(self._blocks) >= MAX_BLOCKS:
+          self._blocks.clear()
+        self._blocks[index] = block
+    return block
+
+  def prime(self):
+    """Renders the whole group ahead of time, if the cache can hold it."""
+    if (self.last - self.first) / BLOCK < MAX_BLOCKS:
+      for index in xrange(self.first / BLOCK, self.last / BLOCK + 1):
+        self._block(index)
+
+  def overview(self, low, high):
+    """The dot-stuffed overview lines of [low, high], CRLF terminated."""
+    low, high = max(low, self.first), min(high, self.last)
+    lines = []
+    for index in xrange(low / BLOCK, high / BLOCK + 1):
+      base = max(self.first, index * BLOCK)  # number of the block's first line
+      lines.extend(self._block(index)[max(low, base) - base:high - base + 1])
+    text = '\r\n'.join(lines)
+    if text[:1] == '.' or '\n.' in text:
+      text = '\r\n'.join('.' + line if line[:1] == '.' else line
+                         for line in lines)
+    return text + '\r\n' if text else ''
+
+
+def yenc_encode(data, line_length=YENC_LINE):
+  """Returns data as yEnc encoded lines, dot stuffed for an NNTP body."""
+  lines = []
+  line = []
+  width = 0
+  for char in data:
+    code = (ord(char) + 42) % 256
+    if code in (0, 10, 13, 61):
+      line.append('=' + chr((code + 64) % 256))
+      width += 2
+    else:
+      line.append(chr(code))
+      width += 1
+    if width >= line_length:
+      lines.append(''.join(line))
+      line, width = [], 0
+  if line:
+    lines.append(''.join(line))
+  return ['.' + line if line[:1] == '.' else line for line in lines]
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+  # Commands are read and timestamped on a thread of their own, so one
+  # waiting out its round trip does not delay the arrival of the next.
+
+  def _read_commands(self, commands):
+    while True:
+      try:
+        line = self.rfile.readline()
+      except (socket.error, ValueError, AttributeError):  # closed when done
+        line = ''
+      commands.put((time.time(), line))
+      if not line:
+        return
+
+  def _send(self, data, arrived):
+    server = self.server
+    delay = arrived + server.latency - time.time()
+    if delay > 0:
+      time.sleep(delay)
+    if not server.bandwidth:
+      self.wfile.write(data)
+      return
+    for offset in xrange(0, len(data), WRITE_CHUNK):
+      chunk = data[offset:offset + WRITE_CHUNK]
+      self.wfile.write(chunk)
+      self._sent_until = (max(self._sent_until, time.time()) +
+                          float(len(chunk)) / server.bandwidth)
+      delay = self._sent_until - time.time()
+      if delay > 0:
+        time.sleep(delay)
+
+  def handle(self):
+    server = self.server
+    self._sent_until = 0.0
+    self.group = None
+    self.gzip = False
+    commands = Queue.Queue()
+    reader = threading.Thread(target=self._read_commands, args=(commands,))
+    reader.daemon = True
+    reader.start()
+    self._send('200 fakenntp ready\r\n', time.time())
+    while True:
+      arrived, line = commands.get()
+      words = line.split()
+      if not words:
+        return
+      response = self.respond(words[0].upper(), words[1:])
+      self._send(response, arrived)
+      if words[0].upper() == 'QUIT':
+        return
+
+  def respond(self, command, args):
+    groups = self.server.groups
+    if command == 'MODE':
+      return '200 reader mode\r\n'
+    if command == 'AUTHINFO':
+      if args and args[0].upper() == 'USER':
+        return '381 password please\r\n'
+      return '281 welcome\r\n'
+    if command == 'CAPABILITIES':
+      caps = ['VERSION 2', 'READER', 'OVER']
+      if self.server.xzver:
+        caps.append('XZVER')
+      if self.server.gzip:
+        caps.append('XFEATURE-COMPRESS GZIP TERMINATOR')
+      return '101 capabilities\r\n%s\r\n.\r\n' % '\r\n'.join(caps)
+    if command == 'XFEATURE' and self.server.gzip:
+      self.gzip = True
+      return '290 compression on\r\n'
+    if command == 'DATE':
+      return '111 %s\r\n' % time.strftime('%Y%m%d%H%M%S', time.gmtime())
+    if command == 'GROUP':
+      group = groups.get(args[0] if args else None)
+      if group is None:
+        return '411 no such group\r\n'
+      self.group = group
+      return '211 %d %d %d %s\r\n' % (
+        group.last - group.first + 1, group.first, group.last, group.name)
+    if command in ('XOVER', 'OVER') or (command == 'XZVER' and
+                                        self.server.xzver):
+      if self.group is None:
+        return '412 no group selected\r\n'
+      low, _, high = (args[0] if args else '').partition('-')
+      try:
+        low, high = int(low), int(high or low)
+      except ValueError:
+        return '501 bad range\r\n'
+      body = self.group.overview(low, high)
+      if not body:
+        return '423 no articles in that range\r\n'
+      if command == 'XZVER':
+        lines = yenc_encode(zlib.compress(body + '.\r\n'))
+        return '224 compressed overview\r\n%s\r\n.\r\n' % '\r\n'.join(
+          ['=ybegin line=%d' % YENC_LINE] + lines + ['=yend'])
+      if self.gzip:
+        return '224 overview [COMPRESS=GZIP]\r\n' + zlib.compress(
+          body + '.\r\n')
+      return '224 overview\r\n' + body + '.\r\n'
+    if command == 'LIST' and (not args or args[0].upper() == 'ACTIVE'):
+      patterns = args[1].split(',') if len(args) > 1 else ['*']
+      lines = ['%s %d %d y' % (group.name, group.last, group.first)
+               for name, group in sorted(groups.iteritems())
+               if any(fnmatch.fnmatchcase(name, pattern)
+                      for pattern in patterns)]
+      return '215 list follows\r\n%s.\r\n' % ''.join(
+        line + '\r\n' for line in lines)
+    if command == 'NEWGROUPS':
+      return '231 no new groups\r\n.\r\n'
+    if command == 'QUIT':
+      return '205 bye\r\n'
+    return '500 unknown command\r\n'
+
+
+class FakeNNTPServer(SocketServer.ThreadingTCPServer):
+  """Serves SyntheticGroups, one thread per connection."""
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, address, groups, latency=DEFAULT_LATENCY,
+               bandwidth=DEFAULT_BANDWIDTH, gzip=False, xzver=False):
+    SocketServer.ThreadingTCPServer.__init__(self, address, _Handler)
+    self.groups = dict((group.name, group) for group in groups)
+    self.latency = latency
+    self.bandwidth = bandwidth
+    self.gzip = gzip
+    self.xzver = xzver
+
+  def handle_error(self, request, client_address):
+    # Clients hanging up mid-response, e.g. closing a pipelined XOVER
+    # early, are expected; anything else is still printed.
+    if isinstance(sys.exc_info()[1], socket.error):
+      LOG.debug('%s hung up: %s', client_address, sys.exc_info()[1])
+    else:
+      SocketServer.ThreadingTCPServer.handle_error(
+        self, request, client_address)
+
+
+def make_groups(names=DEFAULT_GROUPS, articles=DEFAULT_ARTICLES,
+                regexp_file=DEFAULT_REGEXP_FILE, **kwargs):
+  styles = subject_styles(regexp_file)
+  return [SyntheticGroup(name, articles, styles, **kwargs) for name in names]
+
+
+def serve(port=0, host='127.0.0.1', prime=False, **kwargs):
+  """Starts a FakeNNTPServer on a daemon thread and returns it.
+
+  latency, bandwidth, gzip and xzver are the server's, other kwargs go to
+  make_groups. prime renders the groups before anyone connects, so the
+  first fetch is not slowed down by it.
+  """
+  options = dict((name, kwargs.pop(name)) for name in
+                 ('latency', 'bandwidth', 'gzip', 'xzver') if name in kwargs)
+  server = FakeNNTPServer((host, port), make_groups(**kwargs), **options)
+  if prime:
+    for group in server.groups.itervalues():
+      group.prime()
+  thread = threading.Thread(target=server.serve_forever, name='FakeNNTP')
+  thread.daemon = True
+  thread.start()
+  return server
+
+
+def _serve_child(pipe, kwargs):
+  server = serve(**kwargs)
+  pipe.send(server.server_address[1])
+  while True:
+    time.sleep(3600)
+
+
+def serve_in_process(**kwargs):
+  """Like serve(), from a child process so it does not share the GIL with
+  whatever is being measured. Returns (port, process)."""
+  parent, child = multiprocessing.Pipe()
+  process = multiprocessing.Process(target=_serve_child, args=(child, kwargs))
+  process.daemon = True
+  process.start()
+  return parent.recv(), process
+
+
+if __name__ == '__main__':
+  metrics.configure_logging()
+  args = sys.argv[1:] + [None] * 4
+  server = serve(
+    int(args[0] or 1119), '',
+    articles=int(args[1] or DEFAULT_ARTICLES),
+    latency=float(args[2] or 0) / 1000,
+    bandwidth=int(args[3] or DEFAULT_BANDWIDTH))
+  LOG.info('Serving %s on port %d', ', '.join(sorted(server.groups)),
+           server.server_address[1])
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    pass
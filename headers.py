@@ -0,0 +1,219 @@
+#!/usr/bin/python
+"""Parsing and decoding of the header fields overview lines carry."""
+
+import base64
+import binascii
+import calendar
+import collections
+import logging
+import quopri
+import re
+import threading
+
+from dateutil import parser
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+DEFAULT_DATE_MEMO = 65536  # distinct Date headers remembered before a reset
+DEFAULT_POSTER_CACHE = 20000  # decoded posters kept, least recently used go
+
+# RFC 5322 date-time, the obsolete two digit years and named zones
+# included: [Day,] DD Mon YYYY HH:MM[:SS] [zone] [(comment)]
+DATE = re.compile(
+  r'\s*(?:[A-Za-z]{3},\s*)?(\d{1,2})\s+([A-Za-z]{3})\s+(\d{2}|\d{4})\s+'
+  r'(\d{1,2}):(\d{2})(?::(\d{2}))?\s*(?:([+-])(\d{2})(\d{2})|([A-Za-z]{1,5}))?'
+  r'\s*(?:\([^)]*\))?\s*$')
+# RFC 2047 encoded-word: =?charset?encoding?text?=
+ENCODED_WORD = re.compile(r'=\?([^?\s]+)\?([BbQq])\?([^?\s]*)\?=')
+MONTHS = dict((name, number) for number, name in enumerate(
+  ('jan', 'feb', 'mar', 'apr', 'may', 'jun',
+   'jul', 'aug', 'sep', 'oct', 'nov', 'dec'), start=1))
+ZONES = {  # hours east of UTC
+  'ut': 0, 'utc': 0, 'gmt': 0, 'z': 0,
+  'est': -5, 'edt': -4, 'cst': -6, 'cdt': -5,
+  'mst': -7, 'mdt': -6, 'pst': -8, 'pdt': -7,
+  'cet': 1, 'cest': 2, 'bst': 1,
+}
+
+_months = {}  # (year, month) -> (epoch of its first second, days)
+_dates = {}
+
+
+def _month(year, month):
+  found = _months.get((year, month))
+  if found is None:
+    found = _months[(year, month)] = (
+      calendar.timegm((year, month, 1, 0, 0, 0)),
+      calendar.monthrange(year, month)[1])
+  return found
+
+
+def _fast_date(value):
+  # The epoch of an RFC 5322 date, or None for anything else.
+  match = DATE.match(value)
+  if match is None:
+    return None
+  (day, month, year, hour, minute, second, sign, zone_hours, zone_minutes,
+   zone) = match.groups()
+  month = MONTHS.get(month.lower())
+  day, year, hour, minute = int(day), int(year), int(hour), int(minute)
+  second = int(second) if second else 0
+  if month is None or hour > 23 or minute > 59 or second > 60:
+    return None
+  if year < 100:
+    year += 2000 if year < 50 else 1900
+  start, days = _month(year, month)
+  if not 1 <= day <= days:
+    return None
+  if sign:
+    offset = (int(zone_hours) * 60 + int(zone_minutes)) * 60
+    if sign == '-':
+      offset = -offset
+  elif zone:
+    if zone.lower() not in ZONES:
+      return None
+    offset = ZONES[zone.lower()] * 3600
+  else:
+    offset = 0
+  return (start + (day - 1) * 86400 + hour * 3600 + minute * 60 + second -
+          offset)
+
+
+def _slow_date(value):
+  # dateutil takes what the pattern does not; a date without a zone is UTC.
+  # A Date it cannot read either is the epoch, as a subject that cannot be
+  # decoded is still stored: one bad header must not lose its whole batch.
+  try:
+    posted = parser.parse(value)
+    if posted.tzinfo is None:
+      return calendar.timegm(posted.timetuple())
+    return calendar.timegm(posted.utctimetuple())
+  except (ValueError, OverflowError, TypeError):
+    return 0
+
+
+def parse_date(value):
+  """Returns a Date header as seconds since the epoch, UTC.
+
+  Articles of one batch tend to share their Date to the second, so
+  results are memoized, up to DEFAULT_DATE_MEMO distinct headers. The
+  common RFC 5322 form is parsed by a single pattern; dateutil is only
+  asked about the rest. A Date neither can make sense of gives 0; this
+  never raises.
+  """
+  epoch = _dates.get(value)
+  if epoch is None:
+    epoch = _fast_date(value)
+    if epoch is None:
+      epoch = _slow_date(value)
+    if len(_dates) >= DEFAULT_DATE_MEMO:
+      _dates.clear()
+    _dates[value] = epoch
+  return epoch
+
+
+class LRU(object):
+  """A bounded mapping that forgets its least recently used entries."""
+
+  def __init__(self, max_entries):
+    self.max_entries = max_entries
+    self.entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      value = self.entries.pop(key, None)
+      if value is None:
+        self.misses += 1
+        return None
+      self.entries[key] = value  # most recently used goes last
+      self.hits += 1
+      return value
+
+  def put(self, key, value):
+    with self._lock:
+      self.entries.pop(key, None)
+      self.entries[key] = value
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+
+POSTERS = LRU(DEFAULT_POSTER_CACHE)
+
+
+def _decode_bytes(raw, charset=None):
+  # Never raises: a declared charset, else UTF-8, which ASCII is as well,
+  # else Latin-1, which takes any byte.
+  if charset:
+    try:
+      return unicode(raw, charset)
+    except (LookupError, UnicodeDecodeError):
+      pass
+  try:
+    return unicode(raw, 'utf-8')
+  except UnicodeDecodeError:
+    return unicode(raw, 'latin-1')
+
+
+def _decode_word(match):
+  charset, encoding, text = match.groups()
+  charset = charset.split('*', 1)[0]  # RFC 2231 language suffix
+  try:
+    if encoding in 'Bb':
+      raw = base64.b64decode(text + '=' * (-len(text) % 4))
+    else:
+      raw = quopri.decodestring(text, header=True)
+  except (TypeError, binascii.Error):
+    return match.group(0)
+  return _decode_bytes(raw, charset)
+
+
+def decode_header(raw):
+  """Returns a header field as unicode.
+
+  RFC 2047 encoded-words are decoded, with the space between two of them
+  dropped. Other text is read as UTF-8, which covers plain ASCII in the
+  same single decode; only text that is not valid UTF-8 costs a failed
+  decode, and is read as Latin-1. Nothing is logged either way.
+  """
+  if not isinstance(raw, str):
+    return raw
+  if '=?' in raw:
+    out = []
+    end = 0
+    for match in ENCODED_WORD.finditer(raw):
+      gap = raw[end:match.start()]
+      if not (end and gap.isspace()):
+        out.append(_decode_bytes(gap))
+      out.append(_decode_word(match))
+      end = match.end()
+    out.append(_decode_bytes(raw[end:]))
+    return u''.join(out)
+  try:  # _decode_bytes, inlined for the common case
+    return unicode(raw, 'utf-8')
+  except UnicodeDecodeError:
+    return unicode(raw, 'latin-1')
+
+
+def decode_subject(raw):
+  """decode_header; subjects seldom repeat exactly, so are not cached."""
+  return decode_header(raw)
+
+
+def decode_poster(raw):
+  """decode_header, with encoded-words decoded once per poster.
+
+  The same posters post again and again, so their encoded-words are
+  looked up in an LRU. Plain posters are not: decoding them costs less
+  than the lookup.
+  """
+  if not isinstance(raw, str) or '=?' not in raw:
+    return decode_header(raw)
+  poster = POSTERS.get(raw)
+  if poster is None:
+    poster = decode_header(raw)
+    POSTERS.put(raw, poster)
+  return poster
@@ -0,0 +1,328 @@
+#!/usr/bin/python
+
+import collections
+import itertools
+import logging
+import multiprocessing
+import re
+import signal
+import time
+
+import metrics
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+
+MatcherMacros = {
+  'size': r'(?:\d+(?:[.]\d+)? MBytes|\d+ [Bb]ytes)',
+  'comment': r'(?P<comment>.+?)',
+  'release': r'(?P<release_name>.+?)',
+  'seperator': r'(?:-|\||\|\|)',
+  'parts_p': r'\((?P<part_number>\d+)(?:\/| ?of ?)(?P<part_total>\d+)\)',
+  'parts_b': r'\[(?P<part_number>\d+)(?:\/| ?of ?)(?P<part_total>\d+)\]',
+  'files_b': r'\[(?P<file_number>\d+)(?:\/| ?of ?)(?P<file_total>\d+)\]',
+  'files': r'(?P<file_number>\d+)(?:\/| ?of ?)(?P<file_total>\d+)',
+  'parts': r'(?P<part_number>\d+)(?:\/| ?of ?)(?P<part_total>\d+)',
+  'file_name_parts': r'(?P<file_name>.+\.part(?P<file_number>\d+)\.rar)',
+  'file_name': r'(?P<file_name>[^"]+)',
+}
+Matcher = collections.namedtuple('Matcher', ['pattern', 'description'])
+
+# Literal anchors used to prefilter patterns: a subject lacking one of a
+# pattern's required anchors cannot match it.
+ANCHORS = (
+  ('yenc', 1),
+  ('.part', 2),
+  ('"', 4),
+  ('[', 8),
+  ('(', 16),
+)
+DEFAULT_PARSE_CHUNK = 500  # subjects sent to a parser process at a time
+MAX_SHAPES = 100000  # subject shapes remembered before the memo is reset
+DIGITS = re.compile(r'\d+')
+QUANTIFIERS = '?*{'
+RUNS = '+*'  # quantifiers that let an atom take a whole digit run
+
+
+def _anchor_mask(text):
+  text = text.lower()
+  mask = 0
+  for anchor, bit in ANCHORS:
+    if anchor in text:
+      mask |= bit
+  return mask
+
+
+def _digits_matched(atom):
+  """How many of the ten digits a single character atom can match."""
+  try:
+    compiled = re.compile(atom)
+  except re.error:  # e.g. a backreference; assume the worst
+    return 1
+  return sum(1 for digit in '0123456789' if compiled.match(digit))
+
+
+def required_anchors(pattern):
+  """Returns (anchor mask, digit sensitive) for a regular expression.
+
+  Only literals that every match must contain count: anything inside an
+  alternation or an optional group/character is ignored. A pattern is digit
+  sensitive if whether it matches can depend on more than where the digit
+  runs of a subject are: it has literal digits, counted repeats, or an atom
+  (\\d, ., a character class, ...) that matches only some digits or is not
+  repeated with + or *.
+  """
+  frames = [[0, False]]  # [anchor mask, alternation seen] per open group
+  literal = []
+  digit_sensitive = False
+  pos = 0
+
+  def flush():
+    if literal:
+      frames[-1][0] |= _anchor_mask(''.join(literal))
+      del literal[:]
+
+  def sensitive(atom, following):
+    digits = _digits_matched(atom)
+    return digits > 0 and (digits < 10 or not following or
+                           following not in RUNS)
+
+  while pos < len(pattern):
+    char = pattern[pos]
+    following = pattern[pos + 2:pos + 3] if char == '\\' else pattern[pos + 1:pos + 2]
+    optional = following != '' and following in QUANTIFIERS
+    if char == '\\':
+      escaped = pattern[pos + 1:pos + 2]
+      if escaped.isalnum():  # \d, \s, \b, ... are classes, not literals
+        flush()
+        digit_sensitive = digit_sensitive or sensitive(char + escaped,
+                                                       following)
+      elif optional:
+        flush()
+      else:
+        literal.append(escaped)
+      pos += 2
+      continue
+    if char == '[':
+      flush()
+      end = pos + 1
+      while end < len(pattern) and (pattern[end] != ']' or end == pos + 1):
+        end += 2 if pattern[end] == '\\' else 1
+      following = pattern[end + 1:end + 2]
+      digit_sensitive = digit_sensitive or sensitive(pattern[pos:end + 1],
+                                                     following)
+      pos = end + 1
+      continue
+    if char == '(':
+      flush()
+      frames.append([0, False])
+      if pattern[pos + 1:pos + 2] == '?':
+        pos += 2
+        if pattern[pos:pos + 1] == 'P':
+          pos = pattern.index('>', pos) + 1
+        elif pattern[pos:pos + 1] == ':':
+          pos += 1
+        else:  # lookarounds and flags never contribute required text
+          frames[-1][1] = True
+        continue
+    elif char == ')':
+      flush()
+      mask, alternation = frames.pop()
+      if not (alternation or optional):
+        frames[-1][0] |= mask
+    elif char == '|':
+      flush()
+      frames[-1][1] = True
+    elif char == '.':
+      flush()
+      digit_sensitive = digit_sensitive or sensitive(char, following)
+    elif char in '^$+*?{}':
+      flush()
+      digit_sensitive = digit_sensitive or char == '{'
+    elif optional:
+      flush()
+    else:
+      literal.append(char)
+      digit_sensitive = digit_sensitive or char.isdigit()
+    pos += 1
+  flush()
+  mask, alternation = frames[0]
+  return (0 if alternation else mask), digit_sensitive
+
+
+class MatcherStats(object):
+  __slots__ = ('attempts', 'hits', 'seconds')
+
+  def __init__(self):
+    self.attempts = 0
+    self.hits = 0
+    self.seconds = 0.0
+
+
+class MatcherEngine(object):
+  """Matches subjects against the templates of a regexp file.
+
+  The result is the same as trying every pattern in order and taking the
+  first match, but patterns whose literal anchors are missing from the
+  subject are never tried, and the winning pattern is remembered per
+  subject shape (the subject with its digit runs collapsed) so posts of the
+  same file go straight to it.
+  """
+
+  def __init__(self):
+    self.matchers = []
+    self.stats = []
+    self._anchors = []
+    self._by_mask = {}
+    self._by_shape = {}
+    self._shapes_safe = True
+    self.shape_hits = 0
+    self.shape_misses = 0
+
+  def load(self, iterable):
+    for idx, line in enumerate(iterable):
+      if line.strip() and not line.startswith('#'):
+        pattern = line.strip().format(**MatcherMacros)
+        LOG.info((idx, pattern))
+        matcher = Matcher(re.compile('^' + pattern + '$', re.I), str(idx+1))
+        if matcher not in self.matchers:
+          anchors, digit_sensitive = required_anchors(pattern)
+          self.matchers.append(matcher)
+          self.stats.append(MatcherStats())
+          self._anchors.append(anchors)
+          # Such a template can tell apart subjects that collapse to the
+          # same shape, so remembering results per shape would be unsafe.
+          self._shapes_safe = self._shapes_safe and not digit_sensitive
+    self._by_mask.clear()
+    self._by_shape.clear()
+
+  def _candidates(self, mask):
+    candidates = self._by_mask.get(mask)
+    if candidates is None:
+      candidates = self._by_mask[mask] = [
+        idx for idx, anchors in enumerate(self._anchors)
+        if anchors & mask == anchors]
+    return candidates
+
+  def _try(self, idx, subject):
+    stats = self.stats[idx]
+    started = time.time()
+    match = self.matchers[idx].pattern.match(subject)
+    stats.seconds += time.time() - started
+    stats.attempts += 1
+    if match:
+      stats.hits += 1
+    return match
+
+  def match(self, subject):
+    """Returns the groupdict of the first matching template, or None."""
+    shape = DIGITS.sub('0', subject) if self._shapes_safe else None
+    if shape is not None and shape in self._by_shape:
+      self.shape_hits += 1
+      idx = self._by_shape[shape]
+      if idx is None:
+        return None
+      match = self._try(idx, subject)
+      if match:
+        return match.groupdict()
+    self.shape_misses += 1
+
+    found = None
+    for idx in self._candidates(_anchor_mask(subject)):
+      match = self._try(idx, subject)
+      if match:
+        found = idx
+        break
+    if shape is not None:
+      if len(self._by_shape) >= MAX_SHAPES:
+        self._by_shape.clear()
+      self._by_shape[shape] = found
+    return match.groupdict() if found is not None else None
+
+  def report(self):
+    """Per-template attempts, hits and time spent, busiest first."""
+    rows = [{
+      'description': matcher.description,
+      'pattern': matcher.pattern.pattern,
+      'attempts': stats.attempts,
+      'hits': stats.hits,
+      'seconds': round(stats.seconds, 4),
+    } for matcher, stats in zip(self.matchers, self.stats)]
+    return sorted(rows, key=lambda row: (-row['hits'], row['seconds']))
+
+
+ENGINE = MatcherEngine()
+Matchers = ENGINE.matchers
+
+
+def LoadMatchers(iterable):
+  ENGINE.load(iterable)
+
+
+def MatchSubject(subject):
+  """Returns the segment data of the first matcher fitting subject, or None."""
+  return ENGINE.match(subject)
+
+
+def MatchSubjects(subjects):
+  """Matches a batch of subjects; the unit of work for parser processes."""
+  return [ENGINE.match(subject) for subject in subjects]
+
+
+def _init_parse_worker(regexp_file):
+  # Ctrl-C is handled by the parent, which closes the pool.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  LoadMatchers(open(regexp_file, 'rb'))
+
+
+class _Ready(object):
+  def __init__(self, value):
+    self.value = value
+
+  def get(self):
+    return self.value
+
+
+class _Chunked(object):
+  def __init__(self, result):
+    self.result = result
+
+  def get(self):
+    return list(itertools.chain.from_iterable(self.result.get()))
+
+
+class SubjectParser(object):
+  """Matches subjects against regexp.txt in a pool of worker processes.
+
+  Each worker loads the matchers once; subjects are sent over in chunks and
+  segment data (or None) comes back in the same order. processes=0 matches
+  in the calling thread instead.
+  """
+
+  def __init__(self, regexp_file, processes=None, chunk_size=DEFAULT_PARSE_CHUNK):
+    self.chunk_size = chunk_size
+    self.pool = None
+    if processes != 0:
+      self.pool = multiprocessing.Pool(
+        processes, _init_parse_worker, (regexp_file,))
+
+  def match_async(self, subjects):
+    """Returns an object whose get() gives the segment data of subjects."""
+    if self.pool is None:
+      return _Ready(MatchSubjects(subjects))
+    chunks = [subjects[offset:offset + self.chunk_size]
+              for offset in xrange(0, len(subjects), self.chunk_size)]
+    return _Chunked(self.pool.map_async(MatchSubjects, chunks))
+
+  def match(self, subjects):
+    results = self.match_async(subjects).get()
+    if metrics.ENABLED:
+      metrics.MATCHED_SUBJECTS.inc(len(results))
+      metrics.MATCHER_HITS.inc(len(results) - results.count(None))
+    return results
+
+  def close(self):
+    if self.pool is not None:
+      self.pool.close()
+      self.pool.join()
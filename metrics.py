@@ -0,0 +1,249 @@
+#!/usr/bin/python
+"""Counters, histograms and gauges of the sync pipeline.
+
+Nothing is recorded until enable() is called; until then inc() and
+observe() return after one global lookup, and they are only ever called
+once per span or batch, never per article. Gauges are read when the
+metrics are, so queue depths cost nothing in between. render() gives the
+Prometheus text format serve() exports; summary() gives the line run.py
+logs with its progress reports. The metrics live in the process that
+syncs, so Prometheus scrapes run.py's metrics_port, not the API server.
+"""
+
+import bisect
+import logging
+import threading
+import time
+from wsgiref import simple_server
+
+LOG_FORMAT = "%(levelname)s (%(threadName)s) %(filename)s:%(lineno)d %(message)s"
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# Upper bounds, in seconds, of the latency histograms' buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+ENABLED = False
+REGISTRY = []  # every metric, in the order they are rendered
+_summarized = ({}, time.time())  # counter totals at the last summary()
+
+
+def configure_logging():
+  """Sets up the root logger; called once by each entry point."""
+  logging.basicConfig(format=LOG_FORMAT)
+
+
+def enable():
+  global ENABLED
+  ENABLED = True
+
+
+def _escape(value):
+  return (str(value).replace('\\', r'\\').replace('"', r'\"')
+          .replace('\n', r'\n'))
+
+
+def _number(value):
+  if isinstance(value, float):
+    if value == float('inf'):
+      return '+Inf'
+    return repr(value)
+  return str(value)
+
+
+class _Metric(object):
+  kind = None
+
+  def __init__(self, name, description, labels=()):
+    self.name = name
+    self.description = description
+    self.labels = labels
+    self.values = {}  # label values -> whatever the kind keeps
+    self._lock = threading.Lock()
+    REGISTRY.append(self)
+
+  def label_text(self, values, extra=()):
+    pairs = zip(self.labels, values) + list(extra)
+    if not pairs:
+      return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in pairs)
+
+  def samples(self):
+    """Yields (suffix, label values, extra labels, value) to render.
+
+    By default one sample per combination of label values, of the number
+    kept for it.
+    """
+    with self._lock:
+      values = sorted(self.values.iteritems())
+    for labels, value in values:
+      yield '', labels, (), value
+
+
+class Counter(_Metric):
+  """A total that only goes up, per combination of label values."""
+  kind = 'counter'
+
+  def inc(self, amount=1, labels=()):
+    if not ENABLED:
+      return
+    with self._lock:
+      self.values[labels] = self.values.get(labels, 0) + amount
+
+  def total(self):
+    with self._lock:
+      return sum(self.values.itervalues())
+
+
+class Histogram(_Metric):
+  """Observations counted into buckets, with their count and sum."""
+  kind = 'histogram'
+
+  def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+    super(Histogram, self).__init__(name, description, labels)
+    self.buckets = tuple(buckets)
+
+  def observe(self, value, labels=()):
+    if not ENABLED:
+      return
+    with self._lock:
+      counts = self.values.get(labels)
+      if counts is None:
+        # A count per bucket, one for +Inf, then the sum of the values.
+        counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+      counts[bisect.bisect_left(self.buckets, value)] += 1
+      counts[-1] += value
+
+  def merged(self):
+    """Returns (bucket counts, sum) over every combination of labels."""
+    with self._lock:
+      rows = self.values.values()
+    counts = [sum(column) for column in zip(*rows)] if rows else None
+    if counts is None:
+      return [0] * (len(self.buckets) + 1), 0.0
+    return counts[:-1], counts[-1]
+
+  def quantile(self, q):
+    """The upper bound of the bucket holding the q-th observation."""
+    counts, _ = self.merged()
+    wanted = q * sum(counts)
+    seen = 0
+    for bound, count in zip(self.buckets + (float('inf'),), counts):
+      seen += count
+      if count and seen >= wanted:
+        return bound
+    return 0.0
+
+  def samples(self):
+    with self._lock:
+      values = sorted((labels, list(counts))
+                      for labels, counts in self.values.iteritems())
+    bounds = [_number(bound) for bound in self.buckets + (float('inf'),)]
+    for labels, counts in values:
+      seen = 0
+      for bound, count in zip(bounds, counts):
+        seen += count
+        yield '_bucket', labels, (('le', bound),), seen
+      yield '_sum', labels, (), counts[-1]
+      yield '_count', labels, (), seen
+
+
+class Gauge(_Metric):
+  """Values read from callables whenever the metrics are collected."""
+  kind = 'gauge'
+
+  def track(self, read, labels=()):
+    with self._lock:
+      self.values[labels] = read
+
+  def forget(self, labels=()):
+    with self._lock:
+      self.values.pop(labels, None)
+
+  def samples(self):
+    with self._lock:
+      reads = sorted(self.values.iteritems())
+    for labels, read in reads:
+      yield '', labels, (), read()
+
+
+XOVER_SECONDS = Histogram(
+  'nntp_xover_seconds',
+  'Time spent reading XOVER spans off the wire, per span.', ('server',))
+OVERVIEW_BYTES = Counter(
+  'nntp_overview_bytes_total',
+  'Overview bytes received, compressed as they were sent.', ('server',))
+MATCHED_SUBJECTS = Counter(
+  'matcher_subjects_total', 'Subjects parsed by the matchers.')
+MATCHER_HITS = Counter(
+  'matcher_hits_total', 'Subjects a regexp.txt template matched.')
+COMMIT_SECONDS = Histogram(
+  'store_commit_seconds', 'Time SQLite took to commit a transaction.')
+QUEUE_DEPTH = Gauge(
+  'pipeline_queue_depth', 'Items waiting between pipeline stages.', ('queue',))
+
+
+def render():
+  """Every metric, in the Prometheus text exposition format."""
+  out = []
+  for metric in REGISTRY:
+    out.append('# HELP %s %s' % (metric.name, metric.description))
+    out.append('# TYPE %s %s' % (metric.name, metric.kind))
+    for suffix, labels, extra, value in metric.samples():
+      out.append('%s%s%s %s' % (metric.name, suffix,
+                                metric.label_text(labels, extra),
+                                _number(value)))
+  return '\n'.join(out) + '\n'
+
+
+def summary():
+  """One line of what was recorded, counters with their rate since the last."""
+  global _summarized
+  last, when = _summarized
+  now = time.time()
+  elapsed = max(now - when, 0.001)
+  totals = {}
+  parts = []
+  for metric in REGISTRY:
+    if isinstance(metric, Counter):
+      total = totals[metric.name] = metric.total()
+      parts.append('%s %d (%d/s)' % (
+        metric.name, total, (total - last.get(metric.name, 0)) / elapsed))
+    elif isinstance(metric, Histogram):
+      counts, seconds = metric.merged()
+      if sum(counts):
+        parts.append('%s n=%d mean %.3f p50<=%s p99<=%s' % (
+          metric.name, sum(counts), seconds / sum(counts),
+          _number(metric.quantile(0.5)), _number(metric.quantile(0.99))))
+    else:
+      for _, labels, _, value in metric.samples():
+        parts.append('%s%s %s' % (metric.name, metric.label_text(labels),
+                                  _number(value)))
+  _summarized = (totals, now)
+  return ', '.join(parts)
+
+
+def _app(environ, start_response):
+  body = render()
+  start_response('200 OK', [('Content-Type', CONTENT_TYPE),
+                            ('Content-Length', str(len(body)))])
+  return [body]
+
+
+class _QuietHandler(simple_server.WSGIRequestHandler):
+  def log_message(self, format, *args):
+    pass
+
+
+def serve(port, host=''):
+  """Serves render() on every path from a daemon thread; returns the server."""
+  httpd = simple_server.make_server(host, port, _app,
+                                    handler_class=_QuietHandler)
+  thread = threading.Thread(target=httpd.serve_forever, name='MetricsServer')
+  thread.daemon = True
+  thread.start()
+  LOG.info('Serving metrics on %s:%d', host or '*', httpd.server_port)
+  return httpd
@@ -1,22 +1,291 @@
 #!/usr/bin/python
 
+import collections
 import itertools
 import logging
 import nntplib
+import select
 import socket
 import ssl
 import threading
+import time
+import zlib
+
+import metrics
 
-logging.basicConfig(format="%(levelname)s (%(threadName)s) %(filename)s:%(lineno)d %(message)s")
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.DEBUG)
 
 DEFAULT_XOVER_SPAN = 100
+DEFAULT_XOVER_PIPELINE = 4  # XOVER commands kept in flight per connection
 DEFAULT_NNTP_PORT = 119
 DEFAULT_CONNECTIONS = 1
+DEFAULT_COMPRESSION = 'auto'  # auto, xzver, gzip or none
+DEFAULT_POOL_IDLE_CHECK = 30  # seconds idle before a pooled socket is probed
+DEFAULT_POOL_MAX_IDLE = 300  # seconds idle before a pooled socket is dropped
 
 LONGRESP = ['100', '215', '220', '221', '222', '224', '230', '231', '282']
 CRLF = '\r\n'
+NO_ARTICLES = ('420', '423')  # empty overview range, not a failure
+CHUNK_SIZE = 64 * 1024
+MAX_WILDMAT = 480  # bytes of wildmat per LIST ACTIVE; commands end at 512
+WILDMAT_SPECIALS = frozenset('*?[]\\,!')
+
+# Overview transfer modes, negotiated per connection.
+OVER_PLAIN = 'XOVER'
+OVER_XZVER = 'XZVER'  # yEnc encoded, deflated overview (Giganews)
+OVER_GZIP = 'GZIP'  # XFEATURE COMPRESS GZIP (Highwinds, Astraweb)
+COMPRESS_GZIP_MARK = '[COMPRESS=GZIP]'
+YENC_TABLE = ''.join(chr((i - 42) % 256) for i in xrange(256))
+
+# Errors raised after a complete response was read; the socket is still usable.
+RECOVERABLE_ERRORS = (nntplib.NNTPReplyError, nntplib.NNTPTemporaryError,
+                      nntplib.NNTPPermanentError)
+
+
+# The overview fields we keep; subject and poster are left as raw bytes.
+Overview = collections.namedtuple(
+  'Overview', ['number', 'subject', 'poster', 'date', 'message_id', 'size'])
+
+
+def parse_overview(lines):
+  """Yields an Overview for each tab separated overview line."""
+  make = tuple.__new__  # skips the namedtuple constructor's argument handling
+  for line in lines:
+    # number, subject, from, date, message-id, references, bytes, lines...
+    elem = line.split('\t', 7)
+    try:
+      yield make(Overview, (int(elem[0]), elem[1], elem[2], elem[3], elem[4],
+                            int(elem[6] or 0)))
+    except (IndexError, ValueError):
+      raise nntplib.NNTPDataError(line)
+
+
+# A LIST ACTIVE or NEWGROUPS line: the group's watermarks and posting status.
+Active = collections.namedtuple('Active', ['name', 'high', 'low', 'status'])
+
+
+def parse_active(lines):
+  """Yields an Active for each "name high low status" line."""
+  make = tuple.__new__
+  for line in lines:
+    elem = line.split()
+    try:
+      yield make(Active, (elem[0], int(elem[1]), int(elem[2]),
+                          elem[3] if len(elem) > 3 else 'y'))
+    except (IndexError, ValueError):
+      raise nntplib.NNTPDataError(line)
+
+
+def group_wildmats(names, limit=MAX_WILDMAT):
+  """Joins group names into wildmats of at most limit bytes.
+
+  Returns (wildmats, rest): names with wildmat specials in them cannot be
+  matched exactly, and are left in rest.
+  """
+  wildmats, rest = [], []
+  current = ''
+  for name in names:
+    if WILDMAT_SPECIALS.intersection(name) or len(name) > limit:
+      rest.append(name)
+    elif current and len(current) + 1 + len(name) > limit:
+      wildmats.append(current)
+      current = name
+    else:
+      current = current + ',' + name if current else name
+  if current:
+    wildmats.append(current)
+  return wildmats, rest
+
+
+def yenc_decode(line):
+  """Decodes one line of yEnc encoded data."""
+  if '=' in line:
+    parts = line.split('=')
+    line = parts[0] + ''.join(
+      chr((ord(part[0]) - 64) % 256) + part[1:] for part in parts[1:] if part)
+  return line.translate(YENC_TABLE)
+
+
+def _decompressor(head):
+  """Picks zlib framing from the first bytes of a compressed stream."""
+  if head[:1] == '\x78':
+    return zlib.decompressobj(zlib.MAX_WBITS)
+  if head[:2] == '\x1f\x8b':
+    return zlib.decompressobj(zlib.MAX_WBITS | 16)
+  return zlib.decompressobj(-zlib.MAX_WBITS)
+
+
+def _stream_finished(decompressor):
+  # zlib in python 2 has no Decompress.eof; a finished stream hands any
+  # further input straight back as unused_data.
+  if decompressor.unused_data:
+    return True
+  probe = decompressor.copy()
+  try:
+    probe.decompress('\x00')
+  except zlib.error:
+    return False
+  return probe.unused_data == '\x00'
+
+
+class SocketReader(object):
+  """Buffered reader over a socket that can return lines or raw chunks.
+
+  socket.makefile only offers blocking fixed-size reads, which cannot be used
+  to pull a compressed response of unknown length off the wire.
+  """
+
+  def __init__(self, sock, chunk_size=CHUNK_SIZE):
+    self._sock = sock
+    self._chunk_size = chunk_size
+    self._buf = ''
+    self._pos = 0
+    self.received = 0  # bytes read off the socket
+    self.waited = 0.0  # seconds spent blocked reading them
+
+  def _recv(self):
+    started = time.time()
+    data = self._sock.recv(self._chunk_size)
+    self.waited += time.time() - started
+    self.received += len(data)
+    return data
+
+  def buffered(self):
+    return len(self._buf) - self._pos
+
+  def _fill(self):
+    data = self._recv()
+    if data:
+      self._buf = self._buf[self._pos:] + data
+      self._pos = 0
+    return bool(data)
+
+  def readline(self, limit=-1):
+    while True:
+      end = self._buf.find('\n', self._pos)
+      if end >= 0:
+        end += 1
+      elif 0 <= limit <= self.buffered() or not self._fill():
+        end = len(self._buf)
+      else:
+        continue
+      if 0 <= limit < end - self._pos:
+        end = self._pos + limit
+      line = self._buf[self._pos:end]
+      self._pos = end
+      return line
+
+  def dot_lines(self):
+    """Yields the dot-unstuffed lines of a block up to its '.' terminator.
+
+    Complete lines are split out of the buffer a chunk at a time rather than
+    one readline() call per line; the terminator is consumed and anything
+    after it stays buffered for the next response.
+    """
+    while True:
+      last = self._buf.rfind('\n', self._pos)
+      if last < 0:
+        if not self._fill():
+          raise EOFError
+        continue
+      block = self._buf[self._pos:last]
+      offset = self._pos
+      self._pos = last + 1
+      for line in block.split('\n'):
+        offset += len(line) + 1
+        if line[-1:] == '\r':
+          line = line[:-1]
+        if line == '.':
+          self._pos = offset
+          return
+        if line[:2] == '..':
+          line = line[1:]
+        yield line
+
+  def read_chunk(self):
+    """Returns whatever is buffered, or the next chunk from the socket."""
+    if self.buffered():
+      chunk = self._buf[self._pos:]
+    else:
+      chunk = self._recv()
+    self._buf, self._pos = '', 0
+    return chunk
+
+  def unread(self, data):
+    self._buf = data + self._buf[self._pos:]
+    self._pos = 0
+
+  def close(self):
+    self._buf, self._pos = '', 0
+
+
+class Connection(object):
+  """An authenticated socket to a server, kept alive between tasks."""
+
+  def __init__(self, sock):
+    self.sock = sock
+    self.file = SocketReader(sock)
+    self.welcome = None
+    self.group = None
+    self.overview = None
+    self.last_used = time.time()
+    self.broken = False
+
+  def idle_time(self):
+    return time.time() - self.last_used
+
+  def has_pending_data(self):
+    # An idle socket should have nothing to read; if it does the server has
+    # either hung up or sent an unsolicited timeout notice.
+    if self.file.buffered():
+      return True
+    if isinstance(self.sock, ssl.SSLSocket) and self.sock.pending():
+      return True
+    try:
+      return bool(select.select([self.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+      return True
+
+  def close(self):
+    for closeable in (self.file, self.sock):
+      try:
+        closeable.close()
+      except (socket.error, IOError):
+        pass
+
+
+class PoolStats(object):
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.connects = 0
+    self.reconnects = 0
+    self.discarded = 0
+    self.group_skips = 0
+    self.waits = 0
+    self.wait_time = 0.0
+
+  def incr(self, name, amount=1):
+    with self._lock:
+      setattr(self, name, getattr(self, name) + amount)
+
+  def waited(self, seconds):
+    with self._lock:
+      self.waits += 1
+      self.wait_time += seconds
+
+  def as_dict(self):
+    with self._lock:
+      return {
+        'hits': self.hits,
+        'connects': self.connects,
+        'reconnects': self.reconnects,
+        'discarded': self.discarded,
+        'group_skips': self.group_skips,
+        'waits': self.waits,
+        'wait_time': round(self.wait_time, 3),
+      }
 
 class NNTP(nntplib.NNTP):
   @classmethod
@@ -26,76 +295,185 @@ class NNTP(nntplib.NNTP):
       config.get('username'), config.get('password'),
       True, True, config.get('ssl', False),
       config.get('xover_span', DEFAULT_XOVER_SPAN),
-      config.get('connections', DEFAULT_CONNECTIONS))
+      config.get('connections', DEFAULT_CONNECTIONS),
+      xover_pipeline=config.get('xover_pipeline', DEFAULT_XOVER_PIPELINE),
+      compression=config.get('compression', DEFAULT_COMPRESSION),
+      backbone=config.get('backbone'),
+      pool_idle_check=config.get('pool_idle_check', DEFAULT_POOL_IDLE_CHECK),
+      pool_max_idle=config.get('pool_max_idle', DEFAULT_POOL_MAX_IDLE))
 
   def __init__(self, host, port, user=None, password=None,
                readermode=None, usenetrc=True, is_ssl=False, xover_span=None,
-               max_connections=None):
+               max_connections=None, xover_pipeline=None,
+               compression=DEFAULT_COMPRESSION, backbone=None,
+               pool_idle_check=None, pool_max_idle=None):
     self.host = host
     self.port = port
+    # Servers on one backbone share article numbering.
+    self.backbone = backbone or host
     self.user = user
     self.password = password
     self.readermode = readermode
     self.usenetrc = usenetrc
     self.is_ssl = is_ssl
     self.xover_span_width = int(xover_span or DEFAULT_XOVER_SPAN)
-    self._connections_semaphore = threading.BoundedSemaphore(max_connections or DEFAULT_CONNECTIONS)
+    self.xover_pipeline = max(1, int(xover_pipeline or DEFAULT_XOVER_PIPELINE))
+    self.compression = str(compression).lower() if compression else 'none'
+    if self.compression not in ('auto', 'xzver', 'gzip', 'none'):
+      raise ValueError('unknown compression %r' % compression)
+    self.pool_idle_check = float(pool_idle_check or DEFAULT_POOL_IDLE_CHECK)
+    self.pool_max_idle = float(pool_max_idle or DEFAULT_POOL_MAX_IDLE)
+    self.stats = PoolStats()
+    self.max_connections = int(max_connections or DEFAULT_CONNECTIONS)
+    self._connections_semaphore = threading.BoundedSemaphore(self.max_connections)
     self._authentication = lambda: self.__authenticate(user, password)
+    self._idle = []
+    self._idle_lock = threading.Lock()
     self.__thread_local = threading.local()
-    self.__thread_local.sock = None
-    self.__thread_local.file = None
-    self.__thread_local.welcome = None
 
     self.debugging = 0
 
   def __str__(self):
     return '<NNTP %s %i>' % (self.host, self.port)
 
+  @property
+  def connection(self):
+    conn = getattr(self.__thread_local, 'conn', None)
+    if conn is None:
+      raise nntplib.NNTPError('%s used outside of a with block' % self)
+    return conn
+
   @property
   def sock(self):
-    if getattr(self.__thread_local, 'sock', None) is None:
-      LOG.debug('opening socket to %s %i', self.host, self.port)
-      sock = socket.create_connection((self.host, self.port))
-      if self.is_ssl:
-        sock = ssl.wrap_socket(sock)
-      self.__thread_local.sock = sock
-    return self.__thread_local.sock
+    return self.connection.sock
 
   @property
   def file(self):
-    if getattr(self.__thread_local, 'file', None) is None:
-      LOG.debug('opening file for %s %i : %s', self.host, self.port, self.sock)
-      self.__thread_local.file = self.sock.makefile('rb')
-    return self.__thread_local.file
+    return self.connection.file
 
   @property
   def welcome(self):
-    return self.__thread_local.welcome
+    return self.connection.welcome
 
   def __enter__(self):
-    LOG.info('connecting to %s:%i', self.host, self.port)
+    started = time.time()
     self._connections_semaphore.acquire(True)
-
-    # Commiting some magic here
-    self.__thread_local.welcome = self.getresp()
-
-    self._authentication()
+    self.stats.waited(time.time() - started)
+    try:
+      self.__thread_local.conn = self._checkout()
+    except:
+      self.__thread_local.conn = None
+      self._connections_semaphore.release()
+      raise
     return self
 
   def __exit__(self, exec_type, exec_val, exec_traceback):
-    self.file.close()
-    self.sock.close()
-    self.__thread_local.file = None
-    self.__thread_local.sock = None
-
-    self._connections_semaphore.release()
+    conn = self.__thread_local.conn
+    self.__thread_local.conn = None
+    try:
+      if conn.broken or not (exec_type is None or
+                             issubclass(exec_type, RECOVERABLE_ERRORS)):
+        LOG.debug('dropping connection to %s:%i', self.host, self.port)
+        self.stats.incr('discarded')
+        conn.close()
+      else:
+        conn.last_used = time.time()
+        with self._idle_lock:
+          self._idle.append(conn)
+    finally:
+      self._connections_semaphore.release()
     return False
 
+  def _checkout(self):
+    """Returns a healthy pooled connection, or a freshly authenticated one."""
+    replacing = False
+    while True:
+      with self._idle_lock:
+        conn = self._idle.pop() if self._idle else None
+      if conn is None:
+        break
+      if self._healthy(conn):
+        self.stats.incr('hits')
+        return conn
+      self.stats.incr('discarded')
+      conn.close()
+      replacing = True
+
+    LOG.info('connecting to %s:%i', self.host, self.port)
+    sock = socket.create_connection((self.host, self.port))
+    if self.is_ssl:
+      sock = ssl.wrap_socket(sock)
+    conn = Connection(sock)
+    self.__thread_local.conn = conn
+    try:
+      conn.welcome = self.getresp()
+      self._authentication()
+    except:
+      conn.close()
+      raise
+    self.stats.incr('connects')
+    if replacing:
+      self.stats.incr('reconnects')
+    return conn
+
+  def _healthy(self, conn):
+    idle = conn.idle_time()
+    if conn.broken or idle > self.pool_max_idle or conn.has_pending_data():
+      return False
+    if idle > self.pool_idle_check:
+      self.__thread_local.conn = conn
+      try:
+        self.date()
+      except (socket.error, EOFError, nntplib.NNTPError) as err:
+        LOG.debug('idle connection to %s:%i failed probe: %s',
+                  self.host, self.port, err)
+        return False
+      finally:
+        self.__thread_local.conn = None
+    return True
+
+  def pool_stats(self):
+    stats = self.stats.as_dict()
+    with self._idle_lock:
+      stats['idle'] = len(self._idle)
+    return stats
+
+  def close(self):
+    """Sends QUIT on and closes every idle pooled connection."""
+    with self._idle_lock:
+      idle, self._idle = self._idle, []
+    for conn in idle:
+      self.__thread_local.conn = conn
+      try:
+        self.shortcmd('QUIT')
+      except (socket.error, EOFError, nntplib.NNTPError):
+        pass
+      finally:
+        self.__thread_local.conn = None
+        conn.close()
+
+  def quit(self):
+    resp = self.shortcmd('QUIT')
+    self.connection.broken = True
+    return resp
+
+  def group(self, name):
+    response = nntplib.NNTP.group(self, name)
+    self.connection.group = name
+    return response
+
+  def select_group(self, name):
+    """Issues GROUP only if the connection does not already have it selected."""
+    if self.connection.group == name:
+      self.stats.incr('group_skips')
+      return
+    self.group(name)
+
   def __authenticate(self, user, password):
     readermode_afterauth = 0
     if self.readermode:
         try:
-            self.__thread_local.welcome = self.shortcmd('mode reader')
+            self.connection.welcome = self.shortcmd('mode reader')
         except nntplib.NNTPPermanentError:
             # error 500, probably 'not implemented'
             pass
@@ -130,23 +508,258 @@ class NNTP(nntplib.NNTP):
                     raise nntplib.NNTPPermanentError(resp)
         if readermode_afterauth:
             try:
-                self.__thread_local.welcome = self.shortcmd('mode reader')
+                self.connection.welcome = self.shortcmd('mode reader')
             except nntplib.NNTPPermanentError:
                 # error 500, probably 'not implemented'
                 pass
 
-  def xover_span(self, group_name, start, end):
+  def span_ranges(self, start, end):
+    """Splits [start, end] into xover_span sized (low, high) ranges.
+
+    Ranges are returned in descending order when start > end.
+    """
     start, end = int(start), int(end)
-    top = max(start, end)
-    starts = xrange(start, end, self.xover_span_width)
+    low, high = min(start, end), max(start, end)
+    width = self.xover_span_width
+    spans = [(point, min(high, point + width - 1))
+             for point in xrange(low, high + 1, width)]
     if start > end:
-      starts = reversed(starts)
+      spans.reverse()
+    return spans
+
+  def _stream_lines(self, command, expected):
+    # Yields a multi-line response as it arrives, like xover_span, so the
+    # socket is only pooled again once the whole body was read.
+    conn = self.connection
+    if conn.broken:
+      raise nntplib.NNTPError('%s has an unfinished response pending' % self)
+    resp = self.shortcmd(command)
+    if resp[:3] != expected:
+      raise nntplib.NNTPReplyError(resp)
+    conn.broken = True
+    for line in self._body_lines(resp):
+      yield line
+    conn.broken = False
+
+  def list_active(self, wildmat=None):
+    """Yields an Active record per group, or per group matching wildmat.
 
+    The list is parsed as it is read; providers carry 100k+ groups.
+    """
+    command = 'LIST ACTIVE %s' % wildmat if wildmat else 'LIST ACTIVE'
+    return parse_active(self._stream_lines(command, '215'))
+
+  def list_newgroups(self, since):
+    """Yields an Active record per group created since the UTC datetime."""
+    return parse_active(self._stream_lines(
+      since.strftime('NEWGROUPS %Y%m%d %H%M%S GMT'), '231'))
+
+  def active(self, names):
+    """Returns {name: Active} for those of the group names that exist.
+
+    Asks with as few LIST ACTIVE wildmats as will hold the names, falling
+    back to a GROUP per name where a wildmat cannot match it exactly or
+    the server does not take one.
+    """
+    wanted = set(names)
+    found = {}
+    wildmats, rest = group_wildmats(sorted(wanted))
+    for wildmat in wildmats:
+      try:
+        for record in self.list_active(wildmat):
+          if record.name in wanted:
+            found[record.name] = record
+      except nntplib.NNTPPermanentError as err:
+        LOG.info('%s refused LIST ACTIVE with a wildmat: %s', self, err.response)
+        rest = sorted(wanted.difference(found))
+        break
+    for name in rest:
+      try:
+        resp, count, first, last, group_name = self.group(name)
+      except nntplib.NNTPTemporaryError as err:
+        LOG.debug('No group %s on %s: %s', name, self, err.response)
+        continue
+      found[name] = Active(name, int(last), int(first), 'y')
+    return found
+
+  def capabilities(self):
+    """Returns the CAPABILITIES lines, or an empty list if unsupported."""
+    try:
+      resp = self.shortcmd('CAPABILITIES')
+    except nntplib.NNTPPermanentError:
+      return []
+    if resp[:3] != '101':
+      raise nntplib.NNTPReplyError(resp)
+    return list(self._body_lines(resp))
+
+  def overview_mode(self):
+    """Negotiates, once per connection, how overview data is transferred."""
+    conn = self.connection
+    if conn.overview is not None:
+      return conn.overview
+    conn.overview = OVER_PLAIN
+    if self.compression == 'none':
+      return conn.overview
+
+    caps = [line.upper() for line in self.capabilities()]
+    xzver = self.compression == 'xzver' or OVER_XZVER in caps
+    gzip = self.compression == 'gzip' or any(
+      line.startswith('XFEATURE-COMPRESS') and 'GZIP' in line for line in caps)
+    if xzver and self.compression != 'gzip':
+      conn.overview = OVER_XZVER
+    elif gzip:
+      try:
+        self.shortcmd('XFEATURE COMPRESS GZIP TERMINATOR')
+        conn.overview = OVER_GZIP
+      except nntplib.NNTPPermanentError as err:
+        LOG.info('%s refused gzip compression: %s', self, err.response)
+    LOG.debug('%s using %s for overview', self, conn.overview)
+    return conn.overview
+
+  def xover_span(self, group_name, start, end, on_span=None):
+    """Yields an Overview record for each article in [start, end] of group_name.
+
+    Up to xover_pipeline XOVER commands are kept in flight; responses are
+    read back in order while later commands are already queued server side.
+    on_span, if given, is called with (low, high) once every article of a
+    span has been yielded. The time each span spent on the wire, not in
+    the consumer, goes to metrics.XOVER_SECONDS.
+    """
     LOG.debug('Grabbing articles [%i-%i] from %s', start, end, group_name)
-    self.group(group_name)
-    for low in starts:
-      high = min(top, low + self.xover_span_width - 1)
+    self.select_group(group_name)
+    conn = self.connection
+    if conn.broken:
+      raise nntplib.NNTPError('%s has an unfinished response pending' % self)
+    mode = self.overview_mode()
+    spans = iter(self.span_ranges(start, end))
+    pending = collections.deque()
+    # Until every response is consumed the stream is mid-response, so a
+    # generator closed early must not hand the socket back to the pool.
+    conn.broken = True
+    while True:
+      while len(pending) < self.xover_pipeline:
+        span = next(spans, None)
+        if span is None:
+          break
+        command = OVER_XZVER if mode == OVER_XZVER else OVER_PLAIN
+        self.putcmd('%s %i-%i' % ((command,) + span))
+        pending.append((command, span))
+      if not pending:
+        break
+      command, (low, high) = pending.popleft()
       LOG.debug('Fetching [%i-%i] from %s', low, high, group_name)
-      response = self.xover(str(low), str(high))
-      for article in response[1]:
-        yield article
+      reader = conn.file
+      received, waited = reader.received, reader.waited
+      try:
+        resp = self.getresp()
+      except nntplib.NNTPTemporaryError as err:
+        if err.response[:3] in NO_ARTICLES:
+          LOG.debug('No articles in [%i-%i]: %s', low, high, err.response)
+          if on_span:
+            on_span(low, high)
+          continue
+        raise
+      except nntplib.NNTPPermanentError as err:
+        if command != OVER_XZVER:
+          raise
+        # Fall back to plain XOVER; the retried span is answered after
+        # whatever is already in flight.
+        LOG.info('%s rejected XZVER, using XOVER: %s', self, err.response)
+        mode = conn.overview = OVER_PLAIN
+        self.putcmd('%s %i-%i' % (OVER_PLAIN, low, high))
+        pending.append((OVER_PLAIN, (low, high)))
+        continue
+      if resp[:3] != '224':
+        raise nntplib.NNTPReplyError(resp)
+      if command == OVER_XZVER:
+        lines = self._xzver_lines()
+      else:
+        lines = self._body_lines(resp)
+      for record in parse_overview(lines):
+        yield record
+      metrics.XOVER_SECONDS.observe(reader.waited - waited, (self.host,))
+      metrics.OVERVIEW_BYTES.inc(reader.received - received, (self.host,))
+      if on_span:
+        on_span(low, high)
+    conn.broken = False
+
+  def getlongresp(self, file=None):
+    # Replaces nntplib's reader so every multi-line command understands
+    # responses compressed after XFEATURE COMPRESS GZIP.
+    resp = self.getresp()
+    if resp[:3] not in nntplib.LONGRESP:
+      raise nntplib.NNTPReplyError(resp)
+    lines = []
+    for line in self._body_lines(resp):
+      if file:
+        file.write(line + '\n')
+      else:
+        lines.append(line)
+    return resp, lines
+
+  def _body_lines(self, resp):
+    """Yields the lines of a multi-line response body, up to the '.'."""
+    if COMPRESS_GZIP_MARK in resp:
+      return self._gzip_lines()
+    return self._plain_lines()
+
+  def _plain_lines(self):
+    return self.file.dot_lines()
+
+  def _xzver_lines(self):
+    # The body is ordinary dot terminated text whose lines are yEnc encoded
+    # chunks of a deflated overview block.
+    encoded = self._plain_lines()
+    chunks = (yenc_decode(line) for line in encoded if line[:2] != '=y')
+    for line in self._inflate_lines(chunks):
+      yield line
+    for line in encoded:  # the =yend trailer and the terminating '.'
+      pass
+
+  def _gzip_lines(self):
+    # The compressed stream itself carries the '.' terminator, so raw chunks
+    # are fed in until it decompresses; bytes past the stream end belong to
+    # the next response and are pushed back.
+    reader = self.file
+    def read_chunk():
+      chunk = reader.read_chunk()
+      if not chunk:
+        raise EOFError
+      return chunk
+    streams = []
+    for line in self._inflate_lines(iter(read_chunk, None), streams):
+      yield line
+    for decompressor in streams:
+      while not _stream_finished(decompressor):
+        decompressor.decompress(read_chunk())
+      if decompressor.unused_data:
+        reader.unread(decompressor.unused_data)
+
+  def _inflate_lines(self, chunks, streams=None):
+    """Decompresses chunks, yielding unstuffed lines up to the '.'."""
+    decompressor = None
+    pending = ''
+    for chunk in chunks:
+      if decompressor is None:
+        if not chunk:
+          continue
+        decompressor = _decompressor(chunk)
+        if streams is not None:
+          streams.append(decompressor)
+      pending += decompressor.decompress(chunk)
+      lines = pending.split('\n')
+      pending = lines.pop()
+      for line in lines:
+        if line[-1:] == '\r':
+          line = line[:-1]
+        if line == '.':
+          return
+        if line[:2] == '..':
+          line = line[1:]
+        yield line
+    if decompressor is not None:
+      pending += decompressor.flush()
+    for line in pending.split('\n'):
+      line = line.rstrip('\r')
+      if line and line != '.':
+        yield line[1:] if line[:2] == '..' else line
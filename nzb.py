@@ -1,4 +1,93 @@
-class NZBBuilder:
+#!/usr/bin/python
+
+import calendar
+import collections
+import cStringIO
+import datetime
+import errno
+import glob
+import hashlib
+import logging
+import os
+import threading
+import time
+from xml.sax.saxutils import escape, quoteattr
+
+import peewee
+
+import headers
+import store
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+DEFAULT_NZB_DIR = 'nzb'
+EXPORT_CHUNK = 200  # releases read per query when exporting in bulk
+DEFAULT_STALE_AGE = 300  # seconds an outdated NZB is kept for its readers
+
+NZB_HEAD = ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<!DOCTYPE nzb PUBLIC "-//newzBin//DTD NZB 1.1//EN" '
+            '"http://www.newzbin.com/DTD/nzb/nzb-1.1.dtd">\n'
+            '<nzb xmlns="http://www.newzbin.com/DTD/2003/nzb">\n')
+
+
+def _text(value):
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return str(value)
+
+
+def _epoch(posted):
+  if posted is None:
+    return 0
+  if isinstance(posted, (int, long)):
+    return posted
+  if not isinstance(posted, datetime.datetime):
+    return headers.parse_date(posted)
+  return calendar.timegm(posted.utctimetuple())
+
+
+class NZBWriter(object):
+  """Writes an NZB document to a file object as it is being built.
+
+  Only the file currently being written is held in memory; the groups of a
+  file have to be known before its segments are written.
+  """
+
+  def __init__(self, out, title=None, tags=(), password=None):
+    self.out = out
+    out.write(NZB_HEAD)
+    meta = [('title', title)] if title else []
+    meta.extend(('tag', tag) for tag in tags)
+    if password:
+      meta.append(('password', password))
+    if meta:
+      out.write(' <head>\n')
+      for kind, value in meta:
+        out.write('  <meta type=%s>%s</meta>\n' % (
+          quoteattr(kind), escape(_text(value))))
+      out.write(' </head>\n')
+
+  def write_file(self, poster, date, subject, groups, segments):
+    """segments are (number, message_id, bytes) triples in part order."""
+    write = self.out.write
+    write(' <file poster=%s date="%d" subject=%s>\n  <groups>\n' % (
+      quoteattr(_text(poster)), _epoch(date), quoteattr(_text(subject))))
+    for group in sorted(groups):
+      write('   <group>%s</group>\n' % escape(_text(group)))
+    write('  </groups>\n  <segments>\n')
+    for number, message_id, size in segments:
+      write('   <segment bytes="%d" number="%d">%s</segment>\n' % (
+        size, number, escape(_text(message_id).strip('<>'))))
+    write('  </segments>\n </file>\n')
+
+  def close(self):
+    self.out.write('</nzb>\n')
+
+
+class NZBBuilder(object):
+  """Collects a single file's segments and renders them as an NZB."""
+
   def __init__(self, title, poster, date, subject, password=None):
     self.title = title
     self.tags = set()
@@ -14,27 +103,203 @@ class NZBBuilder:
 
   def add_segment(self, group, message_id, size):
     self.groups.add(group)
-    self.segment.append((message_id, size))
+    self.segments.append((message_id, size))
 
   def __str__(self):
-    # title, (tags, ...), file(poster, date, subject, (group, ...), ((message_id, bytes), ...)
-    nzb = ElementTree.Element('nzb', {'xmlns': "http://www.newzbin.com/DTD/2003/nzb"})
-    head = ElementTree.SubElement(nzb, 'head')
-    ElementTree.SubElement(head, 'meta', {'type': 'title'}).text = self.title
-    for tag in self.tags:
-      ElementTree.SubElement(head, 'meta', {'type': 'tag'}).text = tag
-    if self.password:
-      ElementTree.SubElement(head, 'meta', {'type': 'password'}).text = self.password
-    file_entry = ElementTree.SubElement(nzb, 'file', {
-        'poster': self.poster,
-        'date': self.date,
-        'subject': self.subject
-    })
-    groups = ElementTree.SubElement(file_entry, 'groups')
-    for group in self.groups:
-      ElementTree.SubElement(head, 'group').text = group
-    segments = ElementTree.SubElement(file_entry, 'segments')
-    for idx, segment in enumerate(self.segment, start=1):
-      attrs = { 'bytes': segment[0], 'number': idx }
-      ElementTree.SubElement(head, 'segment', attrs).text = segment[0]
+    out = cStringIO.StringIO()
+    writer = NZBWriter(out, self.title, sorted(self.tags), self.password)
+    writer.write_file(self.poster, self.date, self.subject, self.groups, [
+      (number, message_id, size)
+      for number, (message_id, size) in enumerate(self.segments, start=1)])
+    writer.close()
+    return out.getvalue()
+
+
+def _release_rows(release_names):
+  """Yields a row per segment and group of release_names, in NZB order.
+
+  One query per chunk of releases: segments joined to their article and
+  every group the article was seen in, ordered by release, file and part.
+  """
+  Segment, Article, Poster = store.Segment, store.Article, store.Poster
+  GroupIndex, Group = store.GroupIndex, store.Group
+  for chunk in store.chunked(sorted(set(release_names)), EXPORT_CHUNK):
+    q = Segment.select(
+      Segment.release_name, Segment.file_number, Segment.file_name,
+      Segment.part_number, Article.identifier, Article.size,
+      Poster.name, Article.posted, Article.subject, Group.name)
+    q = q.join(Article).join(Poster).switch(Article)
+    q = q.join(GroupIndex, peewee.JOIN.LEFT_OUTER,
+               on=(GroupIndex.article == Article.id))
+    q = q.join(Group, peewee.JOIN.LEFT_OUTER)
+    q = q.where(Segment.release_name << chunk)
+    q = q.order_by(Segment.release_name, Segment.file_number,
+                   Segment.file_name, Segment.part_number,
+                   Article.posted, Article.id)
+    for row in q.tuples().iterator():
+      yield row
+
+
+def write_releases(release_names, open_release):
+  """Streams an NZB for each release to the file object open_release(name).
+
+  Reposted parts keep their earliest article. Segments whose subject gave
+  no part number are all kept, numbered after the numbered parts in the
+  order they were posted. Returns the number of NZBs written; releases
+  without segments get none.
+  """
+  written = 0
+  writer = current = None
+  file_key = groups = parts = unnumbered = first = None
+
+  def flush_file():
+    if parts or unnumbered:
+      segments = [(number,) + parts[number] for number in sorted(parts)]
+      last = segments[-1][0] if segments else 0
+      segments.extend((number,) + segment for number, segment in enumerate(
+        unnumbered.itervalues(), start=last + 1))
+      writer.write_file(first[0], first[1], first[2], groups, segments)
+
+  for (release_name, file_number, file_name, part_number, message_id, size,
+       poster, posted, subject, group) in _release_rows(release_names):
+    if release_name != current:
+      if writer is not None:
+        flush_file()
+        writer.close()
+        writer.out.close()
+      current = release_name
+      writer = NZBWriter(open_release(release_name), release_name)
+      file_key = None
+      written += 1
+    if (file_number, file_name) != file_key:
+      if file_key is not None:
+        flush_file()
+      file_key = (file_number, file_name)
+      groups, parts, first = set(), {}, (poster, posted, subject)
+      unnumbered = collections.OrderedDict()
+    if group:
+      groups.add(group)
+    if part_number:
+      parts.setdefault(part_number, (message_id, size))
+    else:  # one row per group of the article, so keyed by message-id
+      unnumbered.setdefault(message_id, (message_id, size))
+  if writer is not None:
+    flush_file()
+    writer.close()
+    writer.out.close()
+  return written
+
+
+class _AtomicFile(object):
+  # Written under a temporary name, so an interrupted export never leaves a
+  # truncated NZB behind for the cache to serve.
+  def __init__(self, path):
+    self.path = path
+    self._file = open(path + '.tmp', 'wb')
+    self.write = self._file.write
+
+  def close(self):
+    self._file.close()
+    os.rename(self.path + '.tmp', self.path)
+
+
+class NZBCache(object):
+  """NZB files on disk, keyed by release name and what its NZB is made of.
+
+  That is the release's stored part count, and the number of distinct
+  (article, group) pairs of its segments, both kept on its Release row.
+  Neither goes down, and one or the other goes up whenever a part is
+  stored or an article of the release is seen in another group. A cached
+  file with the current counts is still exactly what write_releases would
+  produce. Outdated files are removed once they are stale_age seconds
+  old, when a newer one is written, as a reader may have just been
+  handed their path.
+  """
+
+  def __init__(self, directory=DEFAULT_NZB_DIR, stale_age=DEFAULT_STALE_AGE):
+    self.directory = directory
+    self.stale_age = stale_age
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.hits = 0
+    self.misses = 0
+    self._locks = {}  # release name -> [lock, threads holding or awaiting it]
+    self._locks_lock = threading.Lock()
+
+  def _prefix(self, release_name):
+    digest = hashlib.sha1(_text(release_name)).hexdigest()
+    return os.path.join(self.directory, digest)
+
+  def path(self, release_name, version):
+    return '%s-%d-%d.nzb' % ((self._prefix(release_name),) + version)
+
+  @staticmethod
+  def _versions(release_names):
+    # {release name: (parts, postings)} of the stored releases.
+    versions = {}
+    Release = store.Release
+    for chunk in store.chunked(sorted(set(release_names))):
+      q = Release.select(Release.name, Release.parts, Release.postings)
+      versions.update((name, (parts, postings)) for name, parts, postings in
+                      q.where(Release.name << chunk).tuples())
+    return versions
+
+  def _sweep(self, release_name, current):
+    expired = time.time() - self.stale_age
+    for stale in glob.glob(self._prefix(release_name) + '-*.nzb'):
+      try:
+        if stale != current and os.path.getmtime(stale) <= expired:
+          os.remove(stale)
+      except OSError as err:  # swept by another export meanwhile
+        if err.errno != errno.ENOENT:
+          raise
+
+  def _open(self, versions):
+    def open_release(release_name):
+      path = self.path(release_name, versions[release_name])
+      self._sweep(release_name, path)
+      return _AtomicFile(path)
+    return open_release
+
+  def export(self, release_names):
+    """Returns {release name: NZB path}, writing only what is not cached."""
+    versions = self._versions(release_names)
+    paths = {}
+    missing = []
+    for name, version in versions.iteritems():
+      paths[name] = self.path(name, version)
+      if not os.path.exists(paths[name]):
+        missing.append(name)
+    self.hits += len(versions) - len(missing)
+    self.misses += len(missing)
+    if missing:
+      write_releases(missing, self._open(versions))
+      LOG.info('Wrote %d NZBs, %d were cached', len(missing),
+               len(versions) - len(missing))
+    return paths
+
+  def get(self, release_name):
+    """Returns the path of release_name's NZB, or None if it is unknown.
 
+    May be called from many threads at once. A cached NZB is returned
+    without any lock; building one holds a lock of that release only, as
+    two builds of it would share a temporary file.
+    """
+    version = self._versions([release_name]).get(release_name)
+    if version is None:
+      return None
+    path = self.path(release_name, version)
+    if os.path.exists(path):
+      self.hits += 1
+      return path
+    with self._locks_lock:
+      entry = self._locks.setdefault(release_name, [threading.Lock(), 0])
+      entry[1] += 1
+    try:
+      with entry[0]:  # whoever waited here finds the NZB cached by now
+        return self.export([release_name]).get(release_name)
+    finally:
+      with self._locks_lock:
+        entry[1] -= 1
+        if not entry[1]:
+          del self._locks[release_name]
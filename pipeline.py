@@ -0,0 +1,146 @@
+#!/usr/bin/python
+
+import logging
+import Queue
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+DEFAULT_QUEUE_ITEMS = 200000  # articles buffered between fetching and matching
+DEFAULT_QUEUE_BYTES = 64 * 1024 * 1024  # ... and their approximate size
+DEFAULT_STORE_BACKLOG = 2  # matched batches waiting for the writer
+DEFAULT_POLL = 0.5  # seconds a blocked stage waits before checking exit_event
+
+
+class BoundedQueue(Queue.Queue):
+  """A Queue.Queue bounded by item count and by the summed size of its items.
+
+  sizeof(item) gives an item's size; put() blocks while either limit is
+  reached. A single item larger than max_bytes is still let into an empty
+  queue, so nothing can wait forever. Time spent blocked on either end is
+  counted: a producer that waits long is being held back by its consumer.
+  """
+
+  def __init__(self, maxsize=0, max_bytes=0, sizeof=None):
+    Queue.Queue.__init__(self, maxsize)
+    self.max_bytes = max_bytes
+    self.sizeof = sizeof or (lambda item: 0)
+    self.bytes = 0
+    self.puts = 0
+    self.gets = 0
+    self.put_wait = 0.0
+    self.get_wait = 0.0
+    self.high_water = 0
+    self.high_water_bytes = 0
+
+  def _full(self):
+    if not self.queue:
+      return False
+    return ((self.maxsize > 0 and len(self.queue) >= self.maxsize) or
+            (self.max_bytes > 0 and self.bytes >= self.max_bytes))
+
+  def _put(self, item):
+    self.queue.append((item, self.sizeof(item)))
+    self.bytes += self.queue[-1][1]
+    self.puts += 1
+    self.high_water = max(self.high_water, len(self.queue))
+    self.high_water_bytes = max(self.high_water_bytes, self.bytes)
+
+  def _get(self):
+    item, size = self.queue.popleft()
+    self.bytes -= size
+    self.gets += 1
+    return item
+
+  def put(self, item, block=True, timeout=None):
+    # Queue.Queue.put only knows about maxsize, so the wait is redone here.
+    with self.not_full:
+      if self._full():
+        if not block:
+          raise Queue.Full
+        started = time.time()
+        deadline = None if timeout is None else started + timeout
+        try:
+          while self._full():
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+              raise Queue.Full
+            self.not_full.wait(remaining)
+        finally:
+          self.put_wait += time.time() - started
+      self._put(item)
+      self.unfinished_tasks += 1
+      self.not_empty.notify()
+
+  def get(self, block=True, timeout=None):
+    started = time.time()
+    try:
+      return Queue.Queue.get(self, block, timeout)
+    finally:
+      self.get_wait += time.time() - started
+
+  def put_or_exit(self, item, exit_event, poll=DEFAULT_POLL):
+    """Blocks while full; gives up, returning False, once exit_event is set."""
+    while not exit_event.is_set():
+      try:
+        self.put(item, timeout=poll)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def get_batch(self, limit, timeout=DEFAULT_POLL):
+    """Waits up to timeout for an item, then takes up to limit without waiting."""
+    try:
+      batch = [self.get(timeout=timeout)]
+    except Queue.Empty:
+      return []
+    with self.mutex:
+      while self.queue and len(batch) < limit:
+        batch.append(self._get())
+      if len(batch) > 1:
+        self.not_full.notify_all()
+    return batch
+
+  def stats(self):
+    with self.mutex:
+      return {
+        'depth': len(self.queue),
+        'bytes': self.bytes,
+        'high_water': self.high_water,
+        'high_water_bytes': self.high_water_bytes,
+        'puts': self.puts,
+        'gets': self.gets,
+        'put_wait': round(self.put_wait, 2),
+        'get_wait': round(self.get_wait, 2),
+      }
+
+
+class StageStats(object):
+  """Items a pipeline stage has handled and the time it spent doing so."""
+
+  def __init__(self, name):
+    self.name = name
+    self.items = 0
+    self.batches = 0
+    self.busy = 0.0
+    self.started = time.time()
+    self._lock = threading.Lock()
+
+  def record(self, items, seconds):
+    with self._lock:
+      self.items += items
+      self.batches += 1
+      self.busy += seconds
+
+  def as_dict(self):
+    with self._lock:
+      elapsed = max(time.time() - self.started, 0.001)
+      return {
+        'items': self.items,
+        'batches': self.batches,
+        'per_second': int(self.items / elapsed),
+        'busy': round(self.busy / elapsed, 2),  # fraction of wall time
+      }
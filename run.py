@@ -1,145 +1,440 @@
 #!/usr/bin/python2
 
 import collections
-import interval
+import datetime
 import itertools
 import logging
+import nntplib
 from pprint import pformat
 import Queue
 import re
+import socket
 import sys
 import threading
 import time
 import yaml
 
-import memory_profiler
-
+import clusters
+import headers
+import matcher
+import metrics
 import nntp
+import nzb
+from matcher import SubjectParser
+from pipeline import (BoundedQueue, DEFAULT_POLL, DEFAULT_QUEUE_BYTES,
+                      DEFAULT_QUEUE_ITEMS, DEFAULT_STORE_BACKLOG, StageStats)
+from scheduler import DEFAULT_MAX_ATTEMPTS, Scheduler, Span, split_range
 import store
 
 
-logging.basicConfig(format="%(levelname)s (%(threadName)s) %(filename)s:%(lineno)d %(message)s")
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.DEBUG)
 
+DEFAULT_ENGINE = 'threads'  # threads, or asyncio for aionntp's engine
+DEFAULT_BATCH_SIZE = 2000  # articles stored per transaction
+DEFAULT_REMATCH_BATCH_SIZE = 20000  # unmatched articles read per query
+DEFAULT_UNIT_SPANS = 10  # xover spans per scheduled work unit
+DEFAULT_REPORT_INTERVAL = 10  # seconds between pipeline progress reports
+DEFAULT_WATERMARK_AGE = 600  # seconds stored watermarks are planned from
+NEWGROUPS_SLACK = 3600  # seconds NEWGROUPS looks back, for clock skew
 
-def _decode_if_str(string):
-  if not isinstance(string, str):
-    return string
-  try:
-    return unicode(string, 'ascii')
-  except UnicodeDecodeError:
-    for encoding in ('latin-1', 'cp037'):
-      try:
-        u_str = unicode(string, encoding)
-        LOG.debug('Encoding success: %s %s', encoding, repr(u_str))
-        return u_str
-      except UnicodeDecodeError:
-        LOG.warn('Encoding failure: %s %s', encoding, repr(string))
-    return unicode(string, 'ascii', 'replace')
+ARTICLE_OVERHEAD = 400  # rough bytes of tuple and object headers per article
 
 
-def _compress_ints(ints, initial=None,  func=tuple):
-  iset = interval.IntervalSet()
-  last = None
-  for curr in sorted(set(ints)):
-    if initial is None:
-      last = curr
-      initial = curr
-    if last - curr == 1:
-      iset |= interval.IntervalSet.between(initial, last)
-      initial = curr
-    last = curr
-  iset |= interval.IntervalSet.between(initial, last)
-  return iset
-
-
-def ArticleQueueProcessor(exit_event, queue):
+def _article_size(item):
+  # What an item costs in BoundedQueue terms; exact enough to bound memory.
+  if isinstance(item, Span) or item is None:
+    return 0
+  nntp_article = item[2]
+  return (ARTICLE_OVERHEAD + len(nntp_article.subject) +
+          len(nntp_article.poster) + len(nntp_article.date) +
+          len(nntp_article.message_id))
+
+
+def _store_batch(batch, spans, segment_data):
+  with store.peewee_db.atomic():
+    rows = store.Article.addBatchFromNNTP(
+      (server, group_name, nntp_article, data)
+      for (server, group_name, nntp_article), data in zip(batch, segment_data))
+    # A span's marker is queued after its articles, so by the time it is
+    # seen here every one of them is in this transaction or an earlier one.
+    for span in spans:
+      store.Coverage.add(*span)
+  return rows
+
+
+def ParseStage(exit_event, articles, parsed, parser, stats,
+               batch_size=DEFAULT_BATCH_SIZE):
+  """Takes fetched articles off their queue in batches and matches them.
+
+  A None queued after the last article flushes the final batch and is
+  passed on, telling the store stage to finish.
+  """
+  while not exit_event.is_set():
+    items = articles.get_batch(batch_size)
+    if not items:
+      continue
+    finished = items[-1] is None
+    if finished:
+      items.pop()
+    started = time.time()
+    batch = [item for item in items if not isinstance(item, Span)]
+    spans = [item for item in items if isinstance(item, Span)]
+    segment_data = parser.match(
+      [nntp_article.subject for _, _, nntp_article in batch])
+    stats.record(len(batch), time.time() - started)
+    if not parsed.put_or_exit((batch, spans, segment_data), exit_event):
+      break
+    if finished:
+      parsed.put_or_exit(None, exit_event)
+      break
+
+
+def StoreStage(exit_event, parsed, articles, stats):
+  """Writes matched batches, one transaction each, until told to finish."""
   while not exit_event.is_set():
     try:
-      group_name, nntp_article = queue.get_nowait()
-      #LOG.debug(nntp_article)
-      article = store.Article.addFromNNTP(nntp_article)
-      article.addGroupIndex(group_name, nntp_article[0])
-      for match in article.getSegmentData():
-        article.addSegment(match)
-        break
-      queue.task_done()
-    except Queue.Empty as err:
-      time.sleep(3)
+      item = parsed.get(timeout=DEFAULT_POLL)
+    except Queue.Empty:
+      continue
+    if item is None:
+      break
+    batch, spans, segment_data = item
+    started = time.time()
+    rows = _store_batch(batch, spans, segment_data)
+    elapsed = time.time() - started
+    stats.record(len(batch), elapsed)
+    LOG.info('Stored %d articles (%d rows) in %.2fs, %d rows/s, %d queued',
+             len(batch), rows, elapsed, rows / max(elapsed, 0.001),
+             articles.qsize())
 
 
-def QueueArticlesFromServer(exit_event, queue, group_name, server):
-  LOG.info('Queueing articles from %s on %s', group_name, server)
-  q = store.GroupIndex.select(store.GroupIndex.number)
-  q = q.where(store.GroupIndex.name == group_name)
-  article_nums = _compress_ints(i[0] for i in q.tuples())
-  LOG.info(article_nums)
+def RunStage(stage, exit_event, failures, *args):
+  """Runs a pipeline stage's thread; a stage that fails stops the sync.
 
+  The other threads would otherwise wait forever on the queue it no
+  longer drains or fills. The failure is kept in failures, for sync() to
+  raise once everything has stopped.
+  """
+  try:
+    stage(exit_event, *args)
+  except Exception:
+    LOG.exception('%s failed, stopping the sync',
+                  threading.current_thread().name)
+    failures.append(sys.exc_info())
+    exit_event.set()
+
+
+def RefreshGroups(server, full=False):
+  """Stores the group list and watermarks of server's backbone.
+
+  The whole LIST ACTIVE is only read the first time, or when full is set;
+  afterwards NEWGROUPS asks for the groups created since. Either is stored
+  in batches while it is still being read. Returns the groups stored.
+  """
+  backbone = server.backbone
+  listed = store.Server.listed_at(backbone)
+  started = datetime.datetime.utcnow()
   with server as nntp:
-    group_resp, count, g_first, g_last, name = nntp.group(group_name)
-    LOG.info((group_name, g_first, g_last, len(article_nums)))
-    all_articles = interval.IntervalSet.between(int(g_first), int(g_last))
-    missing_articles = all_articles - article_nums
-    LOG.debug(missing_articles)
-    for intv in missing_articles:
-      articles = nntp.xover_span(group_name, intv.lower_bound, intv.upper_bound)
-      for nntp_article in articles:
-        queue.put((group_name, [_decode_if_str(f) for f in nntp_article]))
-        if exit_event.is_set():
-          break
-  LOG.info('Finished queueing articles from %s on %s', group_name, server)
+    if full or listed is None:
+      records = nntp.list_active()
+    else:
+      records = nntp.list_newgroups(
+        listed - datetime.timedelta(seconds=NEWGROUPS_SLACK))
+    stored = store.Watermark.addBatchFromActive(backbone, records)
+  store.Server.set_listed(backbone, started)
+  LOG.info('Stored %d %sgroups of %s', stored,
+           '' if full or listed is None else 'new ', backbone)
+  return stored
+
+
+def PlanSync(scheduler, servers, group_names, unit_spans=DEFAULT_UNIT_SPANS,
+             max_age=DEFAULT_WATERMARK_AGE):
+  """Queues the missing ranges of every group on every backbone as work units.
+
+  Article numbers are only comparable between servers of one backbone, so
+  each backbone is planned once, through the first of its servers, from
+  watermarks stored within max_age seconds or else fetched with LIST
+  ACTIVE, not a GROUP per group.
+  """
+  planners = collections.OrderedDict()
+  for server in servers:
+    planners.setdefault(server.backbone, server)
+  for backbone, server in planners.iteritems():
+    width = server.xover_span_width * unit_spans
+    watermarks = store.Watermark.fresh(backbone, group_names, max_age)
+    stale = [name for name in group_names if name not in watermarks]
+    if stale:
+      with server as nntp:
+        records = nntp.active(stale).values()
+      store.Watermark.addBatchFromActive(backbone, records)
+      watermarks.update((record.name, (record.low, record.high))
+                        for record in records)
+    for group_name in group_names:
+      if group_name not in watermarks:
+        LOG.warn('Skipping %s on %s: no such group', group_name, backbone)
+        continue
+      g_first, g_last = watermarks[group_name]
+      missing = store.Coverage.missing(backbone, group_name, g_first, g_last)
+      LOG.info('%s on %s [%d-%d]: %d missing ranges, %d articles',
+               group_name, backbone, g_first, g_last, len(missing),
+               sum(high - low + 1 for low, high in missing))
+      for low, high in missing:
+        for piece in split_range(low, high, width):
+          scheduler.add(backbone, group_name, *piece)
+
+
+def _queue_unit(exit_event, queue, client, unit):
+  def span_done(low, high):
+    queue.put_or_exit(Span(unit.backbone, unit.group, low, high), exit_event)
+
+  articles = client.xover_span(unit.group, unit.low, unit.high, span_done)
+  for nntp_article in articles:
+    # Blocks while the queue is full, which holds this connection's reads
+    # back until matching and writing catch up.
+    if not queue.put_or_exit((unit.backbone, unit.group, nntp_article._replace(
+        subject=headers.decode_subject(nntp_article.subject),
+        poster=headers.decode_poster(nntp_article.poster))), exit_event):
+      break
+
+
+def FetchWorker(exit_event, queue, scheduler, server, home):
+  """Fetches work units over one of server's connections until none are left."""
+  while not exit_event.is_set():
+    unit = scheduler.take(server, server.backbone, home)
+    if unit is None:
+      break
+    try:
+      with server as nntp:
+        _queue_unit(exit_event, queue, nntp, unit)
+    except (socket.error, EOFError, nntplib.NNTPError) as err:
+      LOG.warn('Fetching %s [%i-%i] from %s failed: %s',
+               unit.group, unit.low, unit.high, server, err)
+      scheduler.failed(unit, server)
+    else:
+      scheduler.done(unit)
 
 
 def sync(exit_event, config):
-  article_queue = Queue.Queue()
+  if not config.get('groups'):
+    LOG.warn('No groups configured; nothing to sync')
+    return
+  if config.get('engine', DEFAULT_ENGINE) == 'asyncio':
+    # Imported here so the threaded engine does not need trollius.
+    import aionntp
+    return aionntp.sync(exit_event, config)
+
+  article_queue = BoundedQueue(
+    config.get('queue_items', DEFAULT_QUEUE_ITEMS),
+    config.get('queue_bytes', DEFAULT_QUEUE_BYTES), _article_size)
+  parsed_queue = BoundedQueue(
+    config.get('store_backlog', DEFAULT_STORE_BACKLOG))
+  metrics.QUEUE_DEPTH.track(article_queue.qsize, ('fetched',))
+  metrics.QUEUE_DEPTH.track(parsed_queue.qsize, ('parsed',))
   servers = [nntp.NNTP.FromConfig(server) for server in config.get('servers')]
+  group_names = config.get('groups')
+  parser = SubjectParser(config['regexp_file'],
+                         config.get('parse_processes'))
+  scheduler = Scheduler(
+    config.get('max_attempts', DEFAULT_MAX_ATTEMPTS))
+  for server in servers:
+    scheduler.register(server.backbone, server)
+  PlanSync(scheduler, servers, group_names,
+           config.get('unit_spans', DEFAULT_UNIT_SPANS),
+           config.get('watermark_age', DEFAULT_WATERMARK_AGE))
 
-  article_sync = threading.Thread(
-    target=ArticleQueueProcessor,
-    args=(exit_event, article_queue),
-    name='ArticleQueueProcessor')
-  article_sync.start()
+  parse_stats, store_stats = StageStats('parse'), StageStats('store')
+  failures = []
+  stages = [
+    threading.Thread(target=RunStage,
+      args=(ParseStage, exit_event, failures, article_queue, parsed_queue,
+            parser, parse_stats, config.get('batch_size', DEFAULT_BATCH_SIZE)),
+      name='ParseStage'),
+    threading.Thread(target=RunStage,
+      args=(StoreStage, exit_event, failures, parsed_queue, article_queue,
+            store_stats),
+      name='StoreStage'),
+  ]
+  for stage in stages:
+    stage.start()
 
-  for group_name in config.get('groups'):
-    sync_thread = threading.Thread(target=QueueArticlesFromServer,
-      args=(exit_event, article_queue, group_name, servers[0]),
-      name='Sync[%s]' % group_name)
-    #sync_thread.daemon = True
-    sync_thread.start()
+  # Every connection of every server gets a worker; home groups are dealt
+  # out round robin so each group starts with some workers of its own.
+  fetchers = []
+  for server in servers:
+    for idx in xrange(server.max_connections):
+      home = group_names[len(fetchers) % len(group_names)]
+      fetcher = threading.Thread(target=FetchWorker,
+        args=(exit_event, article_queue, scheduler, server, home),
+        name='Fetch[%s#%d]' % (server.host, idx))
+      fetcher.start()
+      fetchers.append(fetcher)
 
-  while threading.active_count() > 1:
-    if exit_event.is_set():
-      LOG.info('waiting...')
-      LOG.debug(threading.enumerate())
-      time.sleep(0.5)
-    else:
+  def report():
+    LOG.info('scheduler: %s', scheduler.stats())
+    LOG.info('fetch -> parse queue: %s', article_queue.stats())
+    LOG.info('parse -> store queue: %s', parsed_queue.stats())
+    for stats in (parse_stats, store_stats):
+      LOG.info('%s stage: %s', stats.name, stats.as_dict())
+    LOG.info('poster cache: %d hits, %d misses', headers.POSTERS.hits,
+             headers.POSTERS.misses)
+    if metrics.ENABLED:
+      LOG.info('metrics: %s', metrics.summary())
+
+  # The parser pool runs threads of its own, so wait on ours rather than on
+  # threading.active_count(). A join with a timeout still lets Ctrl-C in.
+  reported = time.time()
+  interval = config.get('report_interval', DEFAULT_REPORT_INTERVAL)
+  for thread in fetchers:
+    while thread.is_alive():
       try:
-        time.sleep(10)
+        thread.join(DEFAULT_POLL)
       except KeyboardInterrupt as kbd_err:
         exit_event.set()
+      if exit_event.is_set():
+        scheduler.close()  # a stage failed, or Ctrl-C
+      if time.time() - reported >= interval:
+        report()
+        reported = time.time()
 
+  if not exit_event.is_set():
+    article_queue.put_or_exit(None, exit_event)
+  for stage in stages:
+    stage.join()
 
-if __name__ == "__main__":
-  config = yaml.load(open('config.yaml'))
-  store.LoadMatchers(open(config['regexp_file'], 'rb'))
-  exit_event = threading.Event()
+  parser.close()
+  report()
+  for server in servers:
+    LOG.info('%s pool: %s', server, server.pool_stats())
+    server.close()
+  if parser.pool is None:
+    _log_matcher_report()
+  for queue in ('fetched', 'parsed'):
+    metrics.QUEUE_DEPTH.forget((queue,))
+  if failures:
+    exc_type, exc_value, exc_traceback = failures[0]
+    raise exc_type, exc_value, exc_traceback
+
+
+def rematch(exit_event, config):
+  """Re-runs the matchers over every article without a segment."""
+  batch_size = config.get('rematch_batch_size', DEFAULT_REMATCH_BATCH_SIZE)
+  parser = SubjectParser(config['regexp_file'],
+                         config.get('parse_processes'))
+  started = time.time()
+  last = None
+  seen = matched = 0
   try:
-    sync(exit_event, config)
-  except KeyboardInterrupt as kbd_err:
-    pass
+    while not exit_event.is_set():
+      # Keyset paging: newly matched articles drop out of unmatched(), so
+      # an offset would skip rows.
+      q = store.Article.unmatched()
+      if last is not None:
+        q = q.where(store.Article.id > last)
+      q = q.order_by(store.Article.id).limit(batch_size)
+      page = [(a.id, a.subject) for a in q]
+      if not page:
+        break
+      last = page[-1][0]
+      results = parser.match([subject for _, subject in page])
+      matched += store.Segment.addBatch(
+        (article_id, data)
+        for (article_id, _), data in zip(page, results) if data)
+      seen += len(page)
+      LOG.info('Rematched %d of %d articles, %d/s', matched, seen,
+               seen / max(time.time() - started, 0.001))
+  finally:
+    parser.close()
+  if parser.pool is None:
+    _log_matcher_report()
 
 
+def _log_matcher_report():
+  LOG.info('matcher shape memo: %d hits, %d misses',
+           matcher.ENGINE.shape_hits, matcher.ENGINE.shape_misses)
+  for row in matcher.ENGINE.report():
+    LOG.info('matcher %(description)s: %(hits)d/%(attempts)d hits, '
+             '%(seconds).3fs', row)
 
-"""
-import store
-store.LoadMatchers(open('regexp.txt', 'rb'))
-for article in store.Article.unmatched().iterator():
-  for matcher in store.Matchers:
-    match = matcher.pattern.match(article.subject)
-    if match:
-      article.addSegment(match.groupdict())
+
+def suggest_templates(exit_event, config):
+  """Clusters the subjects no template matches and logs suggested ones."""
+  analyzer = clusters.SubjectClusters()
+  q = store.Article.unmatched().select(store.Article.subject)
+  for (subject,) in q.tuples().iterator():
+    if exit_event.is_set():
       break
+    analyzer.add(subject)
+  LOG.info('Clustered %d unmatched subjects into %d clusters, %d unclustered',
+           analyzer.subjects, len(analyzer.clusters), analyzer.unclustered)
+  for row in analyzer.suggestions(config.get('suggest_limit', 20), minimum=2):
+    LOG.info('%(count)d subjects in %(clusters)d clusters, e.g. %(example)s',
+             row)
+    LOG.info('  %s', row['template'])
 
 
-"""
+def groups(exit_event, config, mode=None):
+  """Refreshes the group lists of every backbone; `groups full` rereads them."""
+  full = mode == 'full'
+  planned = set()
+  for server in config.get('servers'):
+    server = nntp.NNTP.FromConfig(server)
+    if server.backbone not in planned:
+      planned.add(server.backbone)
+      RefreshGroups(server, full)
+    server.close()
+
+
+def maintain(exit_event, config):
+  """Checkpoints the database and refreshes its statistics once."""
+  store.maintain()
+
+
+def releases(exit_event, config):
+  """Rebuilds the File and Release summaries from every stored segment."""
+  store.Release.rebuild()
+
+
+def export_nzbs(exit_event, config):
+  """Writes an NZB for every complete release; unchanged ones are skipped."""
+  cache = nzb.NZBCache(config.get('nzb_dir', nzb.DEFAULT_NZB_DIR))
+  q = store.Release.complete(config.get('nzb_min_completion', 100.0))
+  names = [name for (name,) in q.select(store.Release.name).tuples()]
+  paths = cache.export(names)
+  LOG.info('%d NZBs in %s (%d written, %d cached)', len(paths),
+           cache.directory, cache.misses, cache.hits)
+
+
+COMMANDS = {
+  'sync': sync,
+  'rematch': rematch,
+  'releases': releases,
+  'suggest': suggest_templates,
+  'nzb': export_nzbs,
+  'maintain': maintain,
+  'groups': groups,
+}
+
+
+if __name__ == "__main__":
+  metrics.configure_logging()
+  command = COMMANDS[sys.argv[1] if len(sys.argv) > 1 else 'sync']
+  config = yaml.load(open('config.yaml'))
+  if config.get('metrics') or config.get('metrics_port'):
+    metrics.enable()
+  if config.get('metrics_port'):
+    # The pipeline's metrics are only ever recorded in this process, so
+    # this is what Prometheus scrapes; server.py has none to offer.
+    metrics.serve(config['metrics_port'])
+  store.open_db(config.get('database'))
+  store.LoadMatchers(open(config['regexp_file'], 'rb'))
+  exit_event = threading.Event()
+  maintenance = threading.Thread(target=store.MaintenanceWorker,
+                                 args=(exit_event,), name='MaintenanceWorker')
+  maintenance.daemon = True
+  maintenance.start()
+  try:
+    # Anything after the command name goes to it, e.g. `groups full`.
+    command(exit_event, config, *sys.argv[2:])
+  except KeyboardInterrupt as kbd_err:
+    exit_event.set()
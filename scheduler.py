@@ -0,0 +1,141 @@
+#!/usr/bin/python
+
+import collections
+import logging
+import threading
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+DEFAULT_MAX_ATTEMPTS = 3
+
+# A range of one group's articles on one backbone, fetched as a whole by a
+# single connection. failed_on holds the servers it has already failed on.
+WorkUnit = collections.namedtuple(
+  'WorkUnit', ['backbone', 'group', 'low', 'high', 'attempts', 'failed_on'])
+# Queued after the articles of a span, marking the span as fully fetched.
+Span = collections.namedtuple('Span', ['server', 'group', 'low', 'high'])
+
+
+def split_range(low, high, width):
+  """Splits [low, high] into consecutive (low, high) pieces of width."""
+  return [(point, min(high, point + width - 1))
+          for point in xrange(low, high + 1, width)]
+
+
+class Scheduler(object):
+  """Shares work units between every connection of every server.
+
+  Units are queued per (backbone, group). A worker drains its home group
+  first and, once that is empty, steals from the tail of whichever group on
+  its backbone has the most work left. A unit that fails is handed back and
+  preferably retried on a server it has not failed on yet.
+  """
+
+  def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    self.max_attempts = max_attempts
+    self._cond = threading.Condition()
+    self._queues = collections.defaultdict(collections.deque)
+    self._servers = collections.defaultdict(set)
+    self._active = collections.Counter()  # units being fetched, per backbone
+    self._closed = False
+    self.completed = 0
+    self.stolen = 0
+    self.retried = 0
+    self.abandoned = 0
+
+  def register(self, backbone, server):
+    with self._cond:
+      self._servers[backbone].add(server)
+
+  def add(self, backbone, group, low, high):
+    with self._cond:
+      self._queues[(backbone, group)].append(
+        WorkUnit(backbone, group, low, high, 0, ()))
+      self._cond.notify_all()
+
+  def pending(self):
+    with self._cond:
+      return sum(len(queue) for queue in self._queues.itervalues())
+
+  def close(self):
+    """Wakes every waiting worker and makes take() return None."""
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+
+  def _pop(self, server, backbone, home):
+    # Prefer units this server has not already failed, unless every server
+    # of the backbone has failed them.
+    everyone = self._servers[backbone]
+    def usable(unit):
+      return server not in unit.failed_on or everyone <= set(unit.failed_on)
+
+    home_queue = self._queues.get((backbone, home))
+    if home_queue:
+      for idx, unit in enumerate(home_queue):
+        if usable(unit):
+          del home_queue[idx]
+          return unit
+    victims = sorted(
+      (queue for (queue_backbone, _), queue in self._queues.iteritems()
+       if queue_backbone == backbone and queue),
+      key=len, reverse=True)
+    for queue in victims:
+      for idx in xrange(len(queue) - 1, -1, -1):
+        if usable(queue[idx]):
+          unit = queue[idx]
+          del queue[idx]
+          if unit.group != home:
+            self.stolen += 1
+          return unit
+    return None
+
+  def take(self, server, backbone, home=None):
+    """Blocks until a unit is available; returns None once all work is done."""
+    with self._cond:
+      while not self._closed:
+        unit = self._pop(server, backbone, home)
+        if unit is not None:
+          self._active[backbone] += 1
+          return unit
+        # Only units of this backbone can come back to it: another
+        # backbone's busy workers must not keep this one's waiting.
+        if not self._active[backbone] and not any(
+            queue for (queue_backbone, _), queue in self._queues.iteritems()
+            if queue_backbone == backbone):
+          return None
+        # Work may still come back from a unit that fails elsewhere.
+        self._cond.wait(1)
+      return None
+
+  def done(self, unit):
+    with self._cond:
+      self._active[unit.backbone] -= 1
+      self.completed += 1
+      self._cond.notify_all()
+
+  def failed(self, unit, server):
+    with self._cond:
+      self._active[unit.backbone] -= 1
+      attempts = unit.attempts + 1
+      if attempts >= self.max_attempts:
+        self.abandoned += 1
+        LOG.error('Giving up on %s [%i-%i] after %d attempts',
+                  unit.group, unit.low, unit.high, attempts)
+      else:
+        self.retried += 1
+        self._queues[(unit.backbone, unit.group)].appendleft(unit._replace(
+          attempts=attempts, failed_on=unit.failed_on + (server,)))
+      self._cond.notify_all()
+
+  def stats(self):
+    with self._cond:
+      return {
+        'pending': sum(len(queue) for queue in self._queues.itervalues()),
+        'active': sum(self._active.itervalues()),
+        'completed': self.completed,
+        'stolen': self.stolen,
+        'retried': self.retried,
+        'abandoned': self.abandoned,
+      }
@@ -1,11 +1,26 @@
+import base64
+import collections
+import functools
+import hashlib
 import json
 import logging
 import os.path
-from os.path import commonprefix
+import Queue
 import re
+import threading
+import time
+import urllib
+from wsgiref import simple_server
+import zlib
+
+import concurrent.futures
 
 from __init__ import Indexer
-from store import Group, Article
+import clusters
+import metrics
+import nzb
+import store
+from store import Group, GroupIndex, Article, Poster, Release, Stat
 
 from third_party import itty
 from third_party import gviz_api as gviz
@@ -14,6 +29,31 @@ LOG = logging.getLogger('py-usedex.server')
 
 STATIC_FILES = os.path.join(os.path.dirname(__file__), 'static')
 IDXR = None
+NZB_CACHE = None
+
+# Sortable columns per endpoint; each is backed by an index whose order
+# ends in the primary key, which keyset paging needs as a tie breaker.
+GROUP_SORTS = {'name': Group.name}
+ARTICLE_SORTS = {'posted': Article.posted}
+RELEASE_SORTS = {
+  'name': Release.name,
+  'posted': Release.posted,
+  'completion': Release.completion,
+}
+# (endpoint, generation, filters, sort, offset) -> key of the row just
+# before offset; a key only holds while the store generation does.
+PAGE_KEYS = collections.OrderedDict()
+MAX_PAGE_KEYS = 10000
+DEFAULT_CACHE_ENTRIES = 512  # rendered responses kept
+DEFAULT_CACHE_TTL = 60  # seconds, for anything the store generation misses
+DEFAULT_READERS = 8  # request threads, each with a read-only connection
+REQUEST_BACKLOG = 128  # connections the kernel queues while readers are busy
+GZIP_MIN_BYTES = 1024  # smaller responses are not worth compressing
+GZIP_LEVEL = 5
+PAGE_KEYS_LOCK = threading.Lock()
+NZB_LOCK = threading.Lock()
+DEFAULT_CLUSTER_SUBJECTS = 10000  # newest subjects clustered per request
+MAX_CLUSTER_SUBJECTS = 1000000
 
 def parse_tq(tq_str):
   def prs(tq, stop, hsh, key, flag, regex, transform=None):
@@ -44,59 +84,195 @@ def parse_tqx(tqx_str):
     return dict()
   return dict( pair.split(':', 2) for pair in tqx_str.split(';') )
 
-def lcs(data):
-  substr = ''
-  if len(data) > 1 and len(data[0]) > 0:
-    for i in range(len(data[0])):
-      for j in range(len(data[0])-i+1):
-        if j > len(substr) and all(data[0][i:i+j] in x for x in data):
-          substr = data[0][i:i+j]
-  return substr
+def parse_order(tq, sorts, default):
+  """Returns (column, descending) for tq's order by, if it is whitelisted.
+
+  Only indexed columns are listed in sorts; anything else gets default.
+  """
+  words = tq.get('order', '').split()
+  if words and words[0] in sorts:
+    return words[0], len(words) > 1 and words[1].lower() == 'desc'
+  return default
+
+def encode_cursor(key):
+  return base64.urlsafe_b64encode(json.dumps(key, default=str))
+
+def decode_cursor(cursor):
+  try:
+    return tuple(json.loads(base64.urlsafe_b64decode(str(cursor))))
+  except (TypeError, ValueError):
+    return None
+
+def remember_key(scope, position, key):
+  with PAGE_KEYS_LOCK:
+    PAGE_KEYS.pop(scope + (position,), None)  # most recently used goes last
+    PAGE_KEYS[scope + (position,)] = key
+    while len(PAGE_KEYS) > MAX_PAGE_KEYS:
+      PAGE_KEYS.popitem(last=False)
+
+def keyset_page(select, field, descending, tq, request, scope):
+  """Runs one page of select ordered by field, then primary key.
+
+  Pages continue from the key of the row before them, never an OFFSET:
+  from an explicit cursor parameter, or, for the gviz tables that only
+  know limit/offset, from the key remembered for that offset when the
+  previous page was served, as long as the store has not changed since.
+  Only a jump straight to a deep page that was never reached falls back
+  to OFFSET. Returns (rows, next cursor).
+  """
+  model = select.model_class
+  pk = model._meta.primary_key
+  limit, offset = tq.get('limit', 1), tq.get('offset', 0)
+  scope = ((request.path, Stat.get_value('generation')) + scope +
+           (field.name, descending))
+  key = decode_cursor(request.GET.get('cursor', ''))
+  if key is None:
+    with PAGE_KEYS_LOCK:
+      key = PAGE_KEYS.get(scope + (offset,)) if offset else None
+
+  if field is pk:
+    select = select.order_by(pk.desc() if descending else pk)
+  else:
+    select = select.order_by(*([field.desc(), pk.desc()] if descending
+                               else [field, pk]))
+  if key is not None:
+    value, ident = key
+    if field is pk:
+      select = select.where(pk < ident if descending else pk > ident)
+    elif descending:
+      select = select.where((field < value) | ((field == value) & (pk < ident)))
+    else:
+      select = select.where((field > value) | ((field == value) & (pk > ident)))
+  elif offset:
+    select = select.offset(offset)
+
+  rows = list(select.limit(limit))
+  for idx, row in enumerate(rows):
+    remember_key(scope, offset + idx + 1,
+                 (row._data[field.name], row._data[pk.name]))
+  cursor = ''
+  if rows:
+    cursor = encode_cursor((rows[-1]._data[field.name], rows[-1]._data[pk.name]))
+  return rows, cursor
+
+class ResponseCache(object):
+  """LRU of rendered responses, valid while the store's generation holds.
+
+  The ingest writer bumps Stat's 'generation' counter with every row it
+  changes, so a cached page is served until the data behind it changes or
+  ttl runs out, whichever comes first.
+  """
+
+  def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES):
+    self.max_entries = max_entries
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key, generation):
+    """Returns (response, etag) cached for key, or None."""
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry is None or entry[0] != generation or entry[1] < time.time():
+        self.misses += 1
+        return None
+      self.entries[key] = entry  # most recently used goes last
+      self.hits += 1
+      return entry[2:]
+
+  def put(self, key, generation, ttl, response, etag):
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = (generation, time.time() + ttl, response, etag)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+RESPONSES = ResponseCache()
+
+def cache_key(request, args, kwargs):
+  # tq is normalized through the parser, so spacing and backticks do not
+  # split one page into several entries.
+  params = []
+  for name, value in sorted(request.GET.items()):
+    if name == 'tq':
+      value = json.dumps(parse_tq(value), sort_keys=True)
+    params.append((name, value))
+  return (request.path, tuple(params), args, tuple(sorted(kwargs.items())))
+
+def cached(ttl=DEFAULT_CACHE_TTL):
+  """Serves a handler's responses from RESPONSES, with ETag revalidation."""
+  def decorate(handler):
+    @functools.wraps(handler)
+    def wrapper(request, *args, **kwargs):
+      generation = Stat.get_value('generation')
+      key = cache_key(request, args, kwargs)
+      entry = RESPONSES.get(key, generation)
+      if entry is None:
+        response = handler(request, *args, **kwargs)
+        output = response.output
+        if isinstance(output, unicode):
+          output = output.encode('utf-8')
+        etag = '"%s"' % hashlib.sha1(output).hexdigest()
+        response.add_header('ETag', etag)
+        RESPONSES.put(key, generation, ttl, response, etag)
+      else:
+        response, etag = entry
+      if request._environ.get('HTTP_IF_NONE_MATCH') == etag:
+        return itty.Response('', headers=[('ETag', etag)], status=304)
+      return response
+    return wrapper
+  return decorate
+
+def gviz_response(dt, dt_order, tqx, cursor=''):
+  gviz_json = dt.ToJSonResponse(req_id=tqx.get('reqId', 0),
+                                columns_order=dt_order)
+  headers = [('X-Next-Cursor', cursor)] if cursor else []
+  return itty.Response(gviz_json, headers=headers,
+                       content_type='application/json')
 
 
 
 @itty.get('/groups')
+@cached()
 def get_groups(request):
   query = request.GET.get('query', '')
   watched = request.GET.get('watched', '')
   tqx = parse_tqx(request.GET.get('tqx', ''))
   tq = parse_tq(request.GET.get('tq', ''))
+  sort, descending = parse_order(tq, GROUP_SORTS, ('name', False))
 
   select = Group.select()
-  select = select.limit(tq.get('limit', 1))
-  select = select.offset(tq.get('offset', 0))
-  select = select.order_by(Group.name)
   if query:
     select = select.where(Group.name % ('*%s*' % query))
   if watched:
     select = select.where(Group.watch == True)
+  groups, cursor = keyset_page(select, GROUP_SORTS[sort], descending, tq,
+                               request, (query, watched))
 
   dt = gviz.DataTable({
       'name': ('string', 'Name'),
       'watch': ('boolean', 'Watched')
       })
   dt_order = ['watch', 'name']
-  dt.LoadData( g._data for g in select )
-  gviz_json = dt.ToJSonResponse(req_id=tqx.get('reqId', 0),
-                                columns_order=dt_order)
-
-  return itty.Response(gviz_json, content_type='application/json')
+  dt.LoadData( g._data for g in groups )
+  return gviz_response(dt, dt_order, tqx, cursor)
 
 @itty.get('/articles')
+@cached()
 def get_articles(request):
   query = request.GET.get('query', '')
   tq = parse_tq(request.GET.get('tq', ''))
   tqx = parse_tqx(request.GET.get('tqx', ''))
+  sort, descending = parse_order(tq, ARTICLE_SORTS, ('posted', True))
 
-  select = Article.select()
-  select = select.limit(tq.get('limit', 1))
-  select = select.offset(tq.get('offset', 0))
+  cursor = ''
   if query:
-    select = select.where(Article.subject % ('*%s*' % query))
-
-  subjects = [ a.subject for a in select ]
-  LOG.debug(lcs(subjects))
-  LOG.debug(commonprefix(subjects))
+    # Ranked through the full-text index rather than a GLOB over every row.
+    articles = Article.search(query, tq.get('limit', 1), tq.get('offset', 0))
+  else:
+    articles, cursor = keyset_page(Article.select(), ARTICLE_SORTS[sort],
+                                   descending, tq, request, ())
 
   dt = gviz.DataTable({
       'posted': ('datetime', 'Posted'),
@@ -104,22 +280,97 @@ def get_articles(request):
       'subject': ('string', 'Subject'),
       'message_id': ('string', 'ID')
       })
-  dt.LoadData( a._data for a in select )
+  posters = Poster.names(a._data['poster'] for a in articles)
+  dt.LoadData( dict(a._data, message_id=a.identifier,
+                    poster=posters.get(a._data['poster'])) for a in articles )
   dt_order = ['subject', 'posted', 'poster', 'message_id']
-  gviz_json = dt.ToJSonResponse(req_id=tqx.get('reqId', 0),
-                                columns_order=dt_order)
+  return gviz_response(dt, dt_order, tqx, cursor)
 
-  return itty.Response(gviz_json, content_type='application/json')
+@itty.get('/releases')
+@cached()
+def get_releases(request):
+  query = request.GET.get('query', '')
+  tq = parse_tq(request.GET.get('tq', ''))
+  tqx = parse_tqx(request.GET.get('tqx', ''))
+  sort, descending = parse_order(tq, RELEASE_SORTS, ('posted', True))
+
+  cursor = ''
+  if query:
+    releases = Release.search(query, tq.get('limit', 1), tq.get('offset', 0))
+  else:
+    releases, cursor = keyset_page(Release.select(), RELEASE_SORTS[sort],
+                                   descending, tq, request, ())
+
+  dt = gviz.DataTable({
+      'name': ('string', 'Release'),
+      'files': ('number', 'Files'),
+      'parts': ('number', 'Parts'),
+      'completion': ('number', 'Complete %'),
+      'size': ('number', 'Bytes'),
+      'posted': ('string', 'Posted')
+      })
+  dt.LoadData( r._data for r in releases )
+  dt_order = ['name', 'posted', 'completion', 'files', 'parts', 'size']
+  return gviz_response(dt, dt_order, tqx, cursor)
+
+@itty.get('/clusters')
+@cached()
+def get_clusters(request):
+  """Clusters of similar subjects and the regexp.txt templates they suggest.
+
+  Covers the newest `limit` articles, of `group` if given, and only those
+  no template matched yet if `unmatched` is set.
+  """
+  group = request.GET.get('group', '')
+  unmatched = request.GET.get('unmatched', '')
+  try:
+    limit = min(int(request.GET.get('limit', DEFAULT_CLUSTER_SUBJECTS)),
+                MAX_CLUSTER_SUBJECTS)
+  except ValueError:
+    limit = DEFAULT_CLUSTER_SUBJECTS
+
+  select = Article.unmatched() if unmatched else Article.select()
+  select = select.select(Article.subject)
+  if group:
+    select = select.join(GroupIndex, on=(GroupIndex.article == Article.id))
+    select = select.join(Group).where(Group.name == group).distinct()
+  select = select.order_by(Article.posted.desc()).limit(limit)
+  analyzer = clusters.SubjectClusters().add_all(
+    subject for (subject,) in select.tuples().iterator())
 
-@itty.get('/state')
-def get_state(request):
   data = {
-      'jobs': IDXR.task_queue.qsize(),
-      'articles': Article.select().count(),
-      'groups': Group.select().count()
+    'subjects': analyzer.subjects,
+    'unclustered': analyzer.unclustered,
+    'clusters': [cluster.as_dict() for cluster in analyzer.largest(100)],
+    'releases': analyzer.releases(100),
+    'suggestions': analyzer.suggestions(20, minimum=2),
   }
   return itty.Response(json.dumps(data), content_type='application/json')
 
+@itty.get('/nzb/(?P<release_name>.+)')
+def get_nzb(request, release_name):
+  global NZB_CACHE
+  if NZB_CACHE is None:
+    with NZB_LOCK:
+      if NZB_CACHE is None:
+        NZB_CACHE = nzb.NZBCache()
+  # Locks nothing for a cached NZB, and only its release to build one.
+  path = NZB_CACHE.get(urllib.unquote(release_name).decode('utf-8'))
+  if path is None:
+    raise itty.NotFound('No such release')
+  headers = [('Content-Disposition',
+              'attachment; filename="%s.nzb"' % release_name)]
+  return itty.Response(open(path, 'rb').read(), headers=headers,
+                       content_type='application/x-nzb')
+
+@itty.get('/state')
+@cached(ttl=5)
+def get_state(request):
+  # Counters kept by the writer's triggers; no COUNT(*) per poll.
+  data = Stat.snapshot()
+  data['jobs'] = IDXR.task_queue.qsize() if IDXR else 0
+  return itty.Response(json.dumps(data), content_type='application/json')
+
 @itty.get('/')
 def index(request):
   return serve(request, 'index.html')
@@ -168,10 +419,100 @@ def reload_groups(request):
 
 
 
+class RequestHandler(simple_server.WSGIRequestHandler):
+  def log_message(self, format, *args):
+    LOG.debug('%s ' + format, self.client_address[0], *args)
+
+class PooledWSGIServer(simple_server.WSGIServer):
+  """A WSGI server answering requests on a fixed pool of reader threads.
+
+  Each reader opens one read-only database connection and keeps it, so a
+  slow query holds up only its own thread and the API never competes with
+  the ingest writer for SQLite's write lock. Requests that write are handed
+  to a single writer thread by writes_apart().
+  """
+  request_queue_size = REQUEST_BACKLOG
+
+  def __init__(self, address, handler, readers=DEFAULT_READERS):
+    simple_server.WSGIServer.__init__(self, address, handler)
+    self.requests = Queue.Queue(readers * 4)
+    for idx in xrange(readers):
+      reader = threading.Thread(target=self._read, name='reader-%d' % idx)
+      reader.daemon = True
+      reader.start()
+
+  def _read(self):
+    store.connect_read_only()
+    while True:
+      request, client_address = self.requests.get()
+      try:
+        self.finish_request(request, client_address)
+      except Exception:
+        self.handle_error(request, client_address)
+      finally:
+        self.shutdown_request(request)
+
+  def process_request(self, request, client_address):
+    self.requests.put((request, client_address))
+
+def writes_apart(app):
+  """Runs requests other than GET and HEAD on one read-write connection."""
+  writer = concurrent.futures.ThreadPoolExecutor(1)
+  def dispatch(environ, start_response):
+    if environ['REQUEST_METHOD'] in ('GET', 'HEAD'):
+      return app(environ, start_response)
+    return writer.submit(lambda: list(app(environ, start_response))).result()
+  return dispatch
+
+def gzipped(app):
+  """Compresses JSON responses for clients that accept gzip."""
+  def compress(environ, start_response):
+    if 'gzip' not in environ.get('HTTP_ACCEPT_ENCODING', ''):
+      return app(environ, start_response)
+    started = []
+    body = []
+    def capture(status, headers, exc_info=None):
+      started[:] = [status, headers, exc_info]
+      return body.append
+    body.extend(app(environ, capture))
+    status, headers, exc_info = started
+    body = ''.join(body)
+    names = dict((name.lower(), value) for name, value in headers)
+    if (names.get('content-type', '').startswith('application/json') and
+        'content-encoding' not in names and len(body) >= GZIP_MIN_BYTES):
+      gzip = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+      body = gzip.compress(body) + gzip.flush()
+      headers = [(name, value) for name, value in headers
+                 if name.lower() != 'content-length']
+      headers.extend([('Content-Encoding', 'gzip'),
+                      ('Content-Length', str(len(body))),
+                      ('Vary', 'Accept-Encoding')])
+    start_response(status, headers, exc_info)
+    return [body]
+  return compress
+
+def make_server(host, port, readers=DEFAULT_READERS):
+  return simple_server.make_server(
+    host, port, gzipped(writes_apart(itty.handle_request)),
+    server_class=functools.partial(PooledWSGIServer, readers=readers),
+    handler_class=RequestHandler)
+
+
+
 if __name__ == '__main__':
+  metrics.configure_logging()
+  store.open_db()
   IDXR = Indexer()
   host = IDXR.config.get('server', 'host')
   port = IDXR.config.getint('server', 'port')
-  itty.run_itty(host=host, port=port)
+  readers = DEFAULT_READERS
+  if IDXR.config.has_option('server', 'readers'):
+    readers = IDXR.config.getint('server', 'readers')
+  httpd = make_server(host, port, readers)
+  LOG.info('Serving on %s:%d with %d readers', host, port, readers)
+  try:
+    httpd.serve_forever()
+  except KeyboardInterrupt:
+    pass
   LOG.info('waiting on %d tasks', IDXR.task_queue.qsize())
   IDXR.task_queue.join()
@@ -1,58 +1,489 @@
 #!/usr/bin/python
 
+import calendar
 import collections
 import datetime
 import fnmatch
 import hashlib
+import itertools
 import logging
 import re
 import threading
 import time
 
-from dateutil import parser
 import peewee
 from playhouse import fields
+from playhouse import migrate
 import tinydb
 import tinydb.middlewares
 import tinydb.operations
 import tinydb.serialize
 #import tinydb.storages
 
+import headers
+from matcher import LoadMatchers, Matcher, MatcherMacros, Matchers, MatchSubject
+import metrics
+
 
-logging.basicConfig(format="%(levelname)s (%(threadName)s) %(filename)s:%(lineno)d %(message)s")
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.DEBUG)
 #logging.getLogger('peewee').setLevel(logging.DEBUG)
 
 
-MatcherMacros = {
-  'size': r'\d+(?:[.]\d+)? MBytes|\d+ [Bb]ytes',
-  'comment': r'(?P<comment>.+?)',
-  'release': r'(?P<release_name>.+?)',
-  'seperator': r'(?:-|\||\|\|)',
-  'parts_p': r'\((?P<part_number>\d+)(?:\/| ?of ?)(?P<part_total>\d+)\)',
-  'parts_b': r'\[(?P<part_number>\d+)(?:\/| ?of ?)(?P<part_total>\d+)\]',
-  'files_b': r'\[(?P<file_number>\d+)(?:\/| ?of ?)(?P<file_total>\d+)\]',
-  'files': r'(?P<file_number>\d+)(?:\/| ?of ?)(?P<file_total>\d+)',
-  'parts': r'(?P<part_number>\d+)(?:\/| ?of ?)(?P<part_total>\d+)',
-  'file_name_parts': r'(?P<file_name>.+\.part(?P<file_number>\d+)\.rar)',
-  'file_name': r'(?P<file_name>[^"]+)',
+# SQLite refuses statements with more bound parameters than this.
+SQLITE_MAX_VARIABLES = 999
+
+# Storage profile, overridden by the `database` section of config.yaml.
+DEFAULT_PROFILE = {
+  'path': 'nntp.db',
+  'busy_timeout': 30,  # seconds a connection waits for another's lock
+  'maintenance_interval': 600,  # seconds between checkpoint/ANALYZE runs
+  'pragmas': {
+    'journal_mode': 'wal',  # readers never block the writer, nor it them
+    'synchronous': 'normal',  # WAL stays consistent; fsync at checkpoints
+    'cache_size': -65536,  # KiB of page cache per connection
+    'mmap_size': 268435456,  # bytes of the file read through mmap
+    'temp_store': 'memory',
+    'wal_autocheckpoint': 10000,  # pages; maintain() checkpoints as well
+    'journal_size_limit': 67108864,  # bytes a checkpointed WAL shrinks to
+  },
+}
+ANALYSIS_LIMIT = 1000  # rows ANALYZE samples per index
+DEFAULT_INTERN_ENTRIES = 100000  # names an Interner caches before a reset
+DEFAULT_GROUP_BATCH = 5000  # listed groups stored per transaction
+SCHEMA_VERSION = 3  # PRAGMA user_version of the current table layout
+# Columns computed while copying a table of an older layout into the
+# current one, from the copy's %(old)s table. Layouts before 2 stored
+# posters, servers and group names as text.
+MIGRATED_COLUMNS = {
+  ('article', 'poster_id'):
+    '(SELECT id FROM poster WHERE poster.name = "%(old)s".poster)',
+  ('groupindex', 'server_id'):
+    '(SELECT id FROM server WHERE server.name = "%(old)s".server)',
+  ('groupindex', 'group_id'):
+    '(SELECT id FROM "group" WHERE "group".name = "%(old)s".name)',
 }
-Matcher = collections.namedtuple('Matcher', ['pattern', 'description'])
-Matchers = list()
+# Layout 0 keyed articles by their message-id text. Article ids keep the
+# old rowids, which the search index refers to.
+ARTICLE_ID_SQL = ('(SELECT id FROM article'
+                  ' WHERE identifier_hash = message_key("%(old)s".article_id))')
+LAYOUT_0_COLUMNS = {
+  ('article', 'id'): 'rowid',
+  ('article', 'identifier_hash'): 'message_key(identifier)',
+  ('groupindex', 'article_id'): ARTICLE_ID_SQL,
+  ('segment', 'article_id'): ARTICLE_ID_SQL,
+}
+# Filled from the old tables before they are copied.
+MIGRATED_NAMES = (
+  'INSERT OR IGNORE INTO poster (name) SELECT DISTINCT poster FROM article',
+  'INSERT OR IGNORE INTO server (name) SELECT DISTINCT server FROM groupindex',
+  'INSERT OR IGNORE INTO "group" (name, watch)'
+  ' SELECT DISTINCT name, 0 FROM groupindex',
+)
+# Layouts before 3 named coverage's servers and groups as text as well.
+LAYOUT_2_COLUMNS = {
+  ('coverage', 'server_id'):
+    '(SELECT id FROM server WHERE server.name = "%(old)s".server)',
+  ('coverage', 'group_id'):
+    '(SELECT id FROM "group" WHERE "group".name = "%(old)s".name)',
+}
+LAYOUT_2_NAMES = (
+  'INSERT OR IGNORE INTO server (name) SELECT DISTINCT server FROM coverage',
+  'INSERT OR IGNORE INTO "group" (name, watch)'
+  ' SELECT DISTINCT name, 0 FROM coverage',
+)
+# Dates layouts before 2 stored as text; now seconds since the epoch.
+MIGRATED_DATES = (('article', 'posted'), ('file', 'posted'),
+                  ('release', 'posted'))
+
+# FTS5 indexes: (index, content table, indexed columns).
+SEARCH_TABLES = (
+  ('article_search', 'article', ('subject',)),
+  ('release_search', 'release', ('name', 'file_names')),
+)
+SEARCH_WORDS = re.compile(r'\w+', re.UNICODE)
+SEARCH = False  # set once the FTS5 tables are known to exist
+
+# Stat counters kept by triggers: (counter, table, also bumped on update).
+COUNTERS = (
+  ('groups', 'group', True),
+  ('releases', 'release', False),
+)
+# Stat counters of the tables every batch writes thousands of rows to:
+# (counter, table). A trigger would update Stat once per row, so their
+# writers count the rows they insert and call _count once per batch.
+BATCH_COUNTERS = (
+  ('articles', 'article'),
+  ('segments', 'segment'),
+)
+
+
+def _insert_tuples(model, names, rows, on_conflict):
+  # One prepared INSERT run per row of values, as db_value gives them.
+  # Building multi-row INSERTs through peewee costs several times what
+  # SQLite spends storing the rows; see Watermark.addBatchFromActive.
+  # Returns the number of rows inserted or replaced.
+  if not rows:
+    return 0
+  meta = model._meta
+  return peewee_db.get_conn().executemany(
+    'INSERT OR %s INTO "%s" (%s) VALUES (%s)' % (
+      on_conflict, meta.db_table,
+      ', '.join('"%s"' % meta.fields[name].db_column for name in names),
+      ', '.join('?' * len(names))),
+    rows).rowcount
+
+
+def _insert_many(model, rows, on_conflict):
+  # Rows are dicts of field values, all with the same fields; they are
+  # converted as peewee would, and the fields they lack get their defaults.
+  if not rows:
+    return 0
+  meta = model._meta
+  names = list(rows[0])
+  defaults = [(field.name, field.db_value(default))
+              for field, default in meta._default_dict.iteritems()
+              if field.name not in rows[0]]
+  converters = [(meta.fields[name].db_value, name) for name in names]
+  fixed = tuple(value for _, value in defaults)
+  return _insert_tuples(
+    model, names + [name for name, _ in defaults],
+    [tuple([convert(row[name]) for convert, name in converters]) + fixed
+     for row in rows], on_conflict)
+
+
+def _insert_ignore(model, rows):
+  """INSERT OR IGNORE of dicts of field values."""
+  return _insert_many(model, rows, 'IGNORE')
+
+
+def _insert_replace(model, rows):
+  """INSERT OR REPLACE of dicts of field values."""
+  return _insert_many(model, rows, 'REPLACE')
+
+
+def _count(counter, rows):
+  # Adds rows to one of BATCH_COUNTERS, and bumps the generation once.
+  if rows:
+    conn = peewee_db.get_conn()
+    conn.execute('UPDATE stat SET value = value + ? WHERE name = ?',
+                 (rows, counter))
+    conn.execute("UPDATE stat SET value = value + 1 WHERE name = 'generation'")
+
+
+def chunked(values, size=SQLITE_MAX_VARIABLES):
+  """Splits values into lists short enough to bind in one statement."""
+  values = list(values)
+  for offset in xrange(0, len(values), size):
+    yield values[offset:offset + size]
+
+
+def message_key(message_id):
+  """64 bits of a message-id's MD5, which articles are indexed by.
+
+  An 8 byte integer index is a fraction of the size of one over the
+  message-id text. With 64 bits, a collision is unlikely below billions
+  of articles.
+  """
+  if isinstance(message_id, unicode):
+    message_id = message_id.encode('utf-8')
+  key = int(hashlib.md5(message_id).hexdigest()[:16], 16)
+  return key - (1 << 64) if key >= (1 << 63) else key
+
+
+def _completion(parts, part_total):
+  if not part_total:
+    return 0.0
+  return min(100.0, 100.0 * parts / part_total)
+
+
+def _segment_row(article_id, segment_data):
+  # Optional groups a template did not match come back as None.
+  file_name = (segment_data.get('file_name') or '').strip()
+  return {
+    'article': article_id,
+    'file_name': file_name,
+    'release_name': segment_data.get('release_name') or file_name,
+    'file_total': int(segment_data.get('file_total') or 0),
+    'file_number': int(segment_data.get('file_number') or 0),
+    'part_total': int(segment_data.get('part_total') or 0),
+    'part_number': int(segment_data.get('part_number') or 0),
+  }
+
+
+def fts_query(text):
+  """Turns user input into an FTS5 query matching all of its words.
+
+  Words are quoted so FTS5 syntax in the input is taken literally; the
+  last word also matches as a prefix, for search as you type.
+  """
+  words = SEARCH_WORDS.findall(text.lower() if text else '')
+  if not words:
+    return None
+  return ' '.join('"%s"' % word for word in words) + '*'
+
+
+def _ensure_columns(model):
+  # Adds columns declared after the table was created.
+  table = model._meta.db_table
+  existing = set(row[1] for row in peewee_db.execute_sql(
+    'PRAGMA table_info("%s")' % table).fetchall())
+  migrator = migrate.SqliteMigrator(peewee_db)
+  migrate.migrate(*[
+    migrator.add_column(table, field.db_column, field)
+    for field in model._meta.sorted_fields if field.db_column not in existing])
+
+
+def _ensure_search():
+  """Creates the FTS5 indexes and the triggers that keep them current.
+
+  Returns False, leaving searches to fall back to LIKE, if this SQLite was
+  built without FTS5.
+  """
+  for table, content, columns in SEARCH_TABLES:
+    created = not peewee_db.execute_sql(
+      'SELECT 1 FROM sqlite_master WHERE name = ?', (table,)).fetchone()
+    try:
+      peewee_db.execute_sql(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, content=\'%s\','
+        ' content_rowid=rowid, prefix=\'2 3\')' % (
+          table, ', '.join(columns), content))
+    except peewee.OperationalError as err:
+      LOG.warn('Full-text search unavailable: %s', err)
+      return False
+    new = ', '.join('new.%s' % column for column in columns)
+    old = ', '.join('old.%s' % column for column in columns)
+    peewee_db.execute_sql(
+      'CREATE TRIGGER IF NOT EXISTS %s_insert AFTER INSERT ON "%s" BEGIN'
+      ' INSERT INTO %s(rowid, %s) VALUES (new.rowid, %s); END' % (
+        table, content, table, ', '.join(columns), new))
+    peewee_db.execute_sql(
+      'CREATE TRIGGER IF NOT EXISTS %s_delete AFTER DELETE ON "%s" BEGIN'
+      ' INSERT INTO %s(%s, rowid, %s) VALUES (\'delete\', old.rowid, %s);'
+      ' END' % (table, content, table, table, ', '.join(columns), old))
+    if created:
+      LOG.info('Indexing existing rows of %s for search', content)
+      peewee_db.execute_sql(
+        "INSERT INTO %s(%s) VALUES ('rebuild')" % (table, table))
+  return True
+
+
+def _ensure_counters():
+  """Creates the triggers that keep Stat current, seeding missing counters.
+
+  Every change to a counted table also bumps the 'generation' counter,
+  which readers use to tell whether anything they cached is stale. The
+  BATCH_COUNTERS tables are only seeded; their writers count for them.
+  """
+  Stat.insert(name='generation', value=0).on_conflict('IGNORE').execute()
+  counted = [(counter, table) for counter, table, _ in COUNTERS]
+  for counter, table in counted + list(BATCH_COUNTERS):
+    if not Stat.select().where(Stat.name == counter).exists():
+      peewee_db.execute_sql(
+        'INSERT INTO stat (name, value) SELECT ?, COUNT(*) FROM "%s"' % table,
+        (counter,))
+  for counter, table in BATCH_COUNTERS:
+    for event in ('insert', 'delete'):  # as created by earlier versions
+      peewee_db.execute_sql('DROP TRIGGER IF EXISTS stat_%s_%s' % (table, event))
+  for counter, table, on_update in COUNTERS:
+    events = [('insert', 1), ('delete', -1)]
+    if on_update:
+      events.append(('update', 0))
+    for event, delta in events:
+      peewee_db.execute_sql(
+        'CREATE TRIGGER IF NOT EXISTS stat_%s_%s AFTER %s ON "%s" BEGIN'
+        " UPDATE stat SET value = value + %d WHERE name = '%s';"
+        " UPDATE stat SET value = value + 1 WHERE name = 'generation';"
+        ' END' % (table, event, event.upper(), table, delta, counter))
+
+
+def _create_table(model):
+  # Like create_table, but honours Meta.without_rowid and leaves indexes to
+  # _ensure_indexes.
+  sql, params = peewee_db.compiler().create_table(model, safe=True)
+  if getattr(model._meta, 'without_rowid', False):
+    sql += ' WITHOUT ROWID'
+  peewee_db.execute_sql(sql, params)
+
+
+def _ensure_indexes(model):
+  # Builds Meta.indexes and those of fields declared with index or
+  # unique, including on databases created before an index was declared.
+  # Unlike create_table, foreign keys are only indexed when asked to.
+  table = model._meta.db_table
+  indexes = [([field.name], field.unique)
+             for field in model._fields_to_index()
+             if field.index or field.unique]
+  for names, unique in indexes + list(model._meta.indexes):
+    columns = [model._meta.fields[name].db_column for name in names]
+    peewee_db.execute_sql(
+      'CREATE %sINDEX IF NOT EXISTS "%s_%s" ON "%s" (%s)' % (
+        'UNIQUE ' if unique else '', table, '_'.join(columns), table,
+        ', '.join('"%s"' % column for column in columns)))
+
+
+def _table_columns(table):
+  return [row[1] for row in peewee_db.execute_sql(
+    'PRAGMA table_info("%s")' % table).fetchall()]
+
+
+def _without_rowid(table):
+  sql = peewee_db.execute_sql(
+    'SELECT sql FROM sqlite_master WHERE name = ?', (table,)).fetchone()[0]
+  return sql.rstrip().upper().endswith('WITHOUT ROWID')
+
+
+def _migrate(models):
+  """Copies tables of an older layout into the current one.
+
+  Runs once per database, in one transaction. Only tables whose columns
+  or storage changed are copied, each indexed as soon as it is, so the
+  tables after it can look up its ids. Triggers are dropped first and
+  recreated by _ensure_search/_ensure_counters afterwards, which also
+  recount the Stat counters. Renames leave the foreign keys of other
+  tables alone, as the new table takes the old name.
+  """
+  version = peewee_db.execute_sql('PRAGMA user_version').fetchone()[0]
+  if version >= SCHEMA_VERSION:
+    return
+  existing = set(row[0] for row in peewee_db.execute_sql(
+    "SELECT name FROM sqlite_master WHERE type = 'table'").fetchall())
+  if 'article' in existing:
+    LOG.info('Migrating nntp tables from layout %d to %d; this rewrites them',
+             version, SCHEMA_VERSION)
+    computed = dict(LAYOUT_2_COLUMNS)
+    names = LAYOUT_2_NAMES if 'coverage' in existing else ()
+    if version < 2:
+      computed.update(MIGRATED_COLUMNS)
+      names = MIGRATED_NAMES + names
+    if version == 0:
+      computed.update(LAYOUT_0_COLUMNS)
+    peewee_db.execute_sql('PRAGMA legacy_alter_table = ON')
+    with peewee_db.atomic():
+      for (trigger,) in peewee_db.execute_sql(
+          "SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall():
+        peewee_db.execute_sql('DROP TRIGGER "%s"' % trigger)
+      for model in models:
+        if model._meta.db_table not in existing:
+          _create_table(model)
+          _ensure_indexes(model)
+      for statement in names:
+        peewee_db.execute_sql(statement)
+      for model in models:
+        table = model._meta.db_table
+        columns = [field.db_column for field in model._meta.sorted_fields]
+        old_columns = _table_columns(table)
+        rebuilt = (
+          any(key[0] == table for key in computed) or
+          set(columns) != set(old_columns) or
+          _without_rowid(table) != getattr(model._meta, 'without_rowid', False))
+        if table not in existing or not rebuilt:
+          continue
+        old = table + '_v%d' % version
+        peewee_db.execute_sql('ALTER TABLE "%s" RENAME TO "%s"' % (table, old))
+        _create_table(model)
+        copied, values, params = [], [], []
+        defaults = dict((field.db_column, field.db_value(default))
+                        for field, default in
+                        model._meta._default_dict.iteritems())
+        for column in columns:
+          value = computed.get((table, column))
+          if value is None and column in old_columns:
+            value = '"%s"' % column
+          if value is None and column in defaults:  # added since
+            value = '?'
+            params.append(defaults[column])
+          if value is not None:
+            copied.append('"%s"' % column)
+            values.append(value % {'old': old})
+        peewee_db.execute_sql('INSERT OR IGNORE INTO "%s" (%s) SELECT %s FROM "%s"' % (
+          table, ', '.join(copied), ', '.join(values), old), params)
+        peewee_db.execute_sql('DROP TABLE "%s"' % old)
+        _ensure_indexes(model)
+      for table, column in MIGRATED_DATES:
+        peewee_db.execute_sql(
+          'UPDATE "%s" SET "%s" = CAST(strftime(\'%%s\', "%s") AS INTEGER)'
+          ' WHERE typeof("%s") = \'text\'' % (table, column, column, column))
+      if 'stat' in existing:
+        peewee_db.execute_sql("DELETE FROM stat WHERE name <> 'generation'")
+    peewee_db.execute_sql('PRAGMA legacy_alter_table = OFF')
+  peewee_db.execute_sql('PRAGMA user_version = %d' % SCHEMA_VERSION)
 
-def LoadMatchers(iterable):
-  for idx, line in enumerate(iterable):
-    if line.strip() and not line.startswith('#'):
-      pattern = line.strip().format(**MatcherMacros)
-      LOG.info((idx, pattern))
-      matcher = Matcher(re.compile('^' + pattern + '$', re.I), str(idx+1))
-      if matcher not in Matchers:
-        Matchers.append(matcher)
+
+class StoreDatabase(peewee.SqliteDatabase):
+  """Applies the storage profile's pragmas to every new connection.
+
+  Interners are reset whenever a transaction or savepoint rolls back, as
+  the names they cached in it may be gone with it. Commits are timed into
+  metrics.COMMIT_SECONDS.
+  """
+
+  def __init__(self, *args, **kwargs):
+    self.profile = dict(DEFAULT_PROFILE)
+    self.interners = []
+    super(StoreDatabase, self).__init__(*args, **kwargs)
+
+  def initialize_connection(self, conn):
+    for pragma, value in sorted(self.profile['pragmas'].iteritems()):
+      conn.execute('PRAGMA %s = %s' % (pragma, value))
+    conn.create_function('message_key', 1, message_key)
+
+  def commit(self):
+    started = time.time()
+    super(StoreDatabase, self).commit()
+    metrics.COMMIT_SECONDS.observe(time.time() - started)
+
+  def rollback(self):
+    self.clear_interners()
+    super(StoreDatabase, self).rollback()
+
+  def savepoint(self, sid=None):
+    return _Savepoint(self, sid)
+
+  def clear_interners(self):
+    for interner in self.interners:
+      interner.clear()
+
+
+class _Savepoint(peewee.savepoint_sqlite):
+  """A savepoint that, like a whole transaction, resets the interners on
+  rollback; atomic() blocks nest as savepoints."""
+  __slots__ = ()
+
+  def rollback(self):
+    self.db.clear_interners()
+    super(_Savepoint, self).rollback()
+
+
+class EpochField(peewee.BigIntegerField):
+  """A UTC datetime, stored as whole seconds since the epoch."""
+
+  def db_value(self, value):
+    if isinstance(value, basestring):
+      return headers.parse_date(value)
+    if isinstance(value, datetime.datetime):
+      return calendar.timegm(value.utctimetuple())
+    return value
+
+  def python_value(self, value):
+    if isinstance(value, (int, long)):
+      return datetime.datetime.utcfromtimestamp(value)
+    return value
 
 
 peewee_lock = threading.RLock()
-peewee_db = peewee.SqliteDatabase('nntp.db', threadlocals=True)
+peewee_db = StoreDatabase(None, threadlocals=True)  # opened by open_db()
+
+
+def connect_read_only():
+  """Opens the calling thread's connection with writes refused by SQLite.
+
+  Connections are per thread, so a thread that only serves reads keeps
+  its own, and never takes the write lock the ingest writer needs.
+  """
+  if peewee_db.is_closed():
+    peewee_db.connect()
+  peewee_db.execute_sql('PRAGMA query_only = ON')
 
 
 class BaseModel(peewee.Model):
@@ -60,13 +491,128 @@ class BaseModel(peewee.Model):
     database = peewee_db
 
 
+class Interner(object):
+  """Ids of the names in a dictionary table, cached for every thread.
+
+  ids() adds the names not in the table yet; find() only looks them up,
+  for readers. The cache is simply dropped once it holds max_entries
+  names; the names worth caching come back first.
+  """
+
+  def __init__(self, model, max_entries=DEFAULT_INTERN_ENTRIES):
+    self.model = model
+    self.max_entries = max_entries
+    self.cache = {}
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+    peewee_db.interners.append(self)
+
+  def clear(self):
+    with self._lock:
+      self.cache.clear()
+
+  def _cached(self, names):
+    # Returns (found, missing); the caller holds the lock.
+    found = dict((name, self.cache[name]) for name in names
+                 if name in self.cache)
+    missing = [name for name in names if name not in found]
+    self.hits += len(found)
+    self.misses += len(missing)
+    if len(self.cache) + len(missing) > self.max_entries:
+      self.cache.clear()
+    return found, missing
+
+  def _select(self, names):
+    model = self.model
+    found = {}
+    for chunk in chunked(names):
+      q = model.select(model.name, model.id).where(model.name << chunk)
+      found.update(q.tuples())
+    self.cache.update(found)
+    return found
+
+  def ids(self, names):
+    """Returns {name: id} for names, adding those the table lacks."""
+    with self._lock:
+      found, missing = self._cached(set(names))
+      if missing:
+        _insert_ignore(self.model, [{'name': name} for name in missing])
+        found.update(self._select(missing))
+    return found
+
+  def find(self, names):
+    """Returns {name: id} for those of names already in the table."""
+    with self._lock:
+      found, missing = self._cached(set(names))
+      if missing:
+        found.update(self._select(missing))
+    return found
+
+
+class Poster(BaseModel):
+  """Distinct article posters, which articles refer to by id."""
+  id = peewee.PrimaryKeyField()
+  name = peewee.TextField(null=False, unique=True)
+
+  @classmethod
+  def names(cls, ids):
+    """Returns {id: name} for the poster ids."""
+    names = {}
+    for chunk in chunked(sorted(set(ids))):
+      names.update(cls.select(cls.id, cls.name).where(cls.id << chunk).tuples())
+    return names
+
+
+class Server(BaseModel):
+  """Distinct server names, which group indexes refer to by id."""
+  id = peewee.PrimaryKeyField()
+  name = peewee.TextField(null=False, unique=True)
+  listed = EpochField(null=True)  # when its full group list was last read
+
+  @classmethod
+  def listed_at(cls, name):
+    return cls.select(cls.listed).where(cls.name == name).scalar(convert=True)
+
+  @classmethod
+  def set_listed(cls, name, when):
+    SERVERS.ids([name])
+    cls.update(listed=when).where(cls.name == name).execute()
+
+
 class Article(BaseModel):
-  identifier = peewee.TextField(primary_key=True, null=False)
-  poster = peewee.TextField(null=False)
-  posted = peewee.DateTimeField(null=False)
+  id = peewee.PrimaryKeyField()
+  identifier = peewee.TextField(null=False)  # the message-id
+  identifier_hash = peewee.BigIntegerField(null=False, unique=True)  # message_key
+  poster = peewee.ForeignKeyField(Poster, null=False, related_name='articles')
+  posted = EpochField(null=False)
   subject = peewee.TextField(null=False)
   size = peewee.BigIntegerField(null=False, default=0)
 
+  class Meta:
+    indexes = (
+      (('posted', 'id'), False),  # newest first, keyset paged
+    )
+
+  @classmethod
+  def get_by_message_id(cls, message_id):
+    q = cls.select().where(cls.identifier_hash == message_key(message_id))
+    return q.where(cls.identifier == message_id).first()
+
+  @classmethod
+  def ids(cls, message_ids):
+    """Returns {message-id: article id} for the stored ones of message_ids."""
+    keys = dict((message_key(message_id), message_id)
+                for message_id in message_ids)
+    found = {}
+    for chunk in chunked(keys):
+      q = cls.select(cls.identifier_hash, cls.identifier, cls.id)
+      q = q.where(cls.identifier_hash << chunk)
+      for key, message_id, article_id in q.tuples():
+        if message_id == keys[key]:  # not another article's colliding hash
+          found[message_id] = article_id
+    return found
+
   @classmethod
   def unmatched(cls):
     unmatched = cls.select().join(Segment, peewee.JOIN.LEFT_OUTER)
@@ -74,19 +620,74 @@ class Article(BaseModel):
 
   @classmethod
   def addFromNNTP(cls, nntp_article):
-    #a_no, subject, poster, when, a_id, refs, size, lines = article
-    return Article.create_or_get(
-      subject=nntp_article[1],
-      poster=nntp_article[2],
-      posted=parser.parse(nntp_article[3]),
-      identifier=nntp_article[4],
-      size=int(nntp_article[6]))[0]
-
-  def addGroupIndex(self, name, number):
-    return GroupIndex.create_or_get(
-      name=name,
-      number=int(number),
-      article=self)[0]
+    # nntp_article is an nntp.Overview record
+    with peewee_db.atomic():
+      text = cls.subject.db_value
+      _count('articles', _insert_tuples(
+        cls, ('identifier', 'identifier_hash', 'subject', 'poster', 'posted',
+              'size'), [(
+          text(nntp_article.message_id), message_key(nntp_article.message_id),
+          text(nntp_article.subject),
+          POSTERS.ids([nntp_article.poster])[nntp_article.poster],
+          headers.parse_date(nntp_article.date), nntp_article.size)],
+        'IGNORE'))
+    return cls.get_by_message_id(nntp_article.message_id)
+
+  @classmethod
+  def search(cls, text, limit=20, offset=0):
+    """Articles whose subject matches text, best match first."""
+    query = fts_query(text)
+    if query is None:
+      return []
+    if not SEARCH:
+      q = cls.select().where(cls.subject.contains(text))
+      return list(q.limit(limit).offset(offset))
+    return list(cls.raw(
+      'SELECT article.* FROM article_search'
+      ' JOIN article ON article.rowid = article_search.rowid'
+      ' WHERE article_search MATCH ? ORDER BY article_search.rank'
+      ' LIMIT ? OFFSET ?', query, limit, offset))
+
+  @classmethod
+  def addBatchFromNNTP(cls, batch):
+    """Stores (server, group_name, nntp.Overview, segment_data) tuples.
+
+    Articles, group indexes and segments are each written with one
+    prepared INSERT OR IGNORE run over the batch, inside a single
+    transaction; group indexes and segments refer to articles by the ids
+    found for them afterwards, and posters, servers and groups are
+    interned. Returns the number of rows written.
+    """
+    batch = list(batch)
+    with peewee_db.atomic():
+      posters = POSTERS.ids(item[2].poster for item in batch)
+      servers = SERVERS.ids(item[0] for item in batch)
+      groups = GROUPS.ids(item[1] for item in batch)
+      text = cls.subject.db_value  # unicode, as peewee would store it
+      articles = [(
+        text(nntp_article.message_id),
+        message_key(nntp_article.message_id),
+        text(nntp_article.subject),
+        posters[nntp_article.poster],
+        headers.parse_date(nntp_article.date),
+        nntp_article.size,
+      ) for _, _, nntp_article, _ in batch]
+      _count('articles', _insert_tuples(
+        cls, ('identifier', 'identifier_hash', 'subject', 'poster', 'posted',
+              'size'), articles, 'IGNORE'))
+      ids = cls.ids(nntp_article.message_id for _, _, nntp_article, _ in batch)
+      indexes, segments = [], []
+      for server, group_name, nntp_article, segment_data in batch:
+        article_id = ids.get(nntp_article.message_id)
+        if article_id is None:  # a message_key collision; never stored
+          continue
+        indexes.append((servers[server], groups[group_name],
+                        nntp_article.number, article_id))
+        if segment_data:
+          segments.append(_segment_row(article_id, segment_data))
+      crossposts = GroupIndex.add(indexes)
+      Segment.add_rows(segments, crossposts)
+    return len(articles) + len(indexes) + len(segments)
 
   def getSegmentData(self):
     for matcher in Matchers:
@@ -95,32 +696,239 @@ class Article(BaseModel):
         yield match.groupdict()
 
   def addSegment(self, segment_data):
-    file_name = segment_data.get('file_name', '').strip()
-    return Segment.create_or_get(
-      article=self,
-      file_name=file_name,
-      release_name=segment_data.get('release_name', file_name),
-      file_total=int(segment_data.get('file_total', 0)),
-      file_number=int(segment_data.get('file_number', 0)),
-      part_total=int(segment_data.get('part_total', 0)),
-      part_number=int(segment_data.get('part_number', 0)))[0]
+    with peewee_db.atomic():
+      Segment.add_rows([_segment_row(self.id, segment_data)])
+    return Segment.get(Segment.article == self.id)
+
+
+class Group(BaseModel):
+  """A newsgroup known to the indexer; watched groups are synced.
+
+  Also the dictionary of group names that group indexes refer to by id.
+  """
+  id = peewee.PrimaryKeyField()
+  name = peewee.TextField(null=False, unique=True)
+  watch = peewee.BooleanField(null=False, default=False)
+
+  class Meta:
+    indexes = (
+      (('name', 'watch'), False),  # covers the /groups listing
+    )
+
+
+class Stat(BaseModel):
+  """Named counters, so totals never need a COUNT(*).
+
+  Kept by triggers, or once per batch by the writers of BATCH_COUNTERS.
+  """
+  name = peewee.TextField(primary_key=True, null=False)
+  value = peewee.BigIntegerField(null=False, default=0)
+
+  class Meta:
+    without_rowid = True
+
+  @classmethod
+  def get_value(cls, name):
+    return cls.select(cls.value).where(cls.name == name).scalar() or 0
+
+  @classmethod
+  def snapshot(cls):
+    return dict(cls.select(cls.name, cls.value).tuples())
 
 
 class GroupIndex(BaseModel):
-  server = peewee.TextField(null=False)
-  name = peewee.TextField(null=False)
+  server = peewee.ForeignKeyField(Server, null=False)
+  group = peewee.ForeignKeyField(Group, null=False)
   number = peewee.BigIntegerField(null=False)
-  article = peewee.ForeignKeyField(Article, null=False, related_name='group_indexes')
+  article = peewee.ForeignKeyField(Article, null=False, index=True,
+                                   related_name='group_indexes')
 
   class Meta:
-    primary_key = peewee.CompositeKey('server', 'name', 'number')
+    primary_key = peewee.CompositeKey('server', 'group', 'number')
+    without_rowid = True
+    indexes = (
+      (('group', 'number'), False),  # per group, whichever server
+    )
+
+  @classmethod
+  def add(cls, rows):
+    """Stores (server id, group id, number, article id) tuples.
+
+    Returns the article id of each (article, group) pair new to the store:
+    a crosspost adds one, the same article on a second server does not.
+    """
+    pairs = set((article_id, group_id) for _, group_id, _, article_id in rows)
+    conn = peewee_db.get_conn()
+    for chunk in chunked(set(article_id for article_id, _ in pairs)):
+      pairs.difference_update(conn.execute(
+        'SELECT article_id, group_id FROM groupindex WHERE article_id IN (%s)'
+        % ', '.join('?' * len(chunk)), chunk))
+    _insert_tuples(cls, ('server', 'group', 'number', 'article'), rows,
+                   'IGNORE')
+    return [article_id for article_id, _ in pairs]
+
+  @classmethod
+  def of(cls, server, name):
+    """The group indexes of group name, on server if that is not None."""
+    q = cls.select().join(Group).where(Group.name == name)
+    if server is not None:
+      q = q.switch(cls).join(Server).where(Server.name == server)
+    return q.switch(cls)
 
   @classmethod
   def last_for_group(cls, group_name):
-    q = cls.select().where(cls.name == group_name)
+    q = cls.of(None, group_name)
     return q.aggregate(peewee.fn.Max(cls.number))
 
 
+class Watermark(BaseModel):
+  """A group's article numbers on a server, as LIST ACTIVE last gave them.
+
+  Lets a sync plan from stored watermarks instead of a GROUP per group.
+  """
+  server = peewee.ForeignKeyField(Server, null=False)
+  group = peewee.ForeignKeyField(Group, null=False)
+  low = peewee.BigIntegerField(null=False)
+  high = peewee.BigIntegerField(null=False)
+  status = peewee.TextField(null=False, default='y')  # y, n, m, ...
+  updated = EpochField(null=False)
+
+  class Meta:
+    primary_key = peewee.CompositeKey('server', 'group')
+    without_rowid = True
+
+  @classmethod
+  def addBatchFromActive(cls, server, records, batch_size=DEFAULT_GROUP_BATCH):
+    """Stores nntp.Active records of server, batch_size per transaction.
+
+    records may be a generator still reading the list off the socket.
+    Groups new to the store are added unwatched. Returns the number of
+    records stored.
+    """
+    server_id = SERVERS.ids([server])[server]
+    records = iter(records)
+    stored = 0
+    while True:
+      batch = list(itertools.islice(records, batch_size))
+      if not batch:
+        break
+      updated = int(time.time())
+      # Prepared statements run per row: a full list has 100k+ groups, and
+      # building that many rows into peewee queries costs more than
+      # storing them.
+      with peewee_db.atomic():
+        conn = peewee_db.get_conn()
+        conn.executemany(
+          'INSERT OR IGNORE INTO "group" (name, watch) VALUES (?, 0)',
+          [(record.name,) for record in batch])
+        conn.executemany(
+          'INSERT OR REPLACE INTO watermark'
+          ' (server_id, group_id, low, high, status, updated)'
+          ' SELECT ?, id, ?, ?, ?, ? FROM "group" WHERE name = ?',
+          [(server_id, record.low, record.high, record.status, updated,
+            record.name) for record in batch])
+      stored += len(batch)
+    return stored
+
+  @classmethod
+  def fresh(cls, server, names, max_age):
+    """Returns {name: (low, high)} of the group names updated in max_age seconds."""
+    found = {}
+    since = int(time.time() - max_age)
+    for chunk in chunked(names):
+      q = cls.select(Group.name, cls.low, cls.high).join(Group)
+      q = q.switch(cls).join(Server).where(Server.name == server)
+      q = q.where(Group.name << chunk, cls.updated >= since)
+      found.update((name, (low, high)) for name, low, high in q.tuples())
+    return found
+
+
+class Coverage(BaseModel):
+  """Contiguous article number ranges already fetched for a server's group.
+
+  Ranges never overlap or touch; adding a span merges it with its
+  neighbours, so the table holds one row per hole-free run. Servers and
+  groups are interned, as they are for group indexes.
+  """
+  server = peewee.ForeignKeyField(Server, null=False)
+  group = peewee.ForeignKeyField(Group, null=False)
+  low = peewee.BigIntegerField(null=False)
+  high = peewee.BigIntegerField(null=False)
+
+  class Meta:
+    primary_key = peewee.CompositeKey('server', 'group', 'low')
+    without_rowid = True
+
+  @staticmethod
+  def _keys(server, name):
+    return SERVERS.ids([server])[server], GROUPS.ids([name])[name]
+
+  @classmethod
+  def ranges(cls, server, name):
+    # A read; names never stored have no coverage, and are not added.
+    server_id = SERVERS.find([server]).get(server)
+    group_id = GROUPS.find([name]).get(name)
+    if server_id is None or group_id is None:
+      return []
+    q = cls.select(cls.low, cls.high)
+    q = q.where(cls.server == server_id, cls.group == group_id)
+    return list(q.order_by(cls.low).tuples())
+
+  @classmethod
+  def add(cls, server, name, low, high):
+    low, high = min(low, high), max(low, high)
+    with peewee_db.atomic():
+      server_id, group_id = cls._keys(server, name)
+      q = cls.select(cls.low, cls.high)
+      q = q.where(cls.server == server_id, cls.group == group_id,
+                  cls.low <= high + 1, cls.high >= low - 1)
+      touching = list(q.tuples())
+      if touching:
+        low = min([low] + [r[0] for r in touching])
+        high = max([high] + [r[1] for r in touching])
+        cls.delete().where(cls.server == server_id, cls.group == group_id,
+                           cls.low << [r[0] for r in touching]).execute()
+      cls.insert(server=server_id, group=group_id, low=low, high=high).execute()
+
+  @classmethod
+  def bootstrap(cls, server, name):
+    """Builds coverage from GroupIndex rows stored before this table existed."""
+    q = GroupIndex.of(server, name).select(GroupIndex.number)
+    runs = []
+    for (number,) in q.order_by(GroupIndex.number).tuples().iterator():
+      if runs and number == runs[-1][1] + 1:
+        runs[-1][1] = number
+      else:
+        runs.append([number, number])
+    LOG.info('Bootstrapped %d coverage ranges for %s on %s',
+             len(runs), name, server)
+    with peewee_db.atomic():
+      server_id, group_id = cls._keys(server, name)
+      _insert_tuples(cls, ('server', 'group', 'low', 'high'), [
+        (server_id, group_id, low, high) for low, high in runs], 'IGNORE')
+
+  @classmethod
+  def missing(cls, server, name, first, last):
+    """Returns the (low, high) ranges within [first, last] not yet fetched."""
+    ranges = cls.ranges(server, name)
+    if not ranges and GroupIndex.of(server, name).exists():
+      cls.bootstrap(server, name)
+      ranges = cls.ranges(server, name)
+    gaps = []
+    cursor = first
+    for low, high in ranges:
+      if high < cursor:
+        continue
+      if low > last:
+        break
+      if low > cursor:
+        gaps.append((cursor, low - 1))
+      cursor = high + 1
+    if cursor <= last:
+      gaps.append((cursor, last))
+    return gaps
+
+
 class Segment(BaseModel):
   article = peewee.ForeignKeyField(Article, primary_key=True, null=False, related_name='segments')
   release_name = peewee.TextField(null=True)
@@ -130,6 +938,95 @@ class Segment(BaseModel):
   part_total = peewee.IntegerField(null=False, default=0)  # 0 is unknown
   part_number = peewee.IntegerField(null=False, default=0)  # 0 is unknown
 
+  class Meta:
+    indexes = (
+      (('release_name', 'file_name', 'part_number'), False),
+    )
+
+  @classmethod
+  def addBatch(cls, matches):
+    """Stores (article id, segment_data) pairs in one transaction."""
+    rows = [_segment_row(article_id, segment_data)
+            for article_id, segment_data in matches]
+    with peewee_db.atomic():
+      cls.add_rows(rows)
+    return len(rows)
+
+  @classmethod
+  def add_rows(cls, rows, crossposts=()):
+    """Stores _segment_row dicts, adding the new ones to File and Release.
+
+    Segments already stored are skipped. The others are added to their
+    File rows as deltas, a part counted only if no segment of its file
+    had its number yet, so no batch reads back the segments of earlier
+    ones. crossposts are article ids of (article, group) pairs just added,
+    as GroupIndex.add returns them; those of stored segments count
+    towards their files' postings. Returns the number of segments stored.
+    """
+    conn = peewee_db.get_conn()
+    crossposts = collections.Counter(crossposts)
+    stored = set()
+    for chunk in chunked(set(row['article'] for row in rows) |
+                         set(crossposts)):
+      stored.update(article_id for (article_id,) in conn.execute(
+        'SELECT article_id FROM segment WHERE article_id IN (%s)'
+        % ', '.join('?' * len(chunk)), chunk))
+    files = collections.OrderedDict()
+    for chunk in chunked(stored.intersection(crossposts)):
+      for article_id, release_name, file_name in conn.execute(
+          'SELECT article_id, release_name, file_name FROM segment'
+          ' WHERE article_id IN (%s)' % ', '.join('?' * len(chunk)), chunk):
+        summary = files.setdefault((release_name, file_name),
+                                   [0, 0, 0, 0, 0, None, 0])
+        summary[6] += crossposts[article_id]
+    new = []
+    for row in rows:
+      if row['article'] not in stored:
+        stored.add(row['article'])
+        new.append(row)
+    articles = {}
+    for chunk in chunked(row['article'] for row in new):
+      articles.update((article_id, (size, posted, 0))
+                      for article_id, size, posted in conn.execute(
+        'SELECT id, size, posted FROM article WHERE id IN (%s)'
+        % ', '.join('?' * len(chunk)), chunk))
+      for article_id, groups in conn.execute(
+          'SELECT article_id, COUNT(DISTINCT group_id) FROM groupindex'
+          ' WHERE article_id IN (%s) GROUP BY article_id'
+          % ', '.join('?' * len(chunk)), chunk):
+        articles[article_id] = articles[article_id][:2] + (groups,)
+    seen = set()
+    for row in new:
+      key = (row['release_name'], row['file_name'])
+      part = key + (row['part_number'],)
+      if part not in seen:
+        seen.add(part)
+        known = conn.execute(
+          'SELECT 1 FROM segment WHERE release_name = ? AND file_name = ?'
+          ' AND part_number = ? LIMIT 1', part).fetchone()
+        parts = 0 if known else 1
+      else:
+        parts = 0
+      size, posted, postings = articles[row['article']]
+      summary = files.get(key)
+      if summary is None:
+        files[key] = [row['file_number'], row['file_total'],
+                      row['part_total'], parts, size, posted, postings]
+      else:
+        summary[0] = max(summary[0], row['file_number'])
+        summary[1] = max(summary[1], row['file_total'])
+        summary[2] = max(summary[2], row['part_total'])
+        summary[3] += parts
+        summary[4] += size
+        summary[5] = posted if summary[5] is None else min(summary[5], posted)
+        summary[6] += postings
+    if not files:
+      return 0
+    _count('segments', _insert_ignore(cls, new))
+    File.add(key + tuple(summary) for key, summary in files.iteritems())
+    Release.refresh(name for name, _ in files)
+    return len(new)
+
   def __str__(self):
     segment_str = ' [%i/%i] (%i/%i) "%s">' % (
       self.file_name, self.file_number, self.file_total,
@@ -138,31 +1035,30 @@ class Segment(BaseModel):
 
   @classmethod
   def integrity_check(cls, release_name):
-    rel_q = cls.select(cls.file_name).where(cls.release_name == release_name)
-    rel_qo = rel_qo.order_by(cls.file_name, cls.part_number)
-    integrity = {}
-    for file_part_segment in rel_q.iterator():
-      fil_q = rel_q.where(cls.file_name == file_segment.file_name)
-      fil_qo = fil_q.order_by(cls.file_number, cls.part_number)
-      missing = set(xrange(1, q.get().part_total+1))
-      for part_segment in fil_qo.iterator():
-        missing.discard(part_segment.part_number)
-      if missing:
-        LOG.info('Missing parts for "%s": %s', file_segment.file_name)
-        return False
+    """True if every announced file of the release has all of its parts."""
+    release = Release.select().where(Release.name == release_name).first()
+    if release is None:
+      return False
+    intact = release.files >= release.file_total
+    if not intact:
+      LOG.info('Missing files for "%s": %d of %d', release_name,
+               release.files, release.file_total)
+    for file_summary in File.incomplete(release_name):
+      LOG.info('Missing parts for "%s": %d of %d', file_summary.file_name,
+               file_summary.parts, file_summary.part_total)
+      intact = False
+    return intact
 
   @classmethod
   def release_list(cls):
-    q = cls.select(cls.release_name)
-    q = q.group_by(cls.release_name)
-    q = q.order_by(cls.release_name)
-    return [i.release_name for i in q]
+    q = Release.select(Release.name).order_by(Release.name)
+    return [name for (name,) in q.tuples()]
 
   @classmethod
   def release_file_name_list(cls, release_name):
-    q = cls.select(cls.file_name)
-    q = q.where(cls.release_name == release_name)
-    q = q.order_by(cls.file_name)
+    q = File.select()
+    q = q.where(File.release_name == release_name)
+    q = q.order_by(File.file_number, File.file_name)
     return q
 
   @classmethod
@@ -175,8 +1071,8 @@ class Segment(BaseModel):
 
   @property
   def release_posted(self):
-    q = Segment.select().where(Segment.release_name == self.release_name).join(Article)
-    return q.aggregate(peewee.fn.Min(Article.posted))
+    q = Release.select(Release.posted)
+    return q.where(Release.name == self.release_name).scalar()
 
   @property
   def parts_missing(self):
@@ -185,7 +1081,256 @@ class Segment(BaseModel):
     return [n+1 for n in xrange(self.part_total) if n+1 not in parts]
 
 
-for table in (Article, GroupIndex, Segment):
+class File(BaseModel):
+  """One file of a release, summarised from its segments as they are stored."""
+  release_name = peewee.TextField(null=False)
+  file_name = peewee.TextField(null=False)
+  file_number = peewee.IntegerField(null=False, default=0)  # 0 is unknown
+  file_total = peewee.IntegerField(null=False, default=0)  # 0 is unknown
+  part_total = peewee.IntegerField(null=False, default=0)  # 0 is unknown
+  parts = peewee.IntegerField(null=False, default=0)  # distinct parts seen
+  size = peewee.BigIntegerField(null=False, default=0)
+  posted = EpochField(null=True)  # earliest part
+  postings = peewee.IntegerField(null=False, default=0)  # (article, group) pairs
+
+  class Meta:
+    primary_key = peewee.CompositeKey('release_name', 'file_name')
+    without_rowid = True
+
+  @property
+  def completion(self):
+    return _completion(self.parts, self.part_total)
+
+  @classmethod
+  def add(cls, rows):
+    """Adds (release_name, file_name, file_number, file_total, part_total,
+    parts, size, posted, postings) deltas of new segments to their files'
+    rows."""
+    peewee_db.get_conn().executemany(
+      'INSERT INTO file (release_name, file_name, file_number, file_total,'
+      ' part_total, parts, size, posted, postings)'
+      ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+      ' ON CONFLICT (release_name, file_name) DO UPDATE SET'
+      ' file_number = max(file_number, excluded.file_number),'
+      ' file_total = max(file_total, excluded.file_total),'
+      ' part_total = max(part_total, excluded.part_total),'
+      ' parts = parts + excluded.parts, size = size + excluded.size,'
+      ' posted = coalesce(min(posted, excluded.posted), posted,'
+      ' excluded.posted), postings = postings + excluded.postings',
+      list(rows))
+
+  @classmethod
+  def rebuild(cls, release_names):
+    """Recomputes the File rows of release_names from all of their segments."""
+    for chunk in chunked(sorted(set(release_names))):
+      q = Segment.select(
+        Segment.release_name, Segment.file_name,
+        peewee.fn.Max(Segment.file_number), peewee.fn.Max(Segment.file_total),
+        peewee.fn.Max(Segment.part_total),
+        peewee.fn.Count(peewee.fn.Distinct(Segment.part_number)),
+        peewee.fn.Sum(Article.size), peewee.fn.Min(Article.posted))
+      q = q.join(Article).where(Segment.release_name << chunk)
+      q = q.group_by(Segment.release_name, Segment.file_name)
+      postings = dict(((release_name, file_name), count)
+                      for release_name, file_name, count in
+                      peewee_db.execute_sql(
+        'SELECT release_name, file_name, COUNT(*) FROM (SELECT DISTINCT'
+        ' segment.release_name, segment.file_name, groupindex.article_id,'
+        ' groupindex.group_id FROM segment JOIN groupindex'
+        ' ON groupindex.article_id = segment.article_id'
+        ' WHERE segment.release_name IN (%s)) GROUP BY release_name, file_name'
+        % ', '.join('?' * len(chunk)), chunk))
+      _insert_replace(cls, [{
+        'release_name': release_name,
+        'file_name': file_name,
+        'file_number': file_number,
+        'file_total': file_total,
+        'part_total': part_total,
+        'parts': parts,
+        'size': size or 0,
+        'posted': posted,
+        'postings': postings.get((release_name, file_name), 0),
+      } for (release_name, file_name, file_number, file_total, part_total,
+             parts, size, posted) in q.tuples()])
+
+  @classmethod
+  def incomplete(cls, release_name):
+    q = cls.select().where(cls.release_name == release_name)
+    q = q.where((cls.part_total == 0) | (cls.parts < cls.part_total))
+    return q.order_by(cls.file_number, cls.file_name)
+
+
+class Release(BaseModel):
+  """Per release totals, kept current as segments are stored.
+
+  completion is the percentage of announced parts seen, scaled down when
+  fewer files than announced have shown up at all.
+  """
+  name = peewee.TextField(primary_key=True, null=False)
+  file_total = peewee.IntegerField(null=False, default=0)  # 0 is unknown
+  files = peewee.IntegerField(null=False, default=0)  # files seen
+  part_total = peewee.IntegerField(null=False, default=0)  # of files seen
+  parts = peewee.IntegerField(null=False, default=0)  # distinct parts seen
+  size = peewee.BigIntegerField(null=False, default=0)
+  completion = peewee.FloatField(null=False, default=0)
+  posted = EpochField(null=True)  # earliest part
+  file_names = peewee.TextField(null=False, default='')  # for release_search
+  postings = peewee.IntegerField(null=False, default=0)  # (article, group) pairs
+
+  class Meta:
+    indexes = (
+      (('posted', 'name'), False),
+      (('completion', 'name'), False),
+    )
+
+  @classmethod
+  def refresh(cls, release_names):
+    """Recomputes the Release rows of release_names from their File rows.
+
+    A release has a row per file, not per segment, so this costs the same
+    however many segments the releases have. Only rows that changed are
+    rewritten, so the generation moves only when a release does.
+    """
+    fields = cls._meta.sorted_fields
+    names = set(name for name in release_names if name is not None)
+    for chunk in chunked(sorted(names)):
+      q = File.select(
+        File.release_name, peewee.fn.Max(File.file_total),
+        peewee.fn.Count(File.file_name), peewee.fn.Sum(File.part_total),
+        peewee.fn.Sum(File.parts), peewee.fn.Sum(File.size),
+        peewee.fn.Min(File.posted), peewee.fn.group_concat(File.file_name, ' '),
+        peewee.fn.Sum(File.postings))
+      q = q.where(File.release_name << chunk).group_by(File.release_name)
+      rows = []
+      for (name, file_total, files, part_total, parts, size, posted,
+           file_names, postings) in q.tuples():
+        completion = _completion(parts, part_total)
+        if file_total > files:
+          completion *= float(files) / file_total
+        rows.append({
+          'name': name,
+          'file_total': file_total,
+          'files': files,
+          'part_total': part_total,
+          'parts': parts,
+          'size': size or 0,
+          'completion': completion,
+          'posted': posted,
+          'file_names': file_names or '',
+          'postings': postings or 0,
+        })
+      stored = dict((row[0], row) for row in peewee_db.execute_sql(
+        'SELECT %s FROM "release" WHERE name IN (%s)' % (
+          ', '.join('"%s"' % field.db_column for field in fields),
+          ', '.join('?' * len(chunk))), chunk))
+      changed = [row for row in rows if stored.pop(row['name'], None) !=
+                 tuple(field.db_value(row[field.name]) for field in fields)]
+      # Deleted and inserted rather than replaced: REPLACE would drop the
+      # old rows without firing the triggers that maintain release_search.
+      stale = [row['name'] for row in changed] + list(stored)
+      if stale:
+        cls.delete().where(cls.name << stale).execute()
+      _insert_ignore(cls, changed)
+
+  @classmethod
+  def search(cls, text, limit=20, offset=0):
+    """Releases whose name or file names match text, best match first.
+
+    A hit in the release name weighs ten times one in its file names.
+    """
+    query = fts_query(text)
+    if query is None:
+      return []
+    if not SEARCH:
+      q = cls.select().where(cls.name.contains(text) |
+                             cls.file_names.contains(text))
+      return list(q.order_by(cls.posted.desc()).limit(limit).offset(offset))
+    return list(cls.raw(
+      'SELECT "release".* FROM release_search'
+      ' JOIN "release" ON "release".rowid = release_search.rowid'
+      ' WHERE release_search MATCH ?'
+      ' ORDER BY bm25(release_search, 10.0, 1.0) LIMIT ? OFFSET ?',
+      query, limit, offset))
+
+  @classmethod
+  def rebuild(cls, chunk_size=500):
+    """Refreshes every release, e.g. for segments stored before this table."""
+    q = Segment.select(Segment.release_name).distinct()
+    names = [name for (name,) in q.tuples()]
+    for chunk in chunked(names, chunk_size):
+      with peewee_db.atomic():
+        File.rebuild(chunk)
+        cls.refresh(chunk)
+    LOG.info('Rebuilt %d releases', len(names))
+    return len(names)
+
+  @classmethod
+  def complete(cls, minimum=100.0):
+    q = cls.select().where(cls.completion >= minimum)
+    return q.order_by(cls.posted.desc())
+
+
+POSTERS = Interner(Poster)
+SERVERS = Interner(Server)
+GROUPS = Interner(Group)
+
+
+def open_db(profile=None):
+  """Opens the store described by profile (see DEFAULT_PROFILE).
+
+  Creates or migrates the tables, indexes and triggers as needed; call
+  once per process, before any thread uses a model.
+  """
+  global SEARCH
+  settings = dict(DEFAULT_PROFILE)
+  settings.update(profile or {})
+  settings['pragmas'] = dict(DEFAULT_PROFILE['pragmas'],
+                             **settings.get('pragmas') or {})
+  peewee_db.profile = settings
+  for interner in peewee_db.interners:
+    interner.clear()
+  peewee_db.init(settings['path'], timeout=settings['busy_timeout'])
   peewee_db.connect()
-  table.create_table(fail_silently=True)
+  models = (Poster, Server, Group, Article, Stat, GroupIndex, Watermark,
+            Coverage, Segment, File, Release)
+  # Files stored before postings were counted are summarised again.
+  file_columns = _table_columns('file')
+  recount = file_columns and 'postings' not in file_columns
+  _migrate(models)
+  for table in models:
+    _create_table(table)
+    _ensure_columns(table)
+    _ensure_indexes(table)
+  SEARCH = _ensure_search()
+  _ensure_counters()
+  if recount:
+    LOG.info('Counting the postings of stored releases')
+    Release.rebuild()
+
+
+def maintain():
+  """Checkpoints the WAL and refreshes the query planner's statistics.
+
+  The checkpoint is passive, so it never waits on readers; ANALYZE samples
+  a bounded number of rows per index, so it stays cheap on large tables.
+  """
+  started = time.time()
+  busy, wal_pages, moved = peewee_db.execute_sql(
+    'PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+  peewee_db.execute_sql('PRAGMA analysis_limit = %d' % ANALYSIS_LIMIT)
+  peewee_db.execute_sql('ANALYZE')
+  LOG.info('Checkpointed %d of %d WAL pages%s, analyzed in %.2fs', moved,
+           wal_pages, ' (busy)' if busy else '', time.time() - started)
+
+
+def MaintenanceWorker(exit_event, interval=None):
+  """Runs maintain() every interval seconds until exit_event is set."""
+  interval = interval or peewee_db.profile['maintenance_interval']
+  while not exit_event.wait(interval):
+    try:
+      maintain()
+    except peewee.OperationalError as err:  # e.g. locked past busy_timeout
+      LOG.warn('Maintenance skipped: %s', err)
+  if not peewee_db.is_closed():
+    peewee_db.close()
   
\ No newline at end of file
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+"""Tests of subject clustering and template suggestion in clusters.py."""
+
+import unittest
+
+import clusters
+import fakenntp
+
+FILES = 3
+PARTS = 7
+RELEASES = 20
+SUBJECT = 'Some.Show.S01E01 - [%d/3] - "some.show.part%02d.rar" yEnc (%d/40)'
+TEMPLATE = (r'{release} {seperator} \[{files}\] {seperator} "{file_name}" '
+            r'yEnc \({parts}\)')
+
+
+def release_subjects():
+  return [SUBJECT % (file_number, file_number, part)
+          for file_number in (1, 2) for part in (1, 2, 3)]
+
+
+class TokenizeTest(unittest.TestCase):
+
+  def test_tokens(self):
+    self.assertEqual(
+      clusters.tokenize('Some.Show - "a b.rar" (1/20)'),
+      ['Some', '.', 'Show', ' ', '-', ' ', '"a b.rar"', ' ', '(', '1', '/',
+       '20', ')'])
+
+
+class ClusterTest(unittest.TestCase):
+
+  def test_posts_of_a_release_share_a_cluster(self):
+    analyzer = clusters.SubjectClusters().add_all(release_subjects())
+    self.assertEqual(len(analyzer.clusters), 1)
+    cluster = analyzer.largest()[0]
+    self.assertEqual(cluster.count, 6)
+    self.assertEqual(cluster.samples, release_subjects()[:5])
+    self.assertEqual(cluster.pattern(),
+                     'Some.Show.S01E01 - [*/3] - * yEnc (*/40)')
+
+  def test_suggest(self):
+    cluster = clusters.SubjectClusters().add_all(
+      release_subjects()).largest()[0]
+    self.assertEqual(cluster.suggest(), TEMPLATE)
+    self.assertEqual(cluster.release_name(TEMPLATE), 'Some.Show.S01E01')
+    self.assertEqual(cluster.as_dict()['release_name'], 'Some.Show.S01E01')
+
+  def test_no_counter_no_template(self):
+    analyzer = clusters.SubjectClusters().add_all(
+      ['Re: anyone have it?', 'hello world'])
+    self.assertEqual([cluster.suggest() for cluster in analyzer.largest()],
+                     [None, None])
+    self.assertEqual(analyzer.releases(), [])
+    self.assertEqual(analyzer.suggestions(), [])
+
+  def test_max_clusters(self):
+    analyzer = clusters.SubjectClusters(max_clusters=1).add_all(
+      ['a (1/2)', 'b (1/2)', 'a (2/2)'])
+    self.assertEqual((analyzer.subjects, analyzer.unclustered), (3, 1))
+    self.assertEqual(analyzer.largest()[0].count, 2)
+
+  def test_releases_and_suggestions(self):
+    analyzer = clusters.SubjectClusters().add_all(
+      release_subjects() + [subject.replace('Some.Show', 'Other.Show')
+                            for subject in release_subjects()[:2]])
+    self.assertEqual(
+      [(release['release_name'], release['count'])
+       for release in analyzer.releases()],
+      [('Some.Show.S01E01', 6), ('Other.Show.S01E01', 2)])
+    suggestions = analyzer.suggestions()
+    self.assertEqual(len(suggestions), 1)
+    self.assertEqual((suggestions[0]['template'], suggestions[0]['clusters'],
+                      suggestions[0]['count']), (TEMPLATE, 2, 8))
+
+
+class SyntheticGroupTest(unittest.TestCase):
+
+  def setUp(self):
+    self.group = fakenntp.SyntheticGroup(
+      'alt.binaries.test', articles=FILES * PARTS * RELEASES, files=FILES,
+      parts=PARTS, noise=0)
+    self.analyzer = clusters.SubjectClusters().add_all(
+      self.group.subject(number)
+      for number in xrange(1, FILES * PARTS * RELEASES + 1))
+
+  def test_a_cluster_per_release(self):
+    self.assertEqual(len(self.analyzer.clusters), RELEASES)
+    self.assertEqual([cluster.count for cluster in self.analyzer.largest()],
+                     [FILES * PARTS] * RELEASES)
+
+  def test_templates_match_their_samples(self):
+    names = [self.group.release(index)[0] for index in xrange(RELEASES)]
+    for cluster in self.analyzer.largest():
+      template = cluster.suggest()
+      if template is None:
+        continue
+      compiled = clusters.compile_template(template)
+      for subject in cluster.samples:
+        self.assertTrue(compiled.match(subject).group('file_name'), subject)
+      name = cluster.release_name(template)
+      if name is not None:  # not every template has a {release}
+        self.assertTrue(any(name.startswith(known) for known in names), name)
+    self.assertTrue(self.analyzer.releases())
+
+
+if __name__ == '__main__':
+  unittest.main()
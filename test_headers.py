@@ -0,0 +1,47 @@
+#!/usr/bin/python
+"""Tests of the overview header parsing in headers.py."""
+
+import unittest
+
+import headers
+import nntp
+import store
+import test_store
+
+
+class ParseDateTest(unittest.TestCase):
+
+  def test_rfc5322(self):
+    self.assertEqual(headers.parse_date('Thu, 01 Jan 1970 00:01:00 +0000'), 60)
+
+  def test_zone_offset(self):
+    self.assertEqual(headers.parse_date('Thu, 01 Jan 1970 01:01:00 +0100'), 60)
+
+  def test_garbage_is_epoch(self):
+    for value in ('not a date', '', 'Sun, 99 Foo 99999999999 99:99:99'):
+      self.assertEqual(headers.parse_date(value), 0)
+
+
+class StoreGarbageDateTest(test_store.StoreTest):
+
+  def test_batch_is_stored(self):
+    batch = [
+      ('news.example.com', 'alt.binaries.test',
+       nntp.Overview(1, 'good', 'poster@example.com',
+                     'Thu, 01 Jan 1970 00:01:00 +0000', '<1@example>', 10),
+       None),
+      ('news.example.com', 'alt.binaries.test',
+       nntp.Overview(2, 'bad', 'poster@example.com', 'not a date',
+                     '<2@example>', 10),
+       None),
+    ]
+    store.Article.addBatchFromNNTP(batch)
+    posted = dict(store.Article.select(store.Article.identifier,
+                                       store.Article.posted).tuples())
+    self.assertEqual(sorted(posted), ['<1@example>', '<2@example>'])
+    self.assertEqual(store.Article.get_by_message_id('<2@example>').posted,
+                     store.datetime.datetime.utcfromtimestamp(0))
+
+
+if __name__ == '__main__':
+  unittest.main()
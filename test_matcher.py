@@ -0,0 +1,102 @@
+#!/usr/bin/python
+"""Tests of the subject matcher engine in matcher.py."""
+
+import os
+import unittest
+
+import fakenntp
+import matcher
+
+REGEXP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'regexp.txt')
+# Templates whose matches depend on the digits themselves, not just on
+# where the digit runs are, and subjects telling them apart.
+DIGIT_TEMPLATES = (
+  r'(?P<file_name>.+) part\d',
+  r'(?P<file_name>.+) file[0-9]x',
+  r'(?P<file_name>.+) x[13]+y',
+  r'(?P<file_name>.+) a.b',
+)
+DIGIT_SUBJECTS = (
+  'some.file part1', 'some.file part12', 'some.file file3x',
+  'some.file file34x', 'some.file x13y', 'some.file x19y', 'some.file a1b',
+  'some.file a12b',
+)
+
+
+def sequential(engine, subject):
+  """The groupdict of the first template matching subject, tried in order."""
+  for template in engine.matchers:
+    match = template.pattern.match(subject)
+    if match:
+      return match.groupdict()
+  return None
+
+
+def subjects():
+  """fakenntp subjects in every style of regexp.txt, and DIGIT_SUBJECTS."""
+  group = fakenntp.SyntheticGroup(
+    'alt.binaries.test', articles=2000, files=3, parts=7,
+    styles=fakenntp.subject_styles(REGEXP_FILE))
+  return ([group.subject(number) for number in xrange(1, 2001)] +
+          list(DIGIT_SUBJECTS))
+
+
+class RequiredAnchorsTest(unittest.TestCase):
+
+  def test_digit_sensitive(self):
+    for pattern in (r'part\d', r'file[0-9]', r'x[13]+y', r'a.b', r'\w',
+                    r'[\d.]', r'[^"]', r'\d{2}', r'\d?', r'part1'):
+      self.assertTrue(matcher.required_anchors(pattern)[1], pattern)
+
+  def test_digit_runs(self):
+    for pattern in (r'part\d+', r'[\d.]+', r'[^"]+', r'.+?', r'\w*', r'\D',
+                    r'[a-z]', r'\s'):
+      self.assertFalse(matcher.required_anchors(pattern)[1], pattern)
+
+  def test_anchors(self):
+    self.assertEqual(matcher.required_anchors(r'"x" \[\d+\] \((a|b)\)'),
+                     (4 | 8 | 16, False))
+
+
+class MatcherEngineTest(unittest.TestCase):
+
+  def check(self, engine):
+    for subject in subjects() * 2:  # the second pass hits the memo
+      self.assertEqual(engine.match(subject), sequential(engine, subject),
+                       subject)
+
+  def test_regexp_file(self):
+    engine = matcher.MatcherEngine()
+    engine.load(open(REGEXP_FILE, 'rb'))
+    self.check(engine)
+    self.assertTrue(engine.shape_hits)
+
+  def test_digit_templates(self):
+    for template in DIGIT_TEMPLATES:
+      engine = matcher.MatcherEngine()
+      engine.load([template])
+      engine.load(open(REGEXP_FILE, 'rb'))
+      self.check(engine)
+      self.assertEqual(engine.shape_hits, 0, template)
+
+
+class SubjectParserTest(unittest.TestCase):
+
+  def test_processes_match_in_thread(self):
+    # processes=0 matches with this process' engine, as run.py loads it.
+    matcher.LoadMatchers(open(REGEXP_FILE, 'rb'))
+    results = []
+    for processes in (0, 2):
+      parser = matcher.SubjectParser(REGEXP_FILE, processes, chunk_size=300)
+      try:
+        results.append(parser.match(subjects()))
+      finally:
+        parser.close()
+    self.assertEqual(len(results[0]), len(subjects()))
+    self.assertTrue(any(results[0]))
+    self.assertEqual(results[1], results[0])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,207 @@
+#!/usr/bin/python
+"""Tests of the NNTP client in nntp.py, against fakenntp."""
+
+import nntplib
+import os
+import threading
+import time
+import unittest
+
+import fakenntp
+import nntp
+
+REGEXP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'regexp.txt')
+GROUP = fakenntp.DEFAULT_GROUPS[0]
+ARTICLES = 1000
+
+
+class FakeServerTest(unittest.TestCase):
+  """Serves ARTICLES synthetic articles in GROUP for each test."""
+  server_options = {}
+
+  def setUp(self):
+    self.server = fakenntp.serve(articles=ARTICLES, regexp_file=REGEXP_FILE,
+                                 **self.server_options)
+    self.clients = []
+
+  def tearDown(self):
+    for client in self.clients:
+      client.close()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def client(self, **kwargs):
+    client = nntp.NNTP('127.0.0.1', self.server.server_address[1],
+                       usenetrc=False, **kwargs)
+    self.clients.append(client)
+    return client
+
+  def overview(self, client, start=1, end=ARTICLES):
+    with client:
+      return list(client.xover_span(GROUP, start, end))
+
+
+class PoolTest(FakeServerTest):
+
+  def stats(self, client):
+    stats = client.pool_stats()
+    return dict((name, stats[name])
+                for name in ('hits', 'connects', 'discarded', 'idle'))
+
+  def test_checkout_reuses_released_connection(self):
+    client = self.client()
+    with client:
+      self.assertEqual(self.stats(client),
+                       {'hits': 0, 'connects': 1, 'discarded': 0, 'idle': 0})
+      client.date()
+    self.assertEqual(client.pool_stats()['idle'], 1)
+    with client:
+      client.date()
+    self.assertEqual(self.stats(client),
+                     {'hits': 1, 'connects': 1, 'discarded': 0, 'idle': 1})
+
+  def test_concurrent_checkouts_connect_each(self):
+    client = self.client(max_connections=2)
+    inside = threading.Event()
+    leave = threading.Event()
+    def hold():
+      with client:
+        inside.set()
+        leave.wait(10)
+    thread = threading.Thread(target=hold)
+    thread.start()
+    inside.wait(10)
+    with client:
+      client.date()
+    leave.set()
+    thread.join()
+    self.assertEqual(self.stats(client),
+                     {'hits': 0, 'connects': 2, 'discarded': 0, 'idle': 2})
+
+  def test_recoverable_error_keeps_connection(self):
+    client = self.client()
+    with self.assertRaises(nntplib.NNTPTemporaryError):
+      with client:
+        client.group('alt.binaries.missing')
+    with client:
+      client.date()
+    self.assertEqual(self.stats(client),
+                     {'hits': 1, 'connects': 1, 'discarded': 0, 'idle': 1})
+
+  def test_other_error_drops_connection(self):
+    client = self.client()
+    with self.assertRaises(ValueError):
+      with client:
+        raise ValueError('injected')
+    self.assertEqual(self.stats(client),
+                     {'hits': 0, 'connects': 1, 'discarded': 1, 'idle': 0})
+    with client:
+      client.date()
+    self.assertEqual(self.stats(client),
+                     {'hits': 0, 'connects': 2, 'discarded': 1, 'idle': 1})
+
+  def test_expired_connection_is_replaced(self):
+    client = self.client(pool_max_idle=0.01)
+    with client:
+      client.date()
+    time.sleep(0.05)
+    with client:
+      client.date()
+    self.assertEqual(self.stats(client),
+                     {'hits': 0, 'connects': 2, 'discarded': 1, 'idle': 1})
+    self.assertEqual(client.pool_stats()['reconnects'], 1)
+
+
+class PipelineTest(FakeServerTest):
+
+  def test_responses_in_order(self):
+    plain = self.overview(self.client(xover_span=ARTICLES))
+    client = self.client(xover_span=37, xover_pipeline=4)
+    spans = []
+    with client:
+      records = list(client.xover_span(
+        GROUP, 1, ARTICLES, lambda low, high: spans.append((low, high))))
+    self.assertEqual(records, plain)
+    self.assertEqual([record.number for record in records],
+                     range(1, ARTICLES + 1))
+    self.assertEqual(spans, client.span_ranges(1, ARTICLES))
+
+  def test_descending_spans(self):
+    client = self.client(xover_span=37, xover_pipeline=4)
+    with client:
+      records = list(client.xover_span(GROUP, ARTICLES, 1))
+    self.assertEqual([record.number for record in records],
+                     [number for low, high in client.span_ranges(ARTICLES, 1)
+                      for number in xrange(low, high + 1)])
+
+  def test_interrupted_pipeline_drops_connection(self):
+    client = self.client(xover_span=37, xover_pipeline=4)
+    with client:
+      records = client.xover_span(GROUP, 1, ARTICLES)
+      next(records)
+      records.close()
+      self.assertTrue(client.connection.broken)
+      with self.assertRaises(nntplib.NNTPError):
+        next(client.xover_span(GROUP, 1, 10))
+    stats = client.pool_stats()
+    self.assertEqual((stats['discarded'], stats['idle']), (1, 0))
+    self.assertEqual(len(self.overview(client)), ARTICLES)
+
+
+class CompressionTest(FakeServerTest):
+  server_options = {'gzip': True, 'xzver': True}
+
+  def setUp(self):
+    super(CompressionTest, self).setUp()
+    self.plain = self.overview(self.client(xover_span=ARTICLES))
+    self.assertEqual(len(self.plain), ARTICLES)
+
+  def test_single_span(self):
+    for compression in ('xzver', 'gzip'):
+      client = self.client(compression=compression, xover_span=ARTICLES)
+      self.assertEqual(self.overview(client), self.plain, compression)
+
+  def test_pipelined_spans(self):
+    # Every compressed block but the last is followed on the wire by the
+    # next response, which must be left for the next read.
+    for compression in ('xzver', 'gzip'):
+      client = self.client(compression=compression, xover_span=37,
+                           xover_pipeline=4)
+      self.assertEqual(self.overview(client), self.plain, compression)
+      with client:
+        self.assertEqual(client.connection.overview,
+                         {'xzver': nntp.OVER_XZVER,
+                          'gzip': nntp.OVER_GZIP}[compression])
+        self.assertEqual(client.date()[0][:3], '111')
+
+  def test_auto_prefers_xzver(self):
+    client = self.client(compression='auto', xover_span=100)
+    self.assertEqual(self.overview(client), self.plain)
+    with client:
+      self.assertEqual(client.connection.overview, nntp.OVER_XZVER)
+
+
+class XZVERFallbackTest(FakeServerTest):
+
+  def test_plain_server(self):
+    plain = self.overview(self.client(xover_span=100))
+    client = self.client(compression='xzver', xover_span=100,
+                         xover_pipeline=4)
+    self.assertEqual(self.overview(client), plain)
+    with client:
+      self.assertEqual(client.connection.overview, nntp.OVER_PLAIN)
+
+
+class YEncTest(unittest.TestCase):
+
+  def test_round_trip(self):
+    data = ''.join(chr(code) for code in xrange(256)) * 3 + '.\r\n..'
+    lines = fakenntp.yenc_encode(data, line_length=50)
+    unstuffed = [line[1:] if line[:2] == '..' else line for line in lines]
+    self.assertEqual(''.join(nntp.yenc_decode(line) for line in unstuffed),
+                     data)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+"""Tests of NZB export and its on-disk cache."""
+
+import cStringIO
+import os
+import threading
+import unittest
+
+import nntp
+import nzb
+import store
+import test_store
+
+
+class _Output(object):
+  def __init__(self, outputs, name):
+    self.out = cStringIO.StringIO()
+    self.write = self.out.write
+    self.outputs = outputs
+    self.name = name
+
+  def close(self):
+    self.outputs[self.name] = self.out.getvalue()
+
+
+class NZBTest(test_store.StoreTest):
+
+  def store(self, group, parts):
+    store.Article.addBatchFromNNTP(
+      ('news.example.com', group, nntp.Overview(
+        number, 'subject %d' % number, 'poster@example.com',
+        'Thu, 01 Jan 1970 00:%02d:00 +0000' % number,
+        '<%d@example>' % number, 100),
+       {'release_name': 'Some.Release', 'file_name': 'file.rar',
+        'part_number': part, 'part_total': 3})
+      for number, part in parts)
+
+  def export(self):
+    outputs = {}
+    nzb.write_releases(['Some.Release'],
+                       lambda name: _Output(outputs, name))
+    return outputs['Some.Release']
+
+  def test_unnumbered_parts_are_kept(self):
+    self.store('alt.test', [(1, 2), (2, 0), (3, 0), (4, 2)])
+    document = self.export()
+    self.assertIn('number="2">1@example<', document)
+    self.assertIn('number="3">2@example<', document)
+    self.assertIn('number="4">3@example<', document)
+    self.assertNotIn('4@example', document)  # a repost of part 2
+
+  def test_cache_sees_new_groups(self):
+    self.store('alt.test', [(1, 1), (2, 2)])
+    cache = nzb.NZBCache(os.path.join(self.directory, 'nzb'), stale_age=0)
+    first = cache.get('Some.Release')
+    self.assertEqual(cache.get('Some.Release'), first)
+    self.store('alt.other', [(1, 1)])  # the same article, crossposted
+    self.store('alt.other', [(1, 1)])  # and seen again
+    self.assertEqual(store.Release.get().postings, 3)
+    second = cache.get('Some.Release')
+    self.assertNotEqual(second, first)
+    self.assertFalse(os.path.exists(first))
+    self.assertIn('<group>alt.other</group>', open(second).read())
+    self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+  def test_stale_files_outlive_their_readers(self):
+    self.store('alt.test', [(1, 1), (2, 2)])
+    cache = nzb.NZBCache(os.path.join(self.directory, 'nzb'))
+    first = cache.get('Some.Release')
+    self.store('alt.test', [(3, 3)])
+    self.assertNotEqual(cache.get('Some.Release'), first)
+    self.assertTrue(os.path.exists(first))
+
+  def test_concurrent_gets_build_once(self):
+    self.store('alt.test', [(1, 1), (2, 2)])
+    cache = nzb.NZBCache(os.path.join(self.directory, 'nzb'))
+    paths = []
+    def get():
+      store.peewee_db.connect()
+      paths.append(cache.get('Some.Release'))
+      store.peewee_db.close()
+    threads = [threading.Thread(target=get) for _ in xrange(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(len(set(paths)), 1)
+    self.assertEqual(cache.misses, 1)
+    self.assertEqual(cache._locks, {})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+"""Tests of the threaded sync pipeline in run.py, against fakenntp."""
+
+import collections
+import os
+import threading
+import unittest
+
+import fakenntp
+import run
+import scheduler
+import store
+import test_store
+
+try:
+  import aionntp
+except ImportError:  # trollius is only needed for the asyncio engine
+  aionntp = None
+
+REGEXP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'regexp.txt')
+GROUP = fakenntp.DEFAULT_GROUPS[0]
+
+
+class SyncTest(test_store.StoreTest):
+
+  def setUp(self):
+    super(SyncTest, self).setUp()
+    store.LoadMatchers(open(REGEXP_FILE, 'rb'))
+    self.server = fakenntp.serve(articles=2000, regexp_file=REGEXP_FILE)
+    self.config = {
+      'servers': [{'host': '127.0.0.1',
+                   'port': self.server.server_address[1],
+                   'connections': 2, 'xover_span': 100, 'backbone': 'fake'}],
+      'groups': [GROUP],
+      'regexp_file': REGEXP_FILE,
+      'parse_processes': 0,
+      'batch_size': 100,
+      'queue_items': 200,
+    }
+    self.store_batch = run._store_batch
+
+  def tearDown(self):
+    run._store_batch = self.store_batch
+    self.server.shutdown()
+    self.server.server_close()
+    super(SyncTest, self).tearDown()
+
+  def sync(self):
+    exit_event = threading.Event()
+    outcome = []
+    def target():
+      try:
+        run.sync(exit_event, self.config)
+        outcome.append(None)
+      except Exception as err:
+        outcome.append(err)
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    thread.join(60)
+    self.assertFalse(thread.is_alive(), 'sync did not finish')
+    return exit_event, outcome[0]
+
+  def test_sync(self):
+    exit_event, error = self.sync()
+    self.assertIsNone(error)
+    self.assertFalse(exit_event.is_set())
+    self.assertEqual(store.Coverage.ranges('fake', GROUP), [(1, 2000)])
+
+  def test_failed_batch_stops_sync(self):
+    batches = []
+    def failing(batch, spans, segment_data):
+      batches.append(len(batch))
+      if len(batches) == 2:
+        raise ValueError('injected')
+      return self.store_batch(batch, spans, segment_data)
+    run._store_batch = failing
+    exit_event, error = self.sync()
+    self.assertIsInstance(error, ValueError)
+    self.assertTrue(exit_event.is_set())
+    self.assertEqual(len(batches), 2)
+
+  def test_no_groups(self):
+    self.config['groups'] = []
+    exit_event, error = self.sync()
+    self.assertIsNone(error)
+
+
+class GroupsTest(unittest.TestCase):
+
+  def test_full_argument(self):
+    config = {'servers': [{'host': '127.0.0.1', 'backbone': 'fake'}]}
+    calls = []
+    refresh = run.RefreshGroups
+    run.RefreshGroups = lambda server, full=False: calls.append(full)
+    try:
+      run.groups(threading.Event(), config)
+      run.groups(threading.Event(), config, 'full')
+    finally:
+      run.RefreshGroups = refresh
+    self.assertEqual(calls, [False, True])
+
+
+@unittest.skipIf(aionntp is None, 'trollius is not installed')
+class AsyncSyncTest(SyncTest):
+  """The same sync, run by the asyncio engine in aionntp.py."""
+
+  def setUp(self):
+    super(AsyncSyncTest, self).setUp()
+    self.config['engine'] = 'asyncio'
+    self.store = aionntp._store
+
+  def tearDown(self):
+    aionntp._store = self.store
+    super(AsyncSyncTest, self).tearDown()
+
+  def test_failed_batch_stops_sync(self):
+    batches = []
+    def failing(batch, spans):
+      batches.append(len(batch))
+      if len(batches) == 2:
+        raise ValueError('injected')
+      return self.store(batch, spans)
+    aionntp._store = failing
+    exit_event, error = self.sync()
+    self.assertIsInstance(error, ValueError)
+    self.assertEqual(len(batches), 2)
+
+  def test_retry_prefers_another_host(self):
+    unit = scheduler.WorkUnit('fake', GROUP, 1, 10, 1, ('a',))
+    units = collections.deque([unit, unit._replace(low=11, failed_on=())])
+    self.assertEqual(aionntp._take(units, 'a').low, 11)
+    self.assertEqual(aionntp._take(units, 'a'), unit)
+
+
+if __name__ == '__main__':
+  unittest.main()
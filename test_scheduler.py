@@ -0,0 +1,47 @@
+#!/usr/bin/python
+"""Tests of the work unit scheduler."""
+
+import time
+import unittest
+
+from scheduler import Scheduler
+
+
+class SchedulerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.scheduler = Scheduler(max_attempts=2)
+    self.scheduler.register('a', 'a1')
+    self.scheduler.register('b', 'b1')
+
+  def test_home_group_first(self):
+    self.scheduler.add('a', 'g1', 1, 10)
+    self.scheduler.add('a', 'g2', 11, 20)
+    unit = self.scheduler.take('a1', 'a', 'g2')
+    self.assertEqual((unit.group, unit.low), ('g2', 11))
+
+  def test_idle_backbone_exits_while_another_is_busy(self):
+    self.scheduler.add('a', 'g1', 1, 10)
+    self.scheduler.add('b', 'g1', 1, 10)
+    busy = self.scheduler.take('a1', 'a', 'g1')
+    self.scheduler.done(self.scheduler.take('b1', 'b', 'g1'))
+    started = time.time()
+    self.assertIsNone(self.scheduler.take('b1', 'b', 'g1'))
+    self.assertLess(time.time() - started, 0.5)
+    self.assertEqual(self.scheduler.stats()['active'], 1)
+    self.scheduler.done(busy)
+    self.assertIsNone(self.scheduler.take('a1', 'a', 'g1'))
+
+  def test_failed_unit_is_retried_elsewhere(self):
+    self.scheduler.register('a', 'a2')
+    self.scheduler.add('a', 'g1', 1, 10)
+    self.scheduler.failed(self.scheduler.take('a1', 'a', 'g1'), 'a1')
+    unit = self.scheduler.take('a2', 'a', 'g1')
+    self.assertEqual((unit.attempts, unit.failed_on), (1, ('a1',)))
+    self.scheduler.failed(unit, 'a2')
+    self.assertIsNone(self.scheduler.take('a1', 'a', 'g1'))
+    self.assertEqual(self.scheduler.stats()['abandoned'], 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
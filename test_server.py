@@ -0,0 +1,61 @@
+#!/usr/bin/python
+"""Tests of the API server's response cache in server.py."""
+
+import unittest
+
+import store
+import test_store
+
+try:
+  from third_party import itty
+except ImportError:  # itty and gviz_api are not vendored; see README.md
+  server = None
+else:
+  import server
+
+
+class _Request(object):
+  def __init__(self, path, etag=None):
+    self.path = path
+    self.GET = {}
+    self._environ = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+
+
+@unittest.skipIf(server is None, 'third_party/itty.py is not installed')
+class CachedTest(test_store.StoreTest):
+
+  def setUp(self):
+    super(CachedTest, self).setUp()
+    self.responses = server.RESPONSES
+    server.RESPONSES = server.ResponseCache()
+    self.calls = 0
+    @server.cached()
+    def handler(request):
+      self.calls += 1
+      return itty.Response('%d groups' % store.Group.select().count())
+    self.handler = handler
+
+  def tearDown(self):
+    server.RESPONSES = self.responses
+    super(CachedTest, self).tearDown()
+
+  def test_revalidation(self):
+    first = self.handler(_Request('/groups'))
+    etag = dict(first.headers)['ETag']
+    self.assertIs(self.handler(_Request('/groups')), first)
+    revalidated = self.handler(_Request('/groups', etag))
+    self.assertEqual((revalidated.status, revalidated.output), (304, ''))
+    self.assertEqual(dict(revalidated.headers)['ETag'], etag)
+    self.assertEqual(self.calls, 1)
+
+  def test_generation_invalidates(self):
+    etag = dict(self.handler(_Request('/groups')).headers)['ETag']
+    store.GROUPS.ids(['alt.test'])  # bumps the generation
+    fresh = self.handler(_Request('/groups', etag))
+    self.assertEqual((fresh.status, fresh.output), (200, '1 groups'))
+    self.assertNotEqual(dict(fresh.headers)['ETag'], etag)
+    self.assertEqual(self.calls, 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
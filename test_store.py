@@ -0,0 +1,334 @@
+#!/usr/bin/python
+"""Tests of the models in store.py, each against a fresh database."""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import nntp
+import store
+
+
+class StoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    store.open_db({'path': os.path.join(self.directory, 'nntp.db')})
+
+  def tearDown(self):
+    store.peewee_db.close()
+    shutil.rmtree(self.directory)
+
+
+class CoverageTest(StoreTest):
+
+  def test_spans_merge(self):
+    store.Coverage.add('news.example.com', 'alt.test', 1, 10)
+    store.Coverage.add('news.example.com', 'alt.test', 21, 30)
+    store.Coverage.add('news.example.com', 'alt.test', 11, 20)
+    store.Coverage.add('news.example.com', 'alt.other', 5, 6)
+    self.assertEqual(store.Coverage.ranges('news.example.com', 'alt.test'),
+                     [(1, 30)])
+    self.assertEqual(store.Coverage.missing('news.example.com', 'alt.other',
+                                            1, 10), [(1, 4), (7, 10)])
+
+  def test_names_are_interned(self):
+    store.Coverage.add('news.example.com', 'alt.test', 1, 10)
+    row = store.Coverage.select().tuples().get()
+    self.assertEqual(row, (store.SERVERS.ids(['news.example.com'])[
+      'news.example.com'], store.GROUPS.ids(['alt.test'])['alt.test'], 1, 10))
+
+  def test_reads_add_no_names(self):
+    self.assertEqual(store.Coverage.missing('news.example.com', 'alt.test',
+                                            1, 10), [(1, 10)])
+    self.assertEqual(store.Coverage.ranges('news.example.com', 'alt.test'), [])
+    self.assertEqual(store.Server.select().count(), 0)
+    self.assertEqual(store.Group.select().count(), 0)
+
+
+class InternerTest(StoreTest):
+
+  def test_savepoint_rollback_clears(self):
+    with store.peewee_db.atomic():
+      kept = store.GROUPS.ids(['alt.kept'])['alt.kept']
+      try:
+        with store.peewee_db.atomic():
+          store.GROUPS.ids(['alt.gone'])
+          raise ValueError
+      except ValueError:
+        pass
+    self.assertEqual(store.GROUPS.find(['alt.kept', 'alt.gone']),
+                     {'alt.kept': kept})
+    added = store.GROUPS.ids(['alt.gone'])['alt.gone']
+    self.assertEqual(store.Group.get(store.Group.id == added).name, 'alt.gone')
+
+
+POSTED = ('2013-10-12 17:00:00', '2013-10-12 17:01:00+00:00')
+EPOCHS = (1381597200, 1381597260)
+ARTICLES = ((1, '<1@example>', 'poster@example.com', 'subject 1', 100),
+            (2, '<2@example>', 'poster@example.com', 'subject 2', 200))
+SEGMENTS = ((1, 'Some.Release', 'file.rar', 1, 1, 2, 1),
+            (2, 'Some.Release', 'file.rar', 1, 1, 2, 2))
+# (server, group, number, article) of the articles, one crossposted.
+INDEXES = (('news.example.com', 'alt.test', 1, 1),
+           ('news.example.com', 'alt.test', 2, 2),
+           ('news.example.com', 'alt.other', 7, 2))
+
+# The tables of layouts 0 to 2, and the unique indexes migrating relies
+# on, as the versions of store.py that wrote them created them.
+LAYOUT_0 = (
+  'CREATE TABLE article (identifier TEXT NOT NULL PRIMARY KEY,'
+  ' poster TEXT NOT NULL, posted DATETIME NOT NULL, subject TEXT NOT NULL,'
+  ' size BIGINT NOT NULL)',
+  'CREATE TABLE groupindex (server TEXT NOT NULL, name TEXT NOT NULL,'
+  ' number BIGINT NOT NULL, article_id TEXT NOT NULL,'
+  ' PRIMARY KEY (server, name, number))',
+  'CREATE TABLE segment (article_id TEXT NOT NULL PRIMARY KEY,'
+  ' release_name TEXT, file_name TEXT NOT NULL, file_total INTEGER NOT NULL,'
+  ' file_number INTEGER NOT NULL, part_total INTEGER NOT NULL,'
+  ' part_number INTEGER NOT NULL)',
+)
+LAYOUT_1 = (
+  'CREATE TABLE "article" ("id" INTEGER NOT NULL PRIMARY KEY,'
+  ' "identifier" TEXT NOT NULL, "identifier_hash" BIGINT NOT NULL,'
+  ' "poster" TEXT NOT NULL, "posted" DATETIME NOT NULL,'
+  ' "subject" TEXT NOT NULL, "size" BIGINT NOT NULL)',
+  'CREATE TABLE "group" ("name" TEXT NOT NULL PRIMARY KEY,'
+  ' "watch" INTEGER NOT NULL) WITHOUT ROWID',
+  'CREATE TABLE "stat" ("name" TEXT NOT NULL PRIMARY KEY,'
+  ' "value" BIGINT NOT NULL) WITHOUT ROWID',
+  'CREATE TABLE "groupindex" ("server" TEXT NOT NULL, "name" TEXT NOT NULL,'
+  ' "number" BIGINT NOT NULL, "article_id" INTEGER NOT NULL,'
+  ' PRIMARY KEY ("server", "name", "number")) WITHOUT ROWID',
+  'CREATE TABLE "coverage" ("server" TEXT NOT NULL, "name" TEXT NOT NULL,'
+  ' "low" BIGINT NOT NULL, "high" BIGINT NOT NULL,'
+  ' PRIMARY KEY ("server", "name", "low")) WITHOUT ROWID',
+  'CREATE TABLE "segment" ("article_id" INTEGER NOT NULL PRIMARY KEY,'
+  ' "release_name" TEXT, "file_name" TEXT NOT NULL,'
+  ' "file_total" INTEGER NOT NULL, "file_number" INTEGER NOT NULL,'
+  ' "part_total" INTEGER NOT NULL, "part_number" INTEGER NOT NULL)',
+  'CREATE TABLE "file" ("release_name" TEXT NOT NULL,'
+  ' "file_name" TEXT NOT NULL, "file_number" INTEGER NOT NULL,'
+  ' "file_total" INTEGER NOT NULL, "part_total" INTEGER NOT NULL,'
+  ' "parts" INTEGER NOT NULL, "size" BIGINT NOT NULL, "posted" DATETIME,'
+  ' PRIMARY KEY ("release_name", "file_name")) WITHOUT ROWID',
+  'CREATE TABLE "release" ("name" TEXT NOT NULL PRIMARY KEY,'
+  ' "file_total" INTEGER NOT NULL, "files" INTEGER NOT NULL,'
+  ' "part_total" INTEGER NOT NULL, "parts" INTEGER NOT NULL,'
+  ' "size" BIGINT NOT NULL, "completion" REAL NOT NULL, "posted" DATETIME,'
+  ' "file_names" TEXT NOT NULL)',
+  'CREATE UNIQUE INDEX "article_identifier_hash" ON "article"'
+  ' ("identifier_hash")',
+)
+LAYOUT_2 = (
+  'CREATE TABLE "poster" ("id" INTEGER NOT NULL PRIMARY KEY,'
+  ' "name" TEXT NOT NULL)',
+  'CREATE TABLE "server" ("id" INTEGER NOT NULL PRIMARY KEY,'
+  ' "name" TEXT NOT NULL)',
+  'CREATE TABLE "group" ("id" INTEGER NOT NULL PRIMARY KEY,'
+  ' "name" TEXT NOT NULL, "watch" INTEGER NOT NULL)',
+  'CREATE TABLE "article" ("id" INTEGER NOT NULL PRIMARY KEY,'
+  ' "identifier" TEXT NOT NULL, "identifier_hash" BIGINT NOT NULL,'
+  ' "poster_id" INTEGER NOT NULL, "posted" BIGINT NOT NULL,'
+  ' "subject" TEXT NOT NULL, "size" BIGINT NOT NULL)',
+  'CREATE TABLE "stat" ("name" TEXT NOT NULL PRIMARY KEY,'
+  ' "value" BIGINT NOT NULL) WITHOUT ROWID',
+  'CREATE TABLE "groupindex" ("server_id" INTEGER NOT NULL,'
+  ' "group_id" INTEGER NOT NULL, "number" BIGINT NOT NULL,'
+  ' "article_id" INTEGER NOT NULL,'
+  ' PRIMARY KEY ("server_id", "group_id", "number")) WITHOUT ROWID',
+  LAYOUT_1[4],  # coverage
+  LAYOUT_1[5],  # segment
+  'CREATE TABLE "file" ("release_name" TEXT NOT NULL,'
+  ' "file_name" TEXT NOT NULL, "file_number" INTEGER NOT NULL,'
+  ' "file_total" INTEGER NOT NULL, "part_total" INTEGER NOT NULL,'
+  ' "parts" INTEGER NOT NULL, "size" BIGINT NOT NULL, "posted" BIGINT,'
+  ' PRIMARY KEY ("release_name", "file_name")) WITHOUT ROWID',
+  'CREATE TABLE "release" ("name" TEXT NOT NULL PRIMARY KEY,'
+  ' "file_total" INTEGER NOT NULL, "files" INTEGER NOT NULL,'
+  ' "part_total" INTEGER NOT NULL, "parts" INTEGER NOT NULL,'
+  ' "size" BIGINT NOT NULL, "completion" REAL NOT NULL, "posted" BIGINT,'
+  ' "file_names" TEXT NOT NULL)',
+  LAYOUT_1[-1],  # article_identifier_hash
+  'CREATE UNIQUE INDEX "poster_name" ON "poster" ("name")',
+  'CREATE UNIQUE INDEX "server_name" ON "server" ("name")',
+  'CREATE UNIQUE INDEX "group_name" ON "group" ("name")',
+)
+
+
+class MigrationTest(StoreTest):
+  """Opens databases of every older layout and checks what they become."""
+
+  def migrate(self, version, schema, rows):
+    store.peewee_db.close()
+    path = os.path.join(self.directory, 'layout%d.db' % version)
+    conn = sqlite3.connect(path)
+    for statement in schema:
+      conn.execute(statement)
+    for table, values in rows:
+      for value in values:
+        conn.execute('INSERT INTO "%s" VALUES (%s)' % (
+          table, ', '.join('?' * len(value))), value)
+    conn.execute('PRAGMA user_version = %d' % version)
+    conn.commit()
+    conn.close()
+    store.open_db({'path': path})
+    migrated = self.dump()
+    store.peewee_db.close()
+    store.open_db({'path': path})
+    self.assertEqual(self.dump(), migrated)  # nothing left to migrate
+
+  def dump(self):
+    return dict((table, store.peewee_db.execute_sql(
+      'SELECT * FROM "%s" ORDER BY 1, 2' % table).fetchall())
+      for table in ('poster', 'server', 'group', 'article', 'groupindex',
+                    'coverage', 'segment', 'file', 'release', 'stat'))
+
+  def check(self, summaries=False):
+    sql = store.peewee_db.execute_sql
+    self.assertEqual(sql('PRAGMA user_version').fetchone()[0],
+                     store.SCHEMA_VERSION)
+    self.assertEqual(sql(
+      'SELECT identifier, poster.name, posted, typeof(posted), subject, size'
+      ' FROM article JOIN poster ON poster.id = poster_id'
+      ' ORDER BY article.id').fetchall(),
+      [(identifier, poster, epoch, u'integer', subject, size)
+       for (_, identifier, poster, subject, size), epoch
+       in zip(ARTICLES, EPOCHS)])
+    self.assertEqual(sql('SELECT COUNT(*) FROM poster').fetchone()[0], 1)
+    self.assertEqual(sorted(sql(
+      'SELECT server.name, "group".name, number, identifier FROM groupindex'
+      ' JOIN server ON server.id = server_id'
+      ' JOIN "group" ON "group".id = group_id'
+      ' JOIN article ON article.id = article_id').fetchall()),
+      sorted((server, group, number, ARTICLES[article - 1][1])
+             for server, group, number, article in INDEXES))
+    self.assertEqual(sql(
+      'SELECT identifier, part_number FROM segment'
+      ' JOIN article ON article.id = article_id ORDER BY 2').fetchall(),
+      [(u'<1@example>', 1), (u'<2@example>', 2)])
+    for counter, model in (('articles', store.Article),
+                           ('segments', store.Segment),
+                           ('groups', store.Group)):
+      self.assertEqual(store.Stat.get_value(counter), model.select().count())
+    if summaries:
+      self.assertEqual(store.Coverage.ranges('news.example.com', 'alt.test'),
+                       [(1, 2)])
+      self.assertEqual(sql('SELECT posted, typeof(posted) FROM release'
+                           ' UNION ALL SELECT posted, typeof(posted) FROM file'
+                           ).fetchall(), [(EPOCHS[0], u'integer')] * 2)
+      self.assertEqual(store.Release.get().postings, len(INDEXES))
+
+  def test_layout_0(self):
+    self.migrate(0, LAYOUT_0, [
+      ('article', [(identifier, poster, posted, subject, size)
+                   for (_, identifier, poster, subject, size), posted
+                   in zip(ARTICLES, POSTED)]),
+      ('groupindex', [(server, group, number, ARTICLES[article - 1][1])
+                      for server, group, number, article in INDEXES]),
+      ('segment', [(ARTICLES[row[0] - 1][1],) + row[1:] for row in SEGMENTS]),
+    ])
+    self.check()
+
+  def test_layout_1(self):
+    self.migrate(1, LAYOUT_1, [
+      ('article', [(id, identifier, store.message_key(identifier), poster,
+                    posted, subject, size)
+                   for (id, identifier, poster, subject, size), posted
+                   in zip(ARTICLES, POSTED)]),
+      ('group', [('alt.test', 1)]),
+      ('stat', [('articles', 5), ('generation', 3)]),
+      ('groupindex', INDEXES),
+      ('coverage', [('news.example.com', 'alt.test', 1, 2)]),
+      ('segment', SEGMENTS),
+      ('file', [('Some.Release', 'file.rar', 1, 1, 2, 2, 300, POSTED[0])]),
+      ('release', [('Some.Release', 1, 1, 2, 2, 300, 1.0, POSTED[0],
+                    'file.rar')]),
+    ])
+    self.check(summaries=True)
+    self.assertTrue(store.Group.get(store.Group.name == 'alt.test').watch)
+
+  def test_layout_2(self):
+    self.migrate(2, LAYOUT_2, [
+      ('poster', [(1, 'poster@example.com')]),
+      ('server', [(1, 'news.example.com')]),
+      ('group', [(1, 'alt.other', 0), (2, 'alt.test', 1)]),
+      ('article', [(id, identifier, store.message_key(identifier), 1, epoch,
+                    subject, size)
+                   for (id, identifier, _, subject, size), epoch
+                   in zip(ARTICLES, EPOCHS)]),
+      ('stat', [('articles', 2), ('generation', 3)]),
+      ('groupindex', [(1, 2 if group == 'alt.test' else 1, number, article)
+                      for _, group, number, article in INDEXES]),
+      ('coverage', [('news.example.com', 'alt.test', 1, 2)]),
+      ('segment', SEGMENTS),
+      ('file', [('Some.Release', 'file.rar', 1, 1, 2, 2, 300, EPOCHS[0])]),
+      ('release', [('Some.Release', 1, 1, 2, 2, 300, 1.0, EPOCHS[0],
+                    'file.rar')]),
+    ])
+    self.check(summaries=True)
+    self.assertEqual(store.SERVERS.ids(['news.example.com']),
+                     {'news.example.com': 1})
+
+
+class ReleaseTest(StoreTest):
+
+  def store(self, numbers, part=None, group='alt.test'):
+    batch = []
+    for number in numbers:
+      file_number = number % 3 + 1
+      batch.append(('news.example.com', group, nntp.Overview(
+        number, 'subject %d' % number, 'poster@example.com',
+        'Thu, 01 Jan 1970 00:%02d:00 +0000' % (number % 60),
+        '<%d@example>' % number, 100 + number), {
+          'release_name': 'Some.Release',
+          'file_name': 'file%d.rar' % file_number,
+          'file_number': file_number, 'file_total': 4,
+          'part_number': part or number // 3 + 1, 'part_total': 5}))
+    store.Article.addBatchFromNNTP(batch)
+
+  def summaries(self):
+    return (list(store.File.select().order_by(store.File.file_name).tuples()),
+            list(store.Release.select().tuples()))
+
+  def test_batches_match_rebuild(self):
+    self.store(range(0, 6))
+    self.store(range(3, 12))  # half of them stored already
+    self.store(range(100, 103), part=1)  # reposts of stored parts
+    self.store(range(4, 8), group='alt.other')  # crossposts
+    incremental = self.summaries()
+    store.Release.rebuild()
+    self.assertEqual(self.summaries(), incremental)
+    release = store.Release.get()
+    self.assertEqual((release.files, release.file_total, release.parts,
+                      release.part_total, release.postings), (3, 4, 12, 15, 19))
+    self.assertEqual(release.size, sum(100 + number for number in
+                                       range(12) + range(100, 103)))
+
+  def test_unchanged_release_keeps_generation(self):
+    self.store(range(0, 6))
+    generation = store.Stat.get_value('generation')
+    with store.peewee_db.atomic():
+      store.Release.refresh(['Some.Release'])
+    self.assertEqual(store.Stat.get_value('generation'), generation)
+
+  def test_counters(self):
+    self.store(range(0, 6))
+    generation = store.Stat.get_value('generation')
+    self.store(range(3, 12))
+    self.assertGreater(store.Stat.get_value('generation'), generation)
+    for counter, model in (('articles', store.Article),
+                           ('segments', store.Segment),
+                           ('releases', store.Release)):
+      self.assertEqual(store.Stat.get_value(counter), model.select().count())
+    triggers = [name for (name,) in store.peewee_db.execute_sql(
+      "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+      " AND name LIKE 'stat_%'").fetchall()]
+    self.assertNotIn('stat_article_insert', triggers)
+    self.assertIn('stat_release_insert', triggers)
+
+
+if __name__ == '__main__':
+  unittest.main()